@@ -0,0 +1,212 @@
+import math
+import time
+import traceback
+
+import requests
+from linode_api4 import LinodeClient
+
+import catalog
+import hashtopolis_agents as hta
+import inventory
+import jobs
+import network
+import planner
+import scale
+import speeds
+import state
+import tracing
+import warm_pool
+
+DEFAULTS = {
+    'min_agents': 0,
+    'max_agents': None,
+    'type': None,
+    'interval': 60,
+    'target_hours': 1.0,
+    'cooldown_up': 300,
+    'cooldown_down': 900,
+    'hysteresis': 0.2,
+    'idle_grace': 600
+}
+
+
+def policy(config: dict):
+    """The autoscale section of the config file over DEFAULTS; max_agents defaults to settings.max_agents."""
+    merged = {**DEFAULTS, **(config.get('autoscale') or {})}
+    if merged['max_agents'] is None:
+        merged['max_agents'] = int(config['settings'].get('max_agents', 30))
+
+    return merged
+
+
+def memory_name(config: dict):
+    return f'autoscale-{config["settings"]["cluster_prefix"]}.json'
+
+
+def per_agent_speed(config: dict, cat: dict, type_id: str, mode: int, measured: dict):
+    if measured.get(type_id, {}).get(mode):
+        return measured[type_id][mode]
+
+    linode_type = catalog.find_type(cat, type_id) if type_id else None
+    return planner.agent_speed(config, linode_type, mode) if linode_type else None
+
+
+@tracing.traced()
+def observe(config: dict, client: LinodeClient):
+    """Fleet size and the open tasks with their remaining keyspace and the speed of one agent on them.
+
+    Only the fleet's own agents count as registered or idle; a deactivated one is on its way out already.
+    """
+    domain, token = config['settings']['domain'], config['keys']['hashtopolis']
+    inv = inventory.get(config, client, refresh=True)
+    agents = inventory.agents(config, inv)
+    type_id = policy(config)['type'] or warm_pool.pool_type(config, inv)
+    vpc = network.get_vpc_info(config, client)
+    vpc_addresses = network.get_vpc_address_map(client, vpc['vpc']['id']) if vpc else {}
+    registered = list(hta.match_agents(domain, token, hta.instance_ips(agents, vpc_addresses)).values())
+
+    cat, measured, modes = None, speeds.medians(), {}
+    tasks, working = [], set()
+    for task in [t for t in jobs.api(config, 'task', 'listTasks')['tasks'] if t.get('type', 0) == 0]:
+        detail = jobs.api(config, 'task', 'getTask', taskId=task['taskId'])
+        if detail.get('isComplete'):
+            continue
+        if detail['hashlistId'] not in modes:
+            modes[detail['hashlistId']] = jobs.api(config, 'hashlist', 'getHashlist',
+                                                   hashlistId=detail['hashlistId'])['hashtypeId']
+        mode = modes[detail['hashlistId']]
+
+        on_task = [a for a in detail.get('agents', []) if float(a.get('speed') or 0) > 0]
+        working.update(a['agentId'] for a in on_task)
+        speed = sum(float(a['speed']) for a in on_task)
+        if on_task:
+            agent_speed = speed / len(on_task)
+        else:
+            cat = cat or catalog.get(config)
+            agent_speed = per_agent_speed(config, cat, type_id, mode, measured)
+
+        keyspace = float(detail.get('keyspace') or 0)
+        tasks.append({
+            'id': task['taskId'],
+            'mode': mode,
+            # a keyspace of 0 means no agent has measured it yet
+            'remaining': keyspace - float(detail.get('searched', detail.get('dispatched')) or 0) if keyspace else None,
+            'speed': speed,
+            'agent_speed': agent_speed
+        })
+
+    return {
+        'time': time.time(),
+        'agents': len(agents),
+        'registered': len(registered),
+        'idle': len([a for a in registered if a.get('isActive') and a['agentId'] not in working]),
+        'type': type_id,
+        'tasks': tasks
+    }
+
+
+def decide(observation: dict, rules: dict, memory: dict):
+    """Pure scaling decision: returns the target agent count, why, and the memory to pass to the next call.
+
+    The target is the fleet that finishes the open tasks in target_hours. Growing needs the target to be
+    hysteresis above the current size and cooldown_up since the last change, shrinking the same below it and
+    cooldown_down. Agents idle for idle_grace are removed whatever the queue says.
+    """
+    now, current = observation['time'], observation['agents']
+    low, high = rules['min_agents'], rules['max_agents']
+    memory = dict(memory)
+    since_change = now - memory.get('last_change', 0)
+
+    tasks = observation['tasks']
+    agent_seconds = sum(t['remaining'] / t['agent_speed'] for t in tasks if t['remaining'] and t['agent_speed'])
+    desired = math.ceil(agent_seconds / (rules['target_hours'] * 3600))
+    if any(t['remaining'] is None or not t['agent_speed'] for t in tasks):
+        desired = max(desired, 1)
+    desired = min(high, max(low, desired))
+
+    for key, active in (('idle_since', observation['idle']), ('empty_since', not tasks)):
+        if active:
+            memory.setdefault(key, now)
+        else:
+            memory.pop(key, None)
+    idle_for = now - memory.get('idle_since', now)
+    empty_for = now - memory.get('empty_since', now)
+
+    def result(target, reason):
+        return {'target': target, 'desired': desired, 'reason': reason, 'memory': memory}
+
+    if not low <= current <= high:
+        return result(min(high, max(low, current)), f'outside {low}-{high} agents')
+
+    if desired > current:
+        if current and desired < current * (1 + rules['hysteresis']):
+            return result(current, f'{desired} wanted, within hysteresis')
+        if since_change < rules['cooldown_up']:
+            return result(current, f'{desired} wanted, cooling down for {rules["cooldown_up"] - since_change:.0f} s')
+        return result(desired, f'{planner.format_hours(agent_seconds / 3600)} of agent time queued')
+
+    if observation['idle'] and idle_for >= rules['idle_grace']:
+        target = max(low, desired, current - observation['idle'])
+        if target < current:
+            return result(target, f'{observation["idle"]} agents idle for {idle_for:.0f} s')
+
+    if desired < current:
+        if tasks and desired > current * (1 - rules['hysteresis']):
+            return result(current, f'{desired} wanted, within hysteresis')
+        if since_change < rules['cooldown_down']:
+            return result(current,
+                          f'{desired} wanted, cooling down for {rules["cooldown_down"] - since_change:.0f} s')
+        if not tasks and empty_for < rules['idle_grace']:
+            return result(current, f'queue empty, reaping in {rules["idle_grace"] - empty_for:.0f} s')
+        return result(desired, f'{planner.format_hours(agent_seconds / 3600)} of agent time queued')
+
+    return result(current, 'on target')
+
+
+def report(observation: dict, decision: dict):
+    remaining = sum(t['remaining'] or 0 for t in observation['tasks'])
+    speed = sum(t['speed'] for t in observation['tasks'])
+    change = f'-> {decision["target"]}' if decision['target'] != observation['agents'] else 'hold'
+    print(f'# {time.strftime("%H:%M:%S")} {observation["agents"]} agents ({observation["idle"]} idle), '
+          f'{len(observation["tasks"])} tasks, {remaining:.3g} left at {planner.format_speed(speed)}: '
+          f'{change} ({decision["reason"]})')
+
+
+def run(config: dict, client: LinodeClient, dry_run: bool = False, once: bool = False):
+    rules = policy(config)
+    memory = state.load(memory_name(config), {})
+    print(f'# Autoscaling between {rules["min_agents"]} and {rules["max_agents"]} agents every {rules["interval"]} s'
+          f'{", dry run" if dry_run else ""}, Ctrl+C to stop')
+
+    try:
+        while True:
+            try:
+                observation = observe(config, client)
+                decision = decide(observation, rules, memory)
+                memory = decision['memory']
+                report(observation, decision)
+                if decision['target'] != observation['agents'] and not dry_run:
+                    try:
+                        changed = scale.scale(config, client, decision['target'], observation['type'],
+                                              no_prompt=True, refill=True)
+                    except SystemExit:
+                        # the deploy paths exit on what would stop a command, here it only stops this change
+                        print(' ! scaling stopped, trying again on the next poll')
+                        changed = False
+                    if changed:
+                        memory['last_change'] = time.time()
+                        memory.pop('idle_since', None)
+                        memory.pop('empty_since', None)
+                state.save(memory_name(config), memory)
+            except (requests.exceptions.RequestException, RuntimeError) as e:
+                print(f' ! {e}')
+            except Exception:
+                # anything else, e.g. a reply missing a field or a failed write of the speeds database
+                print(' ! autoscale poll failed, trying again on the next one')
+                traceback.print_exc()
+
+            if once:
+                return
+            tracing.sleep(rules['interval'], 'autoscale interval')
+    except KeyboardInterrupt:
+        print('\n# Autoscaler stopped')
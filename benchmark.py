@@ -0,0 +1,190 @@
+"""Run deploy, scale and remove against fakecloud.py and record wall-clock, API calls and peak memory.
+
+    python3 benchmark.py --agents 1 10 100 500 --latency 0.05 --output benchmark.json
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+
+import tracing
+
+FLOWS = ('deploy', 'scale out', 'scale in', 'remove')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_fakecloud(port: int, fake_args: list):
+    process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                             'fakecloud.py'), '--port', str(port), *fake_args],
+                               stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            fake_stats(port)
+            return process
+        except OSError:
+            time.sleep(0.1)
+
+    process.kill()
+    raise RuntimeError('fakecloud did not start')
+
+
+def fake_stats(port: int):
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/_fake/stats', timeout=5) as response:
+        return json.load(response)
+
+
+def point_at_fakecloud(port: int):
+    """Must run before any mewa module is imported, they read the endpoints at import time."""
+    base = f'http://127.0.0.1:{port}'
+    os.environ['MEWA_LINODE_API'] = f'{base}/linode/v4'
+    os.environ['MEWA_GODADDY_API'] = f'{base}/godaddy/v1'
+    os.environ['MEWA_IP_ECHO_URL'] = f'{base}/ip'
+    os.environ['MEWA_HASHTOPOLIS_URL'] = f'{base}/hashtopolis'
+
+
+def bench_config(port: int, agents: int, parallelism: int):
+    return {
+        'keys': {'linode': 'bench', 'godaddy_key': 'bench', 'godaddy_secret': 'bench', 'hashtopolis': 'bench'},
+        'stackscripts': {'server': '1470185', 'agent': '1469008'},
+        'settings': {
+            'cluster_prefix': 'bench_',
+            'domain': 'hashtopolis.bench.example',
+            'autoclean_when_failed': 0,
+            'parallelism': parallelism,
+            'server_ready_timeout': 900,
+            'dns_nameservers': [f'127.0.0.1:{port}'],
+            'inventory_ttl': 0,
+            'teardown_timeout': 600,
+            'voucher_reserve': 0,
+            'max_agents': max(30, agents * 2),
+            'drain_timeout': 5,
+            'golden_image': 0,
+            'warm_pool_size': 0
+        },
+        'images': {'agent_dir': '/root/htpclient', 'agent_service': 'hashtopolis-agent'}
+    }
+
+
+def measure(port: int, flow: str, fn):
+    before = fake_stats(port)
+    tracing.reset()
+    tracemalloc.start()
+    start_time = time.time()
+    error = None
+    try:
+        fn()
+    except SystemExit as e:
+        error = f'exit {e.code}'
+    except Exception as e:
+        error = str(e) or type(e).__name__
+    wall_clock = time.time() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    after = fake_stats(port)
+
+    return {
+        'flow': flow,
+        'wall_clock': round(wall_clock, 2),
+        'linode_calls': after.get('linode total', 0) - before.get('linode total', 0),
+        'hashtopolis_calls': after.get('hashtopolis total', 0) - before.get('hashtopolis total', 0),
+        'rate_limited': after.get('429', 0) - before.get('429', 0),
+        'peak_memory_mb': round(peak / 2 ** 20, 1),
+        'error': error
+    }
+
+
+def run(port: int, agents: int, parallelism: int, region: str, type_id: str):
+    # imported here so point_at_fakecloud() has already set the endpoints
+    from linode_api4 import LinodeClient
+
+    import http_client
+    import journal
+    import mewa
+    import scale
+
+    config = bench_config(port, agents, parallelism)
+    client = LinodeClient(config['keys']['linode'], base_url=http_client.LINODE_API)
+    step = max(1, agents // 10)
+
+    def deploy():
+        deploy_journal = journal.Journal()
+        deploy_journal.data['params'] = {'server': True, 'linodes': True, 'region': region, 'type': type_id,
+                                         'amount': agents, 'vpc_subnet': '10.0.0.0/16'}
+        mewa.run_deploy(config, client, deploy_journal)
+
+    flows = {
+        'deploy': deploy,
+        'scale out': lambda: scale.scale(config, client, agents + step, no_prompt=True),
+        'scale in': lambda: scale.scale(config, client, agents, no_prompt=True),
+        'remove': lambda: mewa.remove(config, client, no_prompt=True)
+    }
+    results = []
+    for flow in FLOWS:
+        result = measure(port, flow, flows[flow])
+        results.append({'agents': agents, **result})
+        if result['error'] and flow == 'deploy':
+            results.append({'agents': agents, **measure(port, 'remove', flows['remove'])})
+            break
+
+    return results
+
+
+def print_results(results: list):
+    print('\n# Benchmark results')
+    print(f'   {"agents":>6} {"flow":<10} {"wall s":>8} {"linode":>7} {"htp":>6} {"429s":>5} {"peak MB":>8}  error')
+    for r in results:
+        print(f'   {r["agents"]:>6} {r["flow"]:<10} {r["wall_clock"]:>8.1f} {r["linode_calls"]:>7} '
+              f'{r["hashtopolis_calls"]:>6} {r["rate_limited"]:>5} {r["peak_memory_mb"]:>8.1f}  {r["error"] or ""}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='benchmark', description='mewa deploy benchmarks against fakecloud.py',
+                                     epilog='unknown options are passed to fakecloud.py, e.g. --boot-time 5')
+    parser.add_argument('--agents', type=int, nargs='+', default=[1, 10, 100, 500])
+    parser.add_argument('--parallelism', type=int, default=8)
+    parser.add_argument('--region', default='us-east')
+    parser.add_argument('--type', default='g6-dedicated-8')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+
+    return parser.parse_known_args()
+
+
+def main():
+    args, fake_args = parse_args()
+    port = free_port()
+    process = start_fakecloud(port, fake_args)
+    point_at_fakecloud(port)
+
+    workdir = os.getcwd()
+    results = []
+    try:
+        for agents in args.agents:
+            # mewa keeps its state in ./.mewa, give every run a clean one
+            with tempfile.TemporaryDirectory(prefix='mewa-bench-') as tmp:
+                os.chdir(tmp)
+                try:
+                    results += run(port, agents, args.parallelism, args.region, args.type)
+                finally:
+                    os.chdir(workdir)
+    finally:
+        process.terminate()
+
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=1)
+
+
+if __name__ == '__main__':
+    main()
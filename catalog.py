@@ -0,0 +1,71 @@
+import time
+
+import requests
+
+import inventory
+import state
+
+CATALOG_NAME = 'catalog.json'
+
+
+def fetch(token: str):
+    regions = inventory.linode_list(token, 'regions')
+    types = inventory.linode_list(token, 'linode/types')
+
+    return {
+        'created': time.time(),
+        'regions': [
+            {
+                'id': r['id'],
+                'label': r['label'],
+                'country': r.get('country'),
+                'status': r.get('status', 'ok'),
+                'capabilities': r.get('capabilities', [])
+            } for r in regions
+        ],
+        'types': [
+            {
+                'id': t['id'],
+                'label': t['label'],
+                'class': t.get('class'),
+                'vcpus': t.get('vcpus', 0),
+                'memory': t.get('memory', 0),
+                'gpus': t.get('gpus', 0),
+                'hourly': (t.get('price') or {}).get('hourly') or 0.0,
+                'monthly': (t.get('price') or {}).get('monthly') or 0.0,
+                'region_prices': {p['id']: p.get('hourly') for p in t.get('region_prices') or []}
+            } for t in types
+        ]
+    }
+
+
+def get(config: dict, refresh: bool = False):
+    """Regions and types from .mewa/catalog.json, downloaded again after catalog_ttl hours.
+
+    When Linode can't be reached a stale catalog is used rather than failing.
+    """
+    ttl = float(config['settings'].get('catalog_ttl', 24)) * 3600
+    cached = state.load(CATALOG_NAME)
+    if cached and not refresh and time.time() - cached['created'] < ttl:
+        return cached
+
+    try:
+        catalog = fetch(config['keys']['linode'])
+    except requests.exceptions.RequestException as e:
+        if not cached:
+            raise
+        print(f'# Linode catalog unavailable ({e.__class__.__name__}), '
+              f'using the one from {time.strftime("%Y-%m-%d %H:%M", time.localtime(cached["created"]))}')
+        return cached
+
+    state.save(CATALOG_NAME, catalog)
+    return catalog
+
+
+def hourly_price(linode_type: dict, region: str = None):
+    return linode_type['region_prices'].get(region) or linode_type['hourly']
+
+
+def find_type(catalog: dict, type_id: str):
+    return next((t for t in catalog['types'] if t['id'] == type_id), None)
+
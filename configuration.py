@@ -1,10 +1,7 @@
-import requests
-import json
 import yaml
 import os
 
-from linode_api4 import LinodeClient
-
+import catalog
 import misc
 
 
@@ -40,7 +37,50 @@ def create_config(file_name):
     config['settings'] = {
         'cluster_prefix': cluster_prefix if cluster_prefix else default_prefix,
         'domain': input(' - enter domain name: '),
-        'autoclean_when_failed': 0
+        'autoclean_when_failed': 0,
+        'parallelism': 8,
+        'server_ready_timeout': 900,
+        'dns_public_resolvers': [],
+        'dns_quorum': 1.0,
+        'inventory_ttl': 30,
+        'teardown_timeout': 600,
+        'voucher_reserve': 0,
+        'max_agents': 30,
+        'drain_timeout': 120,
+        'golden_image': 0,
+        'image_build_timeout': 1800,
+        'warm_pool_size': 0,
+        'warm_pool_max_age': 24,
+        'warm_pool_provision_timeout': 1800,
+        'catalog_ttl': 24,
+        'collect_speeds': 1,
+        'hashlist_part_mb': 16,
+        'hashlist_uploads': 2,
+        'hashtopolis_access_group': 1,
+        'metrics_host': '0.0.0.0',
+        'metrics_port': 9108,
+        'metrics_interval': 30,
+        'agent_registration_timeout': 1200,
+        'agent_replacements': 3,
+        'agent_regions': [],
+        'agents_per_region': 0,
+        'ipam_reservation_ttl': 6
+    }
+
+    config['images'] = {
+        'agent_dir': '/root/htpclient',
+        'agent_service': 'hashtopolis-agent'
+    }
+
+    config['autoscale'] = {
+        'min_agents': 0,
+        'max_agents': 30,
+        'interval': 60,
+        'target_hours': 1.0,
+        'cooldown_up': 300,
+        'cooldown_down': 900,
+        'hysteresis': 0.2,
+        'idle_grace': 600
     }
 
     with open(file_name, 'w') as file:
@@ -69,43 +109,43 @@ def reconfig(config_filename: str):
     create_config(config_filename)
 
 
-def pick_region(client: LinodeClient):
-    available_regions = client.regions()
+def pick_region(config: dict):
+    available_regions = catalog.get(config)['regions']
 
     for index, item in enumerate(available_regions, start=1):
-        print(f'{index:>2}. {item.label}')
+        print(f'{index:>2}. {item['label']}')
 
     while True:
         try:
             linode_region = int(input('# Choose a region: '))
             if 1 <= linode_region <= len(available_regions):
                 print()
-                return available_regions[int(linode_region) - 1].label, available_regions[int(linode_region) - 1].id
+                return available_regions[linode_region - 1]['label'], available_regions[linode_region - 1]['id']
         except ValueError:
             continue
 
 
-def pick_type():
-    url = 'https://api.linode.com/v4/linode/types'
-    headers = {'accept': 'application/json'}
-
-    response = requests.get(url, headers=headers)
-    data = json.loads(response.text)['data']
+def pick_type(config: dict):
+    data = catalog.get(config)['types']
 
     for index, item in enumerate(data, start=1):
-        print(f'{index:>2}. {item['label']}')
+        gpus = f', {item['gpus']} GPU' if item['gpus'] else ''
+        print(f'{index:>2}. {item['label']:<36} {item['vcpus']:>3} vCPU{gpus:<8} ${item['hourly']:.3f}/h')
 
     while True:
-        linode_type = int(input('# Choose a type: '))
-        if 1 <= linode_type <= len(data):
-            print()
-            return data[linode_type - 1]['label'], data[linode_type - 1]['id']
+        try:
+            linode_type = int(input('# Choose a type: '))
+            if 1 <= linode_type <= len(data):
+                print()
+                return data[linode_type - 1]['label'], data[linode_type - 1]['id']
+        except ValueError:
+            continue
 
 
-def pick_amount():
+def pick_amount(max_amount: int = 30):
     amount = int(input('# Choose an amount: '))
     while True:
-        if 1 <= amount <= 30:
+        if 1 <= amount <= max_amount:
             print()
             return amount
         else:
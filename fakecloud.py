@@ -0,0 +1,915 @@
+"""Local stand-in for the Linode, GoDaddy and Hashtopolis APIs and the cluster DNS, used by benchmark.py.
+
+    python3 fakecloud.py --port 8700 --latency 0.05 --error-rate 0.01 --rate-limit 800
+
+Point mewa at it with
+    MEWA_LINODE_API=http://127.0.0.1:8700/linode/v4
+    MEWA_GODADDY_API=http://127.0.0.1:8700/godaddy/v1
+    MEWA_IP_ECHO_URL=http://127.0.0.1:8700/ip
+    MEWA_HASHTOPOLIS_URL=http://127.0.0.1:8700/hashtopolis
+and settings.dns_nameservers: ['127.0.0.1:8700'] (DNS is served over UDP on the same port number).
+"""
+import argparse
+import base64
+import ipaddress
+import itertools
+import json
+import random
+import re
+import socket
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+
+REGIONS = [
+    {'id': 'us-east', 'label': 'Newark, NJ', 'country': 'us'},
+    {'id': 'us-ord', 'label': 'Chicago, IL', 'country': 'us'},
+    {'id': 'eu-central', 'label': 'Frankfurt, DE', 'country': 'de'},
+    {'id': 'ap-south', 'label': 'Singapore, SG', 'country': 'sg'}
+]
+TYPES = [
+    {'id': 'g6-standard-2', 'label': 'Linode 4GB', 'class': 'standard', 'vcpus': 2, 'memory': 4096, 'gpus': 0,
+     'price': {'hourly': 0.036, 'monthly': 24.0}},
+    {'id': 'g6-dedicated-8', 'label': 'Dedicated 16GB', 'class': 'dedicated', 'vcpus': 8, 'memory': 16384,
+     'gpus': 0, 'price': {'hourly': 0.216, 'monthly': 144.0}},
+    {'id': 'g1-gpu-rtx6000-1', 'label': 'Dedicated 32GB + RTX6000 GPU x1', 'class': 'gpu', 'vcpus': 8,
+     'memory': 32768, 'gpus': 1, 'price': {'hourly': 1.5, 'monthly': 1000.0}}
+]
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, reason: str, field: str = None):
+        self.status = status
+        self.body = {'errors': [{'reason': reason, **({'field': field} if field else {})}]}
+        super().__init__(reason)
+
+
+def timestamp(t: float):
+    return datetime.fromtimestamp(t, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def lookup(item: dict, key: str):
+    for part in key.split('.'):
+        item = item.get(part) if isinstance(item, dict) else None
+    return item
+
+
+def matches(item: dict, x_filter: dict):
+    for key, condition in x_filter.items():
+        if key in ('+order', '+order_by'):
+            continue
+        if key == '+and':
+            if not all(matches(item, f) for f in condition):
+                return False
+        elif key == '+or':
+            if not any(matches(item, f) for f in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = lookup(item, key)
+            for op, arg in condition.items():
+                if op == '+contains' and str(arg) not in str(value or ''):
+                    return False
+                if op == '+neq' and value == arg:
+                    return False
+                if op in ('+gt', '+gte', '+lt', '+lte') and (value is None or not {
+                    '+gt': value > arg, '+gte': value >= arg, '+lt': value < arg, '+lte': value <= arg
+                }[op]):
+                    return False
+        elif lookup(item, key) != condition:
+            return False
+
+    return True
+
+
+class Cloud:
+    """All fake state; status changes are computed from timestamps whenever something is read."""
+
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1000)
+        self.public_ips = (str(ip) for ip in ipaddress.ip_network('100.64.0.0/10').hosts())
+        self.instances = {}
+        self.firewalls = {}
+        self.vpcs = {}
+        self.images = {}
+        self.events = {}
+        self.records = {}
+        self.vouchers = set()
+        self.agents = {}
+        self.hashlists = {}
+        self.tasks = {}
+        self.files = {}
+        self.hashes = {}
+        self.chunks = {}
+        self.calls = Counter()
+        self.windows = {}
+        self.started = self.worked = time.time()
+        self.queue = sorted(args.queue, key=lambda job: job['at'])
+
+    # Linode instances
+
+    def set_phase(self, instance: dict, during: str, seconds: float, after: str, action: str = None):
+        start = max(time.time(), instance['until'] if instance['status_after'] == 'provisioned' else 0)
+        instance['during'], instance['until'], instance['status_after'] = during, start + seconds, after
+        if after == 'running':
+            instance['running_since'] = start + seconds
+        if action:
+            self.add_event(action, instance, start + seconds)
+
+    def status(self, instance: dict):
+        if time.time() < instance['until']:
+            return instance['during']
+        return 'offline' if instance['status_after'] == 'provisioned' else instance['status_after']
+
+    def add_event(self, action: str, instance: dict, finished: float):
+        event_id = next(self.ids)
+        self.events[event_id] = {
+            'id': event_id,
+            'action': action,
+            'created': time.time(),
+            'finished': finished,
+            'entity': {'id': instance['id'], 'type': 'linode', 'label': instance['label']}
+        }
+
+    def event_json(self, event: dict):
+        done = time.time() >= event['finished']
+        return {
+            'id': event['id'],
+            'action': event['action'],
+            'created': timestamp(event['created']),
+            'entity': event['entity'],
+            'status': 'finished' if done else 'started',
+            'percent_complete': 100 if done else 50,
+            'seen': False,
+            'read': False,
+            'message': '',
+            'username': 'fakecloud'
+        }
+
+    def instance_json(self, instance: dict):
+        return {
+            'id': instance['id'],
+            'label': instance['label'],
+            'status': self.status(instance),
+            'type': instance['type'],
+            'region': instance['region'],
+            'image': instance['image'],
+            'ipv4': [instance['ipv4']],
+            'ipv6': None,
+            'created': timestamp(instance['created']),
+            'updated': timestamp(instance['created']),
+            'tags': instance['tags'],
+            'group': '',
+            'hypervisor': 'kvm',
+            'specs': {'disk': 81920, 'memory': 4096, 'vcpus': 2, 'transfer': 4000, 'gpus': 0},
+            'alerts': {},
+            'backups': {'enabled': False, 'available': False, 'schedule': {}},
+            'watchdog_enabled': True,
+            'has_user_data': bool(instance['voucher'])
+        }
+
+    def vpc_interface(self, body: dict, instance_id: int = None):
+        subnet_id = body.get('subnet_id')
+        vpc = next((v for v in self.vpcs.values() if any(s['id'] == subnet_id for s in v['subnets'])), None)
+        if vpc is None:
+            raise ApiError(400, 'Subnet not found', 'interfaces[0].subnet_id')
+        address = (body.get('ipv4') or {}).get('vpc')
+        subnet = next(s for s in vpc['subnets'] if s['id'] == subnet_id)
+        if address and ipaddress.ip_address(address) not in ipaddress.ip_network(subnet['ipv4']):
+            raise ApiError(400, f'{address} is not in {subnet["ipv4"]}', 'interfaces[0].ipv4.vpc')
+        used = {i['vpc_ip'] for i in self.instances.values()
+                if i['id'] != instance_id and i['vpc_id'] == vpc['id'] and i['vpc_ip']}
+        if address in used:
+            raise ApiError(400, f'{address} is already in use', 'interfaces[0].ipv4.vpc')
+
+        return vpc['id'], subnet_id, address
+
+    def create_instance(self, body: dict):
+        if any(i['label'] == body.get('label') for i in self.instances.values()):
+            raise ApiError(400, 'Label must be unique among your Linodes', 'label')
+        if body.get('type') not in {t['id'] for t in TYPES}:
+            raise ApiError(400, 'A valid plan type by that ID was not found', 'type')
+        capacity = self.args.region_capacity.get(body.get('region'))
+        if capacity is not None and len([i for i in self.instances.values()
+                                         if i['region'] == body.get('region')]) >= capacity:
+            raise ApiError(400, 'Not enough capacity in this region for that plan', 'type')
+
+        vpc_id = subnet_id = vpc_ip = None
+        for interface in body.get('interfaces') or []:
+            if interface.get('purpose') == 'vpc':
+                vpc_id, subnet_id, vpc_ip = self.vpc_interface(interface)
+
+        voucher = (body.get('stackscript_data') or {}).get('VOUCHER')
+        user_data = (body.get('metadata') or {}).get('user_data')
+        if user_data:
+            found = re.search(r'"voucher": "([^"]+)"', base64.b64decode(user_data).decode())
+            voucher = found.group(1) if found else voucher
+
+        instance_id = next(self.ids)
+        instance = {
+            'id': instance_id,
+            'label': body.get('label') or f'linode{instance_id}',
+            'type': body['type'],
+            'region': body.get('region'),
+            'image': body.get('image'),
+            'ipv4': next(self.public_ips),
+            'created': time.time(),
+            'tags': body.get('tags') or [],
+            'firewall_id': body.get('firewall_id'),
+            'vpc_id': vpc_id,
+            'subnet_id': subnet_id,
+            'vpc_ip': vpc_ip,
+            'voucher': voucher,
+            'golden': str(body.get('image', '')).startswith('private/'),
+            'install_fails': bool(voucher) and random.random() < self.args.agent_failure_rate,
+            'until': 0,
+            'status_after': 'offline',
+            'running_since': None
+        }
+        self.set_phase(instance, 'provisioning', self.args.provision_time, 'provisioned', 'linode_create')
+        self.instances[instance_id] = instance
+        if body.get('booted', True):
+            self.set_phase(instance, 'booting', self.args.boot_time, 'running', 'linode_boot')
+
+        return self.instance_json(instance)
+
+    def instance(self, instance_id: int):
+        if instance_id not in self.instances:
+            raise ApiError(404, 'Not found')
+        return self.instances[instance_id]
+
+    def configs(self, instance: dict):
+        interfaces = []
+        if instance['vpc_id']:
+            interfaces.append({
+                'id': instance['id'] * 10,
+                'purpose': 'vpc',
+                'primary': True,
+                'active': True,
+                'vpc_id': instance['vpc_id'],
+                'subnet_id': instance['subnet_id'],
+                'ipv4': {'vpc': instance['vpc_ip'], 'nat_1_1': instance['ipv4']}
+            })
+        return [{'id': instance['id'], 'label': 'My Debian Profile', 'interfaces': interfaces}]
+
+    # VPCs and firewalls
+
+    def vpc_ips(self, vpc_id: int):
+        return [{
+            'address': i['vpc_ip'],
+            'linode_id': i['id'],
+            'vpc_id': vpc_id,
+            'subnet_id': i['subnet_id'],
+            'active': self.status(i) == 'running',
+            'nat_1_1': i['ipv4']
+        } for i in self.instances.values() if i['vpc_id'] == vpc_id and i['vpc_ip']]
+
+    def create_vpc(self, body: dict):
+        if any(v['label'] == body.get('label') for v in self.vpcs.values()):
+            raise ApiError(400, 'Label must be unique among your VPCs', 'label')
+        vpc_id = next(self.ids)
+        now = timestamp(time.time())
+        self.vpcs[vpc_id] = {
+            'id': vpc_id,
+            'label': body['label'],
+            'region': body['region'],
+            'description': body.get('description', ''),
+            'subnets': [{'id': next(self.ids), 'label': s['label'], 'ipv4': s['ipv4'], 'linodes': [],
+                         'created': now, 'updated': now} for s in body.get('subnets', [])],
+            'created': now,
+            'updated': now
+        }
+        return self.vpcs[vpc_id]
+
+    def create_firewall(self, body: dict):
+        if any(f['label'] == body.get('label') for f in self.firewalls.values()):
+            raise ApiError(400, 'Label must be unique among your Firewalls', 'label')
+        firewall_id = next(self.ids)
+        now = timestamp(time.time())
+        self.firewalls[firewall_id] = {
+            'id': firewall_id,
+            'label': body['label'],
+            'status': 'enabled',
+            'rules': body.get('rules') or {'inbound': [], 'outbound': [], 'inbound_policy': 'DROP',
+                                          'outbound_policy': 'ACCEPT'},
+            'tags': [],
+            'created': now,
+            'updated': now
+        }
+        return self.firewalls[firewall_id]
+
+    # Hashtopolis
+
+    def server_ready(self):
+        server = next((i for i in self.instances.values() if i['label'].endswith('server')), None)
+        if server is None or self.status(server) != 'running':
+            return False
+        return time.time() - server['running_since'] >= self.args.install_time
+
+    def reachable(self, server: dict, instance: dict):
+        """Agents in the server's region come over the VPC, others need a rule for their public IP."""
+        if instance['region'] == server['region']:
+            return True
+        firewall = self.firewalls.get(server['firewall_id'])
+        if firewall is None:
+            return True
+        allowed = {a for rule in firewall['rules'].get('inbound', []) for a in rule['addresses'].get('ipv4', [])}
+        return f'{instance["ipv4"]}/32' in allowed or '0.0.0.0/0' in allowed
+
+    def register_agents(self):
+        """Agents whose instance has been running long enough redeem their voucher."""
+        if not self.server_ready():
+            return
+        server = next(i for i in self.instances.values() if i['label'].endswith('server'))
+        registered = {a['instance_id'] for a in self.agents.values()}
+        for instance in self.instances.values():
+            if instance['id'] in registered or not instance['voucher'] or self.status(instance) != 'running':
+                continue
+            if instance['install_fails'] or not self.reachable(server, instance):
+                continue
+            install_time = self.args.image_install_time if instance['golden'] else self.args.agent_install_time
+            if time.time() - instance['running_since'] < install_time or instance['voucher'] not in self.vouchers:
+                continue
+            self.vouchers.discard(instance['voucher'])
+            agent_id = len(self.agents) + 1
+            while agent_id in self.agents:
+                agent_id += 1
+            self.agents[agent_id] = {
+                'agentId': agent_id,
+                'instance_id': instance['id'],
+                'name': instance['label'],
+                'isActive': True,
+                'ip': instance['vpc_ip'] if instance['region'] == server['region'] else instance['ipv4'],
+                'time': int(time.time())
+            }
+
+    def hashtopolis(self, body: dict):
+        section, request = body.get('section'), body.get('request')
+        if (section, request) == ('test', 'connection'):
+            return {'section': 'test', 'request': 'connection', 'response': 'SUCCESS'}
+        if not body.get('accessKey'):
+            return {'section': section, 'request': request, 'response': 'ERROR', 'message': 'Invalid access key!'}
+
+        self.register_agents()
+        self.work()
+        ok = {'section': section, 'request': request, 'response': 'OK'}
+        if section in ('hashlist', 'superhashlist', 'task', 'file', 'cracker'):
+            return self.hashtopolis_tasks(ok, body)
+        if section != 'agent':
+            return {**ok, 'response': 'ERROR', 'message': f'Invalid section {section}'}
+        if request == 'listAgents':
+            return {**ok, 'agents': [{'agentId': a['agentId'], 'name': a['name'], 'devices': self.devices(a)}
+                                     for a in self.agents.values()]}
+        if request == 'createVoucher':
+            self.vouchers.add(body['voucher'])
+            return {**ok, 'voucher': body['voucher']}
+        if request == 'listVouchers':
+            return {**ok, 'vouchers': sorted(self.vouchers)}
+
+        agent = self.agents.get(body.get('agentId'))
+        if agent is None:
+            return {**ok, 'response': 'ERROR', 'message': 'Invalid agent ID!'}
+        if request == 'get':
+            return {**ok, 'agentId': agent['agentId'], 'name': agent['name'], 'devices': self.devices(agent),
+                    'isActive': agent['isActive'], 'isCpuOnly': not self.agent_type(agent)['gpus'],
+                    'isTrusted': False,
+                    'lastActivity': {'action': 'sendProgress' if agent.get('task') else 'getTask',
+                                     'time': agent['time'], 'ip': agent['ip']}}
+        if request == 'setActive':
+            agent['isActive'] = bool(body.get('active'))
+            return ok
+        if request == 'delete':
+            del self.agents[agent['agentId']]
+            return ok
+
+        return {**ok, 'response': 'ERROR', 'message': f'Invalid request {request}'}
+
+    def agent_type(self, agent: dict):
+        instance = self.instances.get(agent['instance_id'], {})
+        return next((t for t in TYPES if t['id'] == instance.get('type')), TYPES[0])
+
+    def devices(self, agent: dict):
+        linode_type = self.agent_type(agent)
+        if linode_type['gpus']:
+            return ['NVIDIA Quadro RTX 6000'] * linode_type['gpus']
+        return [f'AMD EPYC 7713 64-Core Processor ({linode_type["vcpus"]} cores)']
+
+    def agent_speed(self, agent: dict, mode: int):
+        """Made up but stable speeds: scales with the hardware, drops with the mode, +-10% per agent."""
+        linode_type = self.agent_type(agent)
+        base = 40e9 * linode_type['gpus'] if linode_type['gpus'] else 100e6 * linode_type['vcpus']
+        return round(base / (1 + mode / 100) * random.Random(agent['agentId']).uniform(0.9, 1.1))
+
+    def hashtopolis_tasks(self, ok: dict, body: dict):
+        request = body.get('request')
+        if request == 'createHashlist':
+            hashlist_id = len(self.hashlists) + 1
+            self.hashes[hashlist_id] = list(dict.fromkeys(base64.b64decode(body.get('data', '')).decode().split()))
+            self.hashlists[hashlist_id] = {'hashlistId': hashlist_id, 'name': body.get('name'),
+                                           'hashtypeId': int(body.get('hashtypeId', 0)), 'format': 0,
+                                           'hashCount': len(self.hashes[hashlist_id]), 'cracked': 0,
+                                           'isSecret': bool(body.get('isSecret'))}
+            return {**ok, 'hashlistId': hashlist_id}
+        if request == 'listHashlists':
+            return {**ok, 'hashlists': [{k: h[k] for k in ('hashlistId', 'name', 'hashtypeId', 'format', 'hashCount')}
+                                        for h in self.hashlists.values() if h['format'] != 3]}
+        if request == 'createSuperhashlist':
+            parts = [self.hashlists.get(i) for i in body.get('hashlists', [])]
+            if not parts or None in parts or len({p['hashtypeId'] for p in parts}) != 1:
+                return {**ok, 'response': 'ERROR', 'message': 'Invalid hashlists!'}
+            hashlist_id = len(self.hashlists) + 1
+            self.hashlists[hashlist_id] = {'hashlistId': hashlist_id, 'name': body.get('name'),
+                                           'hashtypeId': parts[0]['hashtypeId'], 'format': 3,
+                                           'hashCount': sum(p['hashCount'] for p in parts), 'cracked': 0,
+                                           'isSecret': any(p['isSecret'] for p in parts),
+                                           'hashlists': body['hashlists']}
+            return ok
+        if request == 'getSuperhashlist':
+            hashlist = self.hashlists.get(body.get('superhashlistId'))
+            if hashlist is None or hashlist['format'] != 3:
+                return {**ok, 'response': 'ERROR', 'message': 'Invalid superhashlist!'}
+            return {**ok, **hashlist}
+        if request == 'listSuperhashlists':
+            return {**ok, 'superhashlists': [{k: h[k] for k in ('hashlistId', 'name', 'hashtypeId', 'hashCount')}
+                                             for h in self.hashlists.values() if h['format'] == 3]}
+        if request == 'addFile':
+            if body.get('source') not in ('inline', 'url', 'import'):
+                return {**ok, 'response': 'ERROR', 'message': 'Invalid source!'}
+            size = len(base64.b64decode(body.get('data', ''))) if body['source'] == 'inline' else 0
+            file_id = len(self.files) + 1
+            self.files[file_id] = {'fileId': file_id, 'filename': body.get('filename'),
+                                   'fileType': int(body.get('fileType', 0)), 'size': size}
+            return ok
+        if request == 'listFiles':
+            return {**ok, 'files': list(self.files.values())}
+        if request == 'listCrackers':
+            return {**ok, 'crackers': [{'crackerTypeId': 1, 'crackerTypeName': 'hashcat'}]}
+        if request == 'getCracker':
+            return {**ok, 'crackerTypeId': 1, 'crackerTypeName': 'hashcat',
+                    'crackerVersions': [{'versionId': 1, 'version': '6.2.6', 'binaryBasename': 'hashcat'}]}
+        if request == 'getHashlist':
+            hashlist = self.hashlists.get(body.get('hashlistId'))
+            if hashlist is None:
+                return {**ok, 'response': 'ERROR', 'message': 'Invalid hashlist!'}
+            return {**ok, **hashlist, 'cracked': len(self.cracked(hashlist['hashlistId']))}
+        if request == 'getCracked':
+            if body.get('hashlistId') not in self.hashlists:
+                return {**ok, 'response': 'ERROR', 'message': 'Invalid hashlist!'}
+            return {**ok, 'cracked': self.cracked(body['hashlistId'])}
+        if request == 'createTask':
+            if body.get('hashlistId') not in self.hashlists:
+                return {**ok, 'response': 'ERROR', 'message': 'Invalid hashlist ID!'}
+            if '#HL#' not in body.get('attackCmd', ''):
+                return {**ok, 'response': 'ERROR', 'message': 'Attack command does not contain hashlist alias!'}
+            if any(f not in self.files for f in body.get('files', [])):
+                return {**ok, 'response': 'ERROR', 'message': 'Invalid file ID!'}
+            return {**ok, 'taskId': self.create_task(body)}
+        if request == 'setTaskPriority':
+            if body.get('taskId') not in self.tasks:
+                return {**ok, 'response': 'ERROR', 'message': 'Invalid task!'}
+            self.tasks[body['taskId']]['priority'] = int(body.get('priority', 0))
+            return ok
+        if request == 'listTasks':
+            return {**ok, 'tasks': [{k: t[k] for k in ('taskId', 'name', 'type', 'hashlistId', 'priority')}
+                                    for t in self.tasks.values()]}
+        if request == 'getTask':
+            task = self.tasks.get(body.get('taskId'))
+            if task is None:
+                return {**ok, 'response': 'ERROR', 'message': 'Invalid task!'}
+            mode = self.hashlists[task['hashlistId']]['hashtypeId']
+            agents = [{'agentId': a['agentId'], 'benchmark': f'1:{self.agent_speed(a, mode)}',
+                       'speed': self.agent_speed(a, mode)}
+                      for a in self.agents.values() if a.get('task') == task['taskId']]
+            return {**ok, **task, 'keyspace': int(task['keyspace']), 'dispatched': int(task['searched']),
+                    'searched': int(task['searched']), 'agents': agents,
+                    'chunkIds': [c['chunkId'] for c in self.chunks.values() if c['taskId'] == task['taskId']]}
+        if request == 'getChunk':
+            chunk = self.chunks.get(body.get('chunkId'))
+            if chunk is None:
+                return {**ok, 'response': 'ERROR', 'message': 'Invalid chunk!'}
+            return {**ok, **self.chunk_json(chunk)}
+
+        return {**ok, 'response': 'ERROR', 'message': f'Invalid request {request}'}
+
+    def create_task(self, body: dict):
+        task_id = len(self.tasks) + 1
+        self.tasks[task_id] = {'taskId': task_id, 'name': body.get('name'), 'type': 0,
+                               'hashlistId': body['hashlistId'], 'priority': int(body.get('priority', 0)),
+                               'attack': body.get('attackCmd', ''), 'chunkTime': int(body.get('chunksize', 600)),
+                               'files': body.get('files', []), 'isComplete': False, 'created': time.time(),
+                               'keyspace': float(body.get('keyspace', self.args.task_keyspace)), 'searched': 0.0}
+        return task_id
+
+    def work(self):
+        """Release due --queue jobs and let every active agent work on the open task with the highest priority."""
+        now = time.time()
+        while self.queue and self.started + self.queue[0]['at'] <= now:
+            job = self.queue.pop(0)
+            hashlist_id = len(self.hashlists) + 1
+            self.hashes[hashlist_id] = []
+            self.hashlists[hashlist_id] = {'hashlistId': hashlist_id, 'name': job['name'],
+                                           'hashtypeId': int(job.get('mode', 0)), 'format': 0, 'hashCount': 0,
+                                           'cracked': 0, 'isSecret': False}
+            self.create_task({**job, 'hashlistId': hashlist_id, 'attackCmd': '#HL# -a 3 ?a?a?a?a?a?a?a'})
+
+        elapsed, self.worked = now - self.worked, now
+        open_tasks = sorted((t for t in self.tasks.values() if not t['isComplete']),
+                            key=lambda t: (-t['priority'], t['taskId']))
+        for agent in self.agents.values():
+            instance = self.instances.get(agent['instance_id'])
+            running = instance is not None and self.status(instance) == 'running'
+            task = open_tasks[0] if open_tasks and agent['isActive'] and running else None
+            agent['task'] = task and task['taskId']
+            if task:
+                agent['time'] = int(now)
+                mode = self.hashlists[task['hashlistId']]['hashtypeId']
+                task['searched'] = min(task['keyspace'], task['searched'] + self.agent_speed(agent, mode) * elapsed)
+                self.dispatch(agent, task, now)
+        for task in open_tasks:
+            task['isComplete'] = task['searched'] >= task['keyspace']
+
+    def dispatch(self, agent: dict, task: dict, now: float):
+        """A new chunk of chunkTime seconds once the agent's current one is done or belongs to another task."""
+        chunk = self.chunks.get(agent.get('chunk'))
+        if chunk and chunk['taskId'] == task['taskId'] and now < chunk['dispatchTime'] + task['chunkTime']:
+            return
+        if chunk:
+            chunk.update(state=4, progress=10000, checkpoint=chunk['start'] + chunk['length'])
+        mode = self.hashlists[task['hashlistId']]['hashtypeId']
+        chunk_id = len(self.chunks) + 1
+        self.chunks[chunk_id] = {'chunkId': chunk_id, 'taskId': task['taskId'], 'agentId': agent['agentId'],
+                                 'start': int(task['searched']),
+                                 'length': int(self.agent_speed(agent, mode) * task['chunkTime']),
+                                 'dispatchTime': int(now), 'state': 2, 'progress': 0, 'cracked': 0}
+        agent['chunk'] = chunk_id
+
+    def chunk_json(self, chunk: dict):
+        """Running chunks progress with time while their agent keeps working on the task; progress is 0-10000."""
+        task = self.tasks[chunk['taskId']]
+        agent = self.agents.get(chunk['agentId'])
+        if chunk['state'] == 2 and agent and agent.get('chunk') == chunk['chunkId']:
+            chunk['progress'] = int(min(1.0, (time.time() - chunk['dispatchTime']) / task['chunkTime']) * 10000)
+            chunk['checkpoint'] = chunk['start'] + chunk['length'] * chunk['progress'] // 10000
+            chunk['lastActivity'] = int(time.time())
+        speed = self.agent_speed(agent, self.hashlists[task['hashlistId']]['hashtypeId']) if agent else 0
+        return {'checkpoint': chunk['start'], 'lastActivity': chunk['dispatchTime'], **chunk,
+                'speed': speed if chunk['state'] == 2 and agent and agent.get('chunk') == chunk['chunkId'] else 0}
+
+    def cracked(self, hashlist_id: int):
+        """Tasks crack --crack-rate hashes a second of each hashlist they work on, first lines first."""
+        hashlist = self.hashlists[hashlist_id]
+        if hashlist['format'] == 3:
+            return [c for part in hashlist['hashlists'] for c in self.cracked(part)]
+
+        started = [t['created'] for t in self.tasks.values() if (
+            t['hashlistId'] == hashlist_id or hashlist_id in self.hashlists[t['hashlistId']].get('hashlists', []))]
+        if not started:
+            return []
+        count = min(len(self.hashes[hashlist_id]), int((time.time() - min(started)) * self.args.crack_rate))
+        return [{'hash': h, 'plain': f'pw{hashlist_id}-{i}', 'crackpos': i}
+                for i, h in enumerate(self.hashes[hashlist_id][:count])]
+
+    # DNS
+
+    def resolve(self, name: str):
+        record = self.records.get(name.rstrip('.').lower())
+        if record and time.time() >= record['visible']:
+            return record['ip']
+        return None
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    cloud: Cloud = None
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status: int, body=None, content_type: str = 'application/json', headers: dict = None):
+        data = (json.dumps(body) if content_type == 'application/json' else body or '').encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}') if length else {}
+
+    def rate_limited(self, key: str):
+        limit = self.cloud.args.rate_limit
+        if not limit:
+            return None
+        with self.cloud.lock:
+            window_start, used = self.cloud.windows.get(key, (time.time(), 0))
+            if time.time() - window_start >= 60:
+                window_start, used = time.time(), 0
+            used += 1
+            self.cloud.windows[key] = (window_start, used)
+        reset = int(window_start + 60)
+        headers = {'X-RateLimit-Limit': limit, 'X-RateLimit-Remaining': max(0, limit - used),
+                   'X-RateLimit-Reset': reset}
+        if used > limit:
+            headers['Retry-After'] = max(1, reset - int(time.time()))
+            self.cloud.calls['429'] += 1
+        return headers
+
+    def handle_any(self, method: str):
+        url = urlsplit(self.path)
+        path = url.path.rstrip('/')
+        service = path.split('/')[1] if path.count('/') else ''
+        args = self.cloud.args
+        # read before any early answer, an unread body would be taken for the start of the next request
+        body = self.body() if method in ('POST', 'PUT') else {}
+
+        if service == '_fake':
+            return self.send(200, dict(self.cloud.calls)) if method == 'GET' else self.reset()
+
+        route = re.sub(r'/\d+(?=/|$)', '/{id}', path)
+        self.cloud.calls[f'{method} {route}'] += 1
+        self.cloud.calls[f'{service} total'] += 1
+        if args.latency:
+            time.sleep(random.uniform(0.5, 1.5) * args.latency)
+
+        headers = self.rate_limited(self.headers.get('Authorization', service)) if service == 'linode' else {}
+        if headers and 'Retry-After' in headers:
+            return self.send(429, {'errors': [{'reason': 'Too Many Requests'}]}, headers=headers)
+        if service in ('linode', 'godaddy') and random.random() < args.error_rate:
+            self.cloud.calls['injected errors'] += 1
+            return self.send(random.choice((500, 502, 503)), {'errors': [{'reason': 'Injected error'}]})
+
+        try:
+            with self.cloud.lock:
+                status, result = self.route(method, service, path, parse_qs(url.query), body)
+        except ApiError as e:
+            return self.send(e.status, e.body, headers=headers)
+
+        if isinstance(result, str):
+            return self.send(status, result, 'text/html', headers)
+        self.send(status, result, headers=headers)
+
+    def reset(self):
+        self.cloud.calls.clear()
+        self.send(200, {})
+
+    def paginate(self, items: list, query: dict):
+        x_filter = json.loads(self.headers.get('X-Filter') or '{}')
+        items = [i for i in items if matches(i, x_filter)]
+        if x_filter.get('+order_by'):
+            items.sort(key=lambda i: lookup(i, x_filter['+order_by']), reverse=x_filter.get('+order') == 'desc')
+        page = int(query.get('page', ['1'])[0])
+        page_size = int(query.get('page_size', ['100'])[0])
+        pages = max(1, -(-len(items) // page_size))
+        return 200, {'data': items[(page - 1) * page_size:page * page_size], 'page': page, 'pages': pages,
+                     'results': len(items)}
+
+    def route(self, method: str, service: str, path: str, query: dict, body: dict):
+        cloud = self.cloud
+        parts = path.split('/')[1:]
+
+        if service == 'ip':
+            return 200, self.client_address[0] + '\n'
+        if service == 'godaddy':
+            if method == 'PUT' and len(parts) == 7 and parts[2] == 'domains':
+                domain, name = parts[3], parts[6]
+                cloud.records[f'{name}.{domain}'.lower()] = {'ip': body[0]['data'],
+                                                             'visible': time.time() + cloud.args.dns_delay}
+                return 200, {}
+            raise ApiError(404, 'Not found')
+        if service == 'hashtopolis':
+            if not cloud.server_ready():
+                return 502, '<html><body>502 Bad Gateway</body></html>'
+            if path.endswith('/api/user.php') and method == 'POST':
+                return 200, cloud.hashtopolis(body)
+            return 200, '<html><body>Hashtopolis</body></html>'
+        if service != 'linode':
+            raise ApiError(404, 'Not found')
+
+        resource = '/'.join(re.sub(r'^\d+$', '{id}', p) for p in parts[2:])
+        ids = [int(p) for p in parts[2:] if p.isdigit()]
+
+        if resource == 'regions':
+            return self.paginate(REGIONS, query)
+        if resource == 'linode/types':
+            return self.paginate(TYPES, query)
+        if resource.startswith('linode/types/'):
+            found = next((t for t in TYPES if t['id'] == parts[4]), None)
+            if not found:
+                raise ApiError(404, 'Not found')
+            return 200, found
+        if resource == 'linode/stackscripts/{id}':
+            return 200, {'id': ids[0], 'label': f'stackscript {ids[0]}', 'updated': timestamp(0),
+                         'created': timestamp(0), 'images': ['linode/debian11'], 'is_public': True,
+                         'user_defined_fields': []}
+
+        if resource == 'linode/instances':
+            if method == 'POST':
+                return 200, cloud.create_instance(body)
+            return self.paginate([cloud.instance_json(i) for i in cloud.instances.values()], query)
+        if resource == 'linode/instances/{id}':
+            instance = cloud.instance(ids[0])
+            if method == 'DELETE':
+                cloud.add_event('linode_delete', instance, time.time())
+                del cloud.instances[ids[0]]
+                if instance['label'].endswith('server'):
+                    # Hashtopolis lives on the server, its agents, vouchers and tasks go with it
+                    cloud.agents.clear()
+                    cloud.vouchers.clear()
+                    cloud.hashlists.clear()
+                    cloud.tasks.clear()
+                    cloud.files.clear()
+                    cloud.hashes.clear()
+                    cloud.chunks.clear()
+                return 200, {}
+            if method == 'PUT':
+                instance['label'] = body.get('label', instance['label'])
+            return 200, cloud.instance_json(instance)
+        if resource in ('linode/instances/{id}/boot', 'linode/instances/{id}/reboot',
+                        'linode/instances/{id}/shutdown'):
+            instance = cloud.instance(ids[0])
+            action = parts[-1]
+            if action == 'shutdown':
+                cloud.set_phase(instance, 'shutting_down', cloud.args.shutdown_time, 'offline', 'linode_shutdown')
+            else:
+                cloud.set_phase(instance, 'booting' if action == 'boot' else 'rebooting', cloud.args.boot_time,
+                                'running', f'linode_{action}')
+            return 200, {}
+        if resource == 'linode/instances/{id}/configs':
+            return self.paginate(cloud.configs(cloud.instance(ids[0])), query)
+        if resource == 'linode/instances/{id}/configs/{id}/interfaces' and method == 'POST':
+            instance = cloud.instance(ids[0])
+            instance['vpc_id'], instance['subnet_id'], instance['vpc_ip'] = cloud.vpc_interface(body, instance['id'])
+            return 200, cloud.configs(instance)[0]['interfaces'][0]
+        if resource == 'linode/instances/{id}/disks':
+            instance = cloud.instance(ids[0])
+            return self.paginate([{'id': instance['id'] * 10, 'label': 'Debian 11 Disk', 'filesystem': 'ext4',
+                                   'size': 81408, 'status': 'ready'},
+                                  {'id': instance['id'] * 10 + 1, 'label': '512 MB Swap Image',
+                                   'filesystem': 'swap', 'size': 512, 'status': 'ready'}], query)
+
+        if resource == 'images':
+            if method == 'POST':
+                image_id = f'private/{next(cloud.ids)}'
+                cloud.images[image_id] = {'id': image_id, 'label': body['label'], 'is_public': False,
+                                          'status': 'available', 'description': body.get('description', ''),
+                                          'created': timestamp(time.time()), 'tags': body.get('tags', [])}
+                return 200, cloud.images[image_id]
+            return self.paginate(list(cloud.images.values()), query)
+        if resource.startswith('images/private/'):
+            image_id = '/'.join(parts[3:5])
+            if image_id not in cloud.images:
+                raise ApiError(404, 'Not found')
+            if method == 'DELETE':
+                return 200, cloud.images.pop(image_id)
+            return 200, cloud.images[image_id]
+
+        if resource == 'vpcs':
+            if method == 'POST':
+                return 200, cloud.create_vpc(body)
+            return self.paginate(list(cloud.vpcs.values()), query)
+        if resource.startswith('vpcs/{id}'):
+            if ids[0] not in cloud.vpcs:
+                raise ApiError(404, 'Not found')
+            vpc = cloud.vpcs[ids[0]]
+            if resource == 'vpcs/{id}/ips':
+                return self.paginate(cloud.vpc_ips(ids[0]), query)
+            if resource == 'vpcs/{id}/subnets':
+                return self.paginate(vpc['subnets'], query)
+            if resource == 'vpcs/{id}/subnets/{id}':
+                return 200, next(s for s in vpc['subnets'] if s['id'] == ids[1])
+            if method == 'DELETE':
+                if any(i['vpc_id'] == ids[0] for i in cloud.instances.values()):
+                    raise ApiError(400, 'Cannot delete a VPC while Linodes are attached')
+                return 200, cloud.vpcs.pop(ids[0])
+            return 200, vpc
+
+        if resource == 'networking/firewalls':
+            if method == 'POST':
+                return 200, cloud.create_firewall(body)
+            return self.paginate(list(cloud.firewalls.values()), query)
+        if resource.startswith('networking/firewalls/{id}'):
+            if ids[0] not in cloud.firewalls:
+                raise ApiError(404, 'Not found')
+            firewall = cloud.firewalls[ids[0]]
+            if resource.endswith('/rules'):
+                if method == 'PUT':
+                    firewall['rules'] = body
+                return 200, firewall['rules']
+            if method == 'DELETE':
+                return 200, cloud.firewalls.pop(ids[0])
+            return 200, firewall
+
+        if resource == 'account/events':
+            events = sorted(cloud.events.values(), key=lambda e: e['id'], reverse=True)
+            return self.paginate([cloud.event_json(e) for e in events], query)
+        if resource == 'account/events/{id}':
+            if ids[0] not in cloud.events:
+                raise ApiError(404, 'Not found')
+            return 200, cloud.event_json(cloud.events[ids[0]])
+
+        raise ApiError(404, f'{method} /{resource} is not emulated')
+
+    def do_GET(self):
+        self.handle_any('GET')
+
+    def do_POST(self):
+        self.handle_any('POST')
+
+    def do_PUT(self):
+        self.handle_any('PUT')
+
+    def do_DELETE(self):
+        self.handle_any('DELETE')
+
+
+def serve_dns(cloud: Cloud, host: str, port: int):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+    while True:
+        data, address = sock.recvfrom(4096)
+        try:
+            query = dns.message.from_wire(data)
+        except dns.exception.DNSException:
+            continue
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.AA
+        question = query.question[0]
+        with cloud.lock:
+            ip = cloud.resolve(question.name.to_text())
+        if ip and question.rdtype == dns.rdatatype.A:
+            response.answer.append(dns.rrset.from_text(question.name, 60, 'IN', 'A', ip))
+        elif not ip:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        sock.sendto(response.to_wire(), address)
+
+
+def load_queue(filename: str):
+    with open(filename) as file:
+        return json.load(file)
+
+
+def region_capacity(value: str):
+    region, _, amount = value.partition('=')
+    return region, int(amount)
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser(prog='fakecloud', description='Local Linode/GoDaddy/Hashtopolis stand-in')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8700)
+    parser.add_argument('--latency', type=float, default=0.0, help='mean seconds added to every request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of Linode/GoDaddy calls failing 5xx')
+    parser.add_argument('--rate-limit', type=int, default=0, help='Linode requests per minute, 0 for none')
+    parser.add_argument('--provision-time', type=float, default=1.0)
+    parser.add_argument('--boot-time', type=float, default=2.0)
+    parser.add_argument('--shutdown-time', type=float, default=1.0)
+    parser.add_argument('--install-time', type=float, default=3.0, help='server StackScript run time')
+    parser.add_argument('--agent-install-time', type=float, default=3.0, help='agent StackScript run time')
+    parser.add_argument('--image-install-time', type=float, default=1.0, help='golden image first boot time')
+    parser.add_argument('--agent-failure-rate', type=float, default=0.0,
+                        help='share of agent installs that fail and never register')
+    parser.add_argument('--region-capacity', type=region_capacity, action='append', default=[],
+                        help='REGION=N, instances a region takes before creates fail for lack of capacity')
+    parser.add_argument('--task-keyspace', type=float, default=1e13, help='keyspace of tasks made with createTask')
+    parser.add_argument('--queue', type=load_queue, default=[],
+                        help='JSON file of jobs to replay, [{"at": seconds, "name": ..., "mode": ..., "keyspace": ...,'
+                             ' "priority": ...}]')
+    parser.add_argument('--crack-rate', type=float, default=50.0, help='hashes cracked a second per hashlist')
+    parser.add_argument('--dns-delay', type=float, default=1.0, help='seconds until a new A record resolves')
+
+    args = parser.parse_args(argv)
+    args.region_capacity = dict(args.region_capacity)
+    return args
+
+
+def main(argv: list = None):
+    args = parse_args(argv)
+    cloud = Cloud(args)
+    Handler.cloud = cloud
+
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=serve_dns, args=(cloud, args.host, args.port), daemon=True).start()
+    print(f'# fakecloud listening on http://{args.host}:{args.port} (DNS on udp/{args.port})', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
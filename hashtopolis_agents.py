@@ -1,85 +1,771 @@
-import random
+import secrets
+import sqlite3
 import string
 import sys
+import threading
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import linode_api4
 import requests
 from linode_api4 import LinodeClient, StackScript
 
+import http_client
+import images
+import inventory
+import ipam
+import misc
 import network
+import readiness
+import speeds
+import state
+import teardown
+import tracing
+from journal import Journal
 
+# how long listAgents is retried while the server can't be reached, unless the caller has a deadline of its own
+LIST_AGENTS_RETRY = 300
+# statuses of instances boot_agents boots, waiting up to PROVISION_TIMEOUT for provisioning ones
+BOOTABLE = ('offline', 'provisioning')
+PROVISION_TIMEOUT = 600
 
-def deploy_linodes(config: dict, client: LinodeClient, region: str, firewall_id: str, type_id: str, amount: int, vpc_addresses: list):
+
+@tracing.traced()
+def deploy_linodes(config: dict, client: LinodeClient, region: str, firewall_id: str, type_id: str, amount: int, vpc: dict,
+                   vpc_addresses: list, labels: list = None, journal: Journal = None, prompt: bool = True):
     print('Deploying Linodes')
-    while get_agents(config['settings']['domain'], config['keys']['hashtopolis']) == 0:
+    journal = journal or Journal()
+    ensure_api_key(config, prompt)
+
+    parallelism = int(config['settings'].get('parallelism', 8))
+    vouchers = journal.get('agents.vouchers')
+    if vouchers is None:
+        try:
+            vouchers = get_x_vouchers(amount, config['settings']['domain'], config['keys']['hashtopolis'],
+                                      parallelism)
+        except RuntimeError as e:
+            print(f'# {e}')
+            sys.exit(1)
+        journal.record('agents.vouchers', vouchers)
+    print(f'# Deploying {amount} agents, {parallelism} at a time')
+    if labels is None:
+        labels = [config['settings']['cluster_prefix'] + f'agent_{counter:02}' for counter in range(1, amount + 1)]
+
+    failed = {}
+    created = {}
+    jobs = list(zip(labels, vouchers, vpc_addresses[1:]))
+    fanout = Fanout(config, client, region, vpc, firewall_id, type_id, vpc_addresses, journal=journal)
+    if str(config['settings'].get('golden_image', 0)) == '1':
+        fanout.image_id = images.find_agent_image(config, client)
+        if fanout.image_id:
+            print(f'# Using agent image {fanout.image_id}')
+        elif len(jobs) > 1 and not journal.done(f'agents.{jobs[0][0]}'):
+            # the image is built in the server's region, spill-over applies to the agents made from it
+            linode_label, voucher, vpc_ip = jobs.pop(0)
+            try:
+                agent = provision_agent(config, client, region, firewall_id, type_id, linode_label, voucher, vpc,
+                                        vpc_addresses[0], vpc_ip)
+                journal.record(f'agents.{linode_label}', agent.id, ('instances', agent.id))
+                fanout.adopt(linode_label, region, vpc_ip)
+                created[linode_label] = agent
+                fanout.image_id = images.capture_agent_image(config, client, agent, vpc_ip)
+                print(f'# {linode_label} done')
+            except Exception as e:
+                failed[linode_label] = e
+                print(f'# {linode_label} failed: {e}')
+
+    more_created, create_failed = create_agents(config, client, fanout, jobs, journal=journal)
+    created.update(more_created)
+    failed.update(create_failed)
+    report_failed(failed, amount)
+
+    vouchers = dict(zip(labels, vouchers))
+    return_vouchers(config['settings']['domain'], [vouchers[linode_label] for linode_label in failed])
+    failed.update(wait_for_registration(config, client, {
+        linode_label: fanout.entry(linode_label, agent, vouchers[linode_label])
+        for linode_label, agent in created.items()
+    }, fanout))
+    record_speeds(config, client)
+
+    reserve_size = int(config['settings'].get('voucher_reserve', 0))
+    if reserve_size:
+        fill_voucher_reserve(reserve_size, config['settings']['domain'], config['keys']['hashtopolis'], parallelism)
+
+    return failed
+
+
+def ensure_api_key(config: dict, prompt: bool = True):
+    """Wait for a valid Hashtopolis API key; without prompt, an invalid one raises RuntimeError.
+
+    A server that stays unreachable for agent_registration_timeout seconds raises the connection error.
+    """
+    retry_for = int(config['settings'].get('agent_registration_timeout', 1200))
+    while get_agents(config['settings']['domain'], config['keys']['hashtopolis'], retry_for) == 0:
+        if not prompt:
+            raise RuntimeError('the Hashtopolis API key in the config file is not accepted')
         input('# Update your Hashtopolis API key in config file and hit enter')
 
+
+@tracing.traced()
+def create_agents(config: dict, client: LinodeClient, fanout: 'Fanout', jobs: list, boot: bool = True,
+                  journal: Journal = None):
+    """Provision (label, voucher, vpc_ip) jobs concurrently; returns created instances and failures by label.
+
+    Agents already in the journal are reused, and booted again if boot is set and they are still offline.
+    """
+    parallelism = int(config['settings'].get('parallelism', 8))
+    journal = journal or Journal()
+    created, failed = {}, {}
+
+    for linode_label, _, vpc_ip in jobs:
+        if journal.done(f'agents.{linode_label}'):
+            created[linode_label] = linode_api4.Instance(client, journal.get(f'agents.{linode_label}'))
+            fanout.adopt(linode_label, *journal.get(f'placements.{linode_label}', (fanout.region, vpc_ip)))
+            print(f'# {linode_label} already created, resuming')
+    if boot:
+        offline = {label: a for label, a in created.items() if a.status in BOOTABLE}
+        fanout.hold(offline)
+        failed.update(boot_agents(config, {label: a for label, a in offline.items() if label not in fanout.unbooted}))
+        for linode_label in failed:
+            created.pop(linode_label)
+
+    with ThreadPoolExecutor(max_workers=max(1, parallelism)) as executor:
+        futures = {}
+        for linode_label, voucher, vpc_ip in jobs:
+            if journal.done(f'agents.{linode_label}'):
+                continue
+            futures[executor.submit(fanout.provision, linode_label, voucher, vpc_ip, boot=boot)] = linode_label
+
+        for done, future in enumerate(as_completed(futures), start=1):
+            linode_label = futures[future]
+            try:
+                created[linode_label] = future.result()
+                print(f'# {linode_label} done ({done}/{len(jobs)})')
+            except Exception as e:
+                failed[linode_label] = e
+                print(f'# {linode_label} failed ({done}/{len(jobs)}): {e}')
+
+    boot_failed = fanout.finish()
+    failed.update(boot_failed)
+    for linode_label in boot_failed:
+        created.pop(linode_label, None)
+
+    return created, failed
+
+
+class Fanout:
+    """Places agents in the server's region, then in agent_regions in order when a region has no capacity left.
+
+    Agents outside the server's region get a VPC of their own region, connect to the server's public HTTPS
+    endpoint, and are let through the server firewall by their public IP before they boot. agents_per_region,
+    when set, caps every region so agents spread over the list instead of waiting for capacity errors.
+    """
+
+    def __init__(self, config: dict, client: LinodeClient, region: str, vpc: dict, firewall_id: str, type_id: str,
+                 vpc_addresses: list, image_id: str = None, vpc_subnet: str = None, journal: Journal = None):
+        self.config = config
+        self.client = client
+        self.region = region
+        self.regions = list(dict.fromkeys([region] + list(config['settings'].get('agent_regions') or [])))
+        self.limit = int(config['settings'].get('agents_per_region', 0))
+        self.firewall_id = firewall_id
+        self.type_id = type_id
+        self.server_vpc_ip = vpc_addresses[0]
+        self.image_id = image_id
+        self.vpc_subnet = vpc_subnet
+        self.journal = journal or Journal()
+        self.vpcs = {region: vpc}
+        self.used = {}
+        self.full = set()
+        self.counts = None
+        self.placed = {}
+        self.unbooted = {}
+        self.lock = threading.Lock()
+        self.vpc_lock = threading.Lock()
+        self.finish_lock = threading.Lock()
+
+    def subnet(self):
+        if not self.vpc_subnet:
+            inv = inventory.get(self.config, self.client)
+            self.vpc_subnet = inv['vpcs']['by_id'][self.vpcs[self.region]['vpc']['id']]['subnets'][0]['ipv4']
+        return self.vpc_subnet
+
+    def vpc(self, region: str):
+        """The VPC agents in region join, created with the cluster's subnet the first time it is needed."""
+        with self.vpc_lock:
+            if region not in self.vpcs:
+                label = inventory.vpc_label(self.config['settings']['cluster_prefix'], region)
+                vpc = network.get_vpc_info(self.config, self.client, label, refresh=True)
+                if 'subnet' not in vpc:
+                    print(f'# Setting up VPC network in {region}')
+                    vpc = network.build_vpc(self.config, self.client, region, self.subnet(), label)
+                self.journal.record(f'vpcs.{region}', vpc['vpc']['id'], ('vpcs', vpc['vpc']['id']))
+                self.vpcs[region] = vpc
+            return self.vpcs[region]
+
+    def address(self, region: str, linode_label: str):
+        vpc_id = self.vpc(region)['vpc']['id']
+        with self.lock:
+            if region not in self.used:
+                # ipam records what this process hands out, so the addresses in use are only read once
+                self.used[region] = network.get_used_vpc_addresses(self.client, vpc_id)
+        return ipam.allocate(self.config, self.client, vpc_id, self.subnet(), [linode_label], self.used[region])[0]
+
+    def reserve(self, region: str):
+        with self.lock:
+            if region in self.full:
+                return False
+            if self.limit:
+                if self.counts is None:
+                    self.counts = Counter(a['region'] for a in inventory.agents(
+                        self.config, inventory.get(self.config, self.client)).values())
+                if self.counts[region] >= self.limit:
+                    return False
+                self.counts[region] += 1
+            return True
+
+    def release(self, region: str, full: bool = False):
+        with self.lock:
+            if self.limit and self.counts is not None:
+                self.counts[region] -= 1
+            if full and region not in self.full:
+                self.full.add(region)
+                print(f' ! {region} has no capacity left for {self.type_id}, spilling over to the next region')
+
+    def adopt(self, linode_label: str, region: str, vpc_ip: str):
+        with self.lock:
+            self.placed[linode_label] = (region, vpc_ip)
+
+    def hold(self, agents: dict):
+        """Keep out-of-region agents from booting until finish() opened the server firewall for them."""
+        with self.lock:
+            self.unbooted.update({label: a for label, a in agents.items()
+                                  if self.placed.get(label, (self.region,))[0] != self.region})
+
+    def provision(self, linode_label: str, voucher: str, vpc_ip: str = None, ip_region: str = None,
+                  boot: bool = True):
+        """Create the agent in the first region with room; vpc_ip is kept if it lands in ip_region."""
+        preferred = {ip_region or self.region: vpc_ip} if vpc_ip else {}
+        if linode_label in self.placed:
+            # a replaced agent frees its slot
+            self.release(self.placed[linode_label][0])
+
+        for region in self.regions:
+            if not self.reserve(region):
+                continue
+            try:
+                address = preferred.get(region) or self.address(region, linode_label)
+                server_url = None if region == self.region else http_client.hashtopolis_url(
+                    self.config['settings']['domain'])
+                agent = provision_agent(self.config, self.client, region, self.firewall_id, self.type_id,
+                                        linode_label, voucher, self.vpc(region), self.server_vpc_ip, address,
+                                        self.image_id, boot=False, server_url=server_url)
+            except Exception as e:
+                if not network.is_capacity_error(e):
+                    self.release(region)
+                    raise
+                self.release(region, full=True)
+                if region != self.region:
+                    ipam.release([linode_label], self.vpc(region)['vpc']['id'])
+                continue
+
+            if region != self.region:
+                ipam.release([linode_label], self.vpcs[self.region]['vpc']['id'])
+            self.adopt(linode_label, region, address)
+            self.journal.record(f'agents.{linode_label}', agent.id, ('instances', agent.id))
+            self.journal.record(f'placements.{linode_label}', [region, address])
+            if boot:
+                self.hold({linode_label: agent})
+                if region == self.region:
+                    agent.boot()
+                    print(f' - {linode_label} booted')
+            return agent
+
+        raise RuntimeError(f'no capacity for {self.type_id} in {", ".join(self.regions)}')
+
+    def finish(self):
+        """Open the server firewall to the held back agents and boot them; returns the ones that failed to boot."""
+        # one at a time, a firewall update made from an older inventory must not land last
+        with self.finish_lock:
+            with self.lock:
+                agents, self.unbooted = self.unbooted, {}
+            if not agents:
+                return {}
+            open_server_firewall(self.config, self.client, self.region)
+            return boot_agents(self.config, agents)
+
+    def entry(self, linode_label: str, agent, voucher: str):
+        region, vpc_ip = self.placed.get(linode_label, (self.region, None))
+        return registration_entry(agent, voucher, region, vpc_ip, self.region)
+
+
+def registration_entry(agent, voucher: str, region: str, vpc_ip: str, server_region: str):
+    """What wait_for_registration tracks of an agent; 'address' is the IP it reaches the server from."""
+    return {
+        'id': agent.id,
+        'voucher': voucher,
+        'region': region,
+        'vpc_ip': vpc_ip,
+        'address': vpc_ip if region == server_region else agent.ipv4[0]
+    }
+
+
+def open_server_firewall(config: dict, client: LinodeClient, server_region: str = None):
+    """Allow every agent and pool member outside the server's region through the server firewall.
+
+    The rules are rebuilt from the running instances, so calling it after a teardown drops the removed ones.
+    """
+    cluster_prefix = config['settings']['cluster_prefix']
+    firewall_id = network.firewall_exists(client, cluster_prefix + 'server_firewall')
+    if not firewall_id:
+        return
+    inv = inventory.get(config, client, refresh=True)
+    if server_region is None:
+        server = inventory.server(config, inv)
+        if not server:
+            return
+        server_region = server['region']
+    members = list(inventory.agents(config, inv).values()) + list(inventory.pool(config, inv).values())
+    network.set_remote_agent_rules(client.token, firewall_id,
+                                   sorted({i['ipv4'][0] for i in members if i['region'] != server_region and i['ipv4']}))
+
+
+@tracing.traced()
+def boot_agents(config: dict, agents: dict):
+    """Boot the agents, waiting for the ones still provisioning; returns the ones that failed by label."""
+    parallelism = int(config['settings'].get('parallelism', 8))
+    failed = {}
+
+    def boot(linode_label):
+        agent = agents[linode_label]
+        try:
+            if agent.status == 'provisioning':
+                # a resumed deploy boots agents straight after creating them, before Linode is done with them
+                readiness.wait_for(f'{linode_label} offline', readiness.instance_status(agent, 'offline'),
+                                   readiness.Deadline(PROVISION_TIMEOUT))
+            agent.boot()
+            print(f' - {linode_label} booted')
+        except Exception as e:
+            failed[linode_label] = e
+
+    with ThreadPoolExecutor(max_workers=max(1, parallelism)) as executor:
+        list(executor.map(boot, agents))
+
+    return failed
+
+
+def report_failed(failed: dict, amount: int):
+    if failed:
+        print(f'# {len(failed)} of {amount} agents failed to deploy:')
+        for linode_label, error in failed.items():
+            print(f' ! {linode_label}: {error}')
+
+
+def diagnose(client: LinodeClient, entry: dict, vouchers: set = None):
+    """Why an agent did not register, from its instance status and whether its voucher was redeemed."""
+    try:
+        status = linode_api4.Instance(client, entry['id']).status
+    except Exception as e:
+        return f'instance not found ({e})'
+    if status != 'running':
+        return f'instance {status}'
+    if vouchers is None:
+        return 'not registered'
+    if entry['voucher'] in vouchers:
+        return 'voucher never redeemed, the install failed or could not reach the server'
+    return f'voucher redeemed, but no agent connects from {entry["address"]}'
+
+
+def replace_agent(config: dict, client: LinodeClient, linode_label: str, entry: dict, fanout: Fanout):
+    """Delete the agent's Linode and provision it again under the same label, in its region and VPC address if
+    that region still has room."""
+    domain, token = config['settings']['domain'], config['keys']['hashtopolis']
+    teardown.delete_ignoring_missing(misc.delete_linode, client.token, entry['id'])
+    readiness.wait_for(f'{linode_label} deleted',
+                       lambda: not inventory.linode_list(client.token, 'linode/instances', {'label': linode_label}),
+                       readiness.Deadline(int(config['settings'].get('teardown_timeout', 600))), max_interval=10)
+
+    # an unredeemed voucher can be used again, one redeemed by a broken install can't
+    voucher = entry['voucher'] if entry['voucher'] in list_vouchers(domain, token) else create_voucher(domain, token)
+    if not voucher:
+        raise RuntimeError('can\'t create a voucher')
+
+    agent = fanout.provision(linode_label, voucher, entry['vpc_ip'], entry['region'])
+    error = fanout.finish().get(linode_label)
+    if error:
+        raise error
+    return fanout.entry(linode_label, agent, voucher)
+
+
+def report_registration(total: int, registered: dict, replaced: dict, failed: dict):
+    print(f'# {len(registered)}/{total} agents registered, '
+          f'{sum(len(reasons) for reasons in replaced.values())} replaced')
+    for linode_label, reasons in sorted(replaced.items()):
+        print(f' - {linode_label} replaced: {"; ".join(reasons)}')
+    for linode_label, reason in sorted(failed.items()):
+        print(f' ! {linode_label} not registered: {reason}')
+
+
+@tracing.traced('wait')
+def wait_for_registration(config: dict, client: LinodeClient, agents: dict, fanout: Fanout):
+    """Wait for agents ({label: registration_entry}) to register; returns the ones that never did.
+
+    Every agent gets agent_registration_timeout seconds. One that misses it is deleted and created again through
+    fanout, while the deploy has agent_replacements left.
+    """
+    domain, token = config['settings']['domain'], config['keys']['hashtopolis']
+    parallelism = int(config['settings'].get('parallelism', 8))
+    timeout = int(config['settings'].get('agent_registration_timeout', 1200))
+    budget = int(config['settings'].get('agent_replacements', 3))
+
+    pending = {label: {**entry, 'deadline': readiness.Deadline(timeout)} for label, entry in agents.items()}
+    registered, replaced, failed, seen = {}, {}, {}, set()
+    print(f'# Waiting for {len(pending)} agents to register, {timeout} s each, {budget} replacements allowed')
+    start_time = time.time()
+
+    while pending:
+        try:
+            matched = match_agents(domain, token, {e['id']: {e['address']} for e in pending.values()}, seen,
+                                   retry_for=max(e['deadline'].remaining() for e in pending.values()))
+        except (requests.exceptions.RequestException, RuntimeError):
+            matched = {}
+        for label in [label for label, entry in pending.items() if entry['id'] in matched]:
+            registered[label] = matched[pending.pop(label)['id']]['agentId']
+
+        expired = [label for label, entry in pending.items() if entry['deadline'].expired()]
+        if expired:
+            try:
+                vouchers = list_vouchers(domain, token)
+            except (requests.exceptions.RequestException, RuntimeError):
+                vouchers = None
+            replacements = {}
+            print()
+            for label in expired:
+                entry = pending.pop(label)
+                reason = f'{diagnose(client, entry, vouchers)} after {timeout} s'
+                print(f' ! {label}: {reason}')
+                if budget > 0:
+                    budget -= 1
+                    replaced.setdefault(label, []).append(reason)
+                    replacements[label] = entry
+                else:
+                    failed[label] = reason
+
+            def replace(label):
+                try:
+                    return replace_agent(config, client, label, replacements[label], fanout), None
+                except Exception as e:
+                    return None, e
+
+            with ThreadPoolExecutor(max_workers=max(1, min(parallelism, len(replacements)))) as executor:
+                for label, (entry, error) in zip(replacements, executor.map(replace, replacements)):
+                    if error:
+                        failed[label] = f'{replaced[label][-1]}, replacement failed: {error}'
+                    else:
+                        pending[label] = {**entry, 'deadline': readiness.Deadline(timeout)}
+                        print(f' - {label} replaced')
+
+        if pending:
+            print(f'\r - {len(registered)}/{len(agents)} registered, elapsed {int(time.time() - start_time)} seconds',
+                  end='', flush=True)
+            tracing.sleep(10, 'poll agent registration')
+
+    print()
+    report_registration(len(agents), registered, replaced, failed)
+    return failed
+
+
+def provision_agent(config: dict, client: LinodeClient, region: str, firewall_id: str, type_id: str, linode_label: str,
+                    voucher: str, vpc: dict, server_vpc_ip: str, vpc_ip: str, image_id: str = None, boot: bool = True,
+                    server_url: str = None):
+    """Create an agent in the VPC; one outside the server's region reaches it at server_url instead."""
     linode_image = 'linode/debian11'
-    counter = 0
-    for voucher in get_x_vouchers(amount, config['settings']['domain'], config['keys']['hashtopolis']):
-        counter += 1
-        linode_label = config['settings']['cluster_prefix'] + f'agent_{counter:02}'
-        print(f'# Deploying {linode_label}...')
-        agent, _ = client.linode.instance_create(
-            type_id,
-            region,
-            image=linode_image,
-            label=linode_label,
-            firewall=firewall_id,
-            booted=False,
-            stackscript=StackScript(client, int(config['stackscripts']['agent'])),
-            stackscript_data={
+    if server_url:
+        download_url, api_url = f'{server_url}/agents.php?download=1', f'{server_url}/api/server.php'
+    else:
+        download_url, api_url = (f'https://{server_vpc_ip}/agents.php?download=1',
+                                 f'http://{server_vpc_ip}:8080/api/server.php')
+
+    if image_id:
+        first_boot = {
+            'image': image_id,
+            'metadata': client.linode.build_instance_metadata(
+                user_data=images.first_boot_user_data(config, voucher, api_url)
+            )
+        }
+    else:
+        first_boot = {
+            'image': linode_image,
+            'stackscript': StackScript(client, int(config['stackscripts']['agent'])),
+            'stackscript_data': {
                 'VOUCHER': voucher,
-                'DOWNLOAD_URL': f'https://{vpc_addresses[0]}/agents.php?download=1',
-                'API_URL': f'http://{vpc_addresses[0]}:8080/api/server.php'
+                'DOWNLOAD_URL': download_url,
+                'API_URL': api_url
             }
-        )
+        }
 
-        network.add_to_vpc_subnet(config, client, agent.id, vpc_addresses[counter])
+    print(f'# Deploying {linode_label}...')
+    agent, _ = network.create_instance_in_vpc(
+        config,
+        client,
+        vpc,
+        vpc_ip,
+        type_id,
+        region,
+        label=linode_label,
+        firewall=firewall_id,
+        booted=False,
+        **first_boot
+    )
+    print(f' - {linode_label} created')
+
+    if boot:
         agent.boot()
-        print(f'# {linode_label} done')
+        print(f' - {linode_label} booted')
+
+    return agent
+
+
+def user_api(domain: str, token: str, section: str, request: str, **params):
+    url = f'{http_client.hashtopolis_url(domain)}/api/user.php'
+    payload = {
+        'section': section,
+        'request': request,
+        'accessKey': token,
+        **params
+    }
+
+    # every request is a POST, only the reads are safe to send twice
+    return http_client.post(url, json=payload, idempotent=request.startswith(('list', 'get'))).json()
 
-    print('# Waiting for Linodes to synchronize with the server...')
-    start_time = time.time()
-    while True:
-        if len(get_agents(config['settings']['domain'], config['keys']['hashtopolis'])) == amount:
-            print('\n - synchronized')
-            break
-        else:
-            print(f'\r - elapsed {int(time.time() - start_time)} seconds', end='', flush=True)
-            time.sleep(10)
-
-
-def get_x_vouchers(x: int, domain: str, token: str):
-    url = f'https://{domain}/api/user.php'
-    vouchers = []
-
-    for i in range(x):
-        voucher = ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(16))
-        payload = {
-            'section': 'agent',
-            'request': 'createVoucher',
-            'voucher': voucher,
-            'accessKey': token
-        }
 
+def generate_voucher(length: int = 16):
+    return ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(length))
+
+
+def create_voucher(domain: str, token: str, voucher: str = None, attempts: int = 3):
+    for _ in range(attempts):
+        candidate = voucher or generate_voucher()
         try:
-            response = requests.post(url, json=payload).json()
-        except requests.exceptions.ConnectionError:
-            print(f'# Incorrect domain {domain}')
-            sys.exit(1)
+            if user_api(domain, token, 'agent', 'createVoucher', voucher=candidate).get('response') == 'OK':
+                return candidate
+        except requests.exceptions.RequestException:
+            continue
 
-        if response.get('response') == 'OK':
-            vouchers.append(voucher)
-        else:
-            print('# Can\'t get hashtopolis vouchers')
-            sys.exit(1)
+    return None
+
+
+def list_vouchers(domain: str, token: str):
+    response = user_api(domain, token, 'agent', 'listVouchers')
+    if response.get('response') != 'OK':
+        raise RuntimeError(response.get('message', 'listVouchers failed'))
+
+    return set(response['vouchers'])
+
+
+@tracing.traced()
+def mint_vouchers(x: int, domain: str, token: str, parallelism: int = 8):
+    if x <= 0:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(parallelism, x)) as executor:
+        vouchers = list(executor.map(lambda _: create_voucher(domain, token), range(x)))
+
+    return [v for v in vouchers if v]
+
+
+@tracing.traced()
+def register_vouchers(vouchers: list, domain: str, token: str, parallelism: int = 8):
+    """Register vouchers generated up front, e.g. already baked into StackScript data."""
+    existing = list_vouchers(domain, token)
+    missing = [v for v in vouchers if v not in existing]
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(parallelism, len(missing))) as executor:
+            list(executor.map(lambda v: create_voucher(domain, token, v), missing))
+        existing = list_vouchers(domain, token)
+
+    return [v for v in vouchers if v in existing]
+
+
+def reserve_name(domain: str):
+    return f'vouchers-{domain}.json'
+
+
+def take_reserved_vouchers(x: int, domain: str, existing: set):
+    """Take vouchers out of the reserve so parallel deploys don't share them; put back what goes unused."""
+    reserve = [v for v in state.load(reserve_name(domain), []) if v in existing]
+    state.save(reserve_name(domain), reserve[x:])
+
+    return reserve[:x]
+
+
+def return_vouchers(domain: str, vouchers: list):
+    """Put unused vouchers (back) in the reserve; ones redeemed meanwhile are dropped when it is next read."""
+    if vouchers:
+        reserve = state.load(reserve_name(domain), [])
+        state.save(reserve_name(domain), reserve + [v for v in vouchers if v not in reserve])
+
+
+def fill_voucher_reserve(size: int, domain: str, token: str, parallelism: int = 8):
+    existing = list_vouchers(domain, token)
+    reserve = [v for v in state.load(reserve_name(domain), []) if v in existing]
+    reserve += mint_vouchers(size - len(reserve), domain, token, parallelism)
+    state.save(reserve_name(domain), reserve)
+    print(f'# Voucher reserve: {len(reserve)}/{size}')
+
+    return reserve
+
+
+def get_x_vouchers(x: int, domain: str, token: str, parallelism: int = 8, attempts: int = 3):
+    """x vouchers from the reserve or freshly minted; raises RuntimeError when Hashtopolis won't give them."""
+    try:
+        existing = list_vouchers(domain, token)
+    except (requests.exceptions.RequestException, RuntimeError):
+        raise RuntimeError(f'Incorrect domain {domain}') from None
+
+    vouchers = take_reserved_vouchers(x, domain, existing)
+    if vouchers:
+        print(f' - {len(vouchers)} vouchers taken from the reserve')
+
+    for _ in range(attempts):
+        vouchers += mint_vouchers(x - len(vouchers), domain, token, parallelism)
+        try:
+            existing = list_vouchers(domain, token)
+        except (requests.exceptions.RequestException, RuntimeError):
+            continue
+        vouchers = [v for v in vouchers if v in existing]
+        if len(vouchers) == x:
+            return vouchers
+
+    return_vouchers(domain, vouchers)
+    raise RuntimeError('Can\'t get hashtopolis vouchers')
+
+
+def get_agent(domain: str, token: str, agent_id: int):
+    response = user_api(domain, token, 'agent', 'get', agentId=agent_id)
+    if response.get('response') != 'OK':
+        raise RuntimeError(response.get('message', f'can\'t get agent {agent_id}'))
+
+    return response
+
+
+def set_agent_active(domain: str, token: str, agent_id: int, active: bool):
+    return user_api(domain, token, 'agent', 'setActive', agentId=agent_id, active=active).get('response') == 'OK'
+
+
+def delete_agent(domain: str, token: str, agent_id: int):
+    return user_api(domain, token, 'agent', 'delete', agentId=agent_id).get('response') == 'OK'
+
+
+def instance_ips(instances: dict, vpc_addresses: dict):
+    ips = {linode_id: set(instance['ipv4']) for linode_id, instance in instances.items()}
+    for address, linode_id in vpc_addresses.items():
+        if linode_id in ips:
+            ips[linode_id].add(address)
+
+    return ips
+
+
+def match_agents(domain: str, token: str, instance_ips: dict, seen: set = None,
+                 retry_for: float = LIST_AGENTS_RETRY):
+    """Map Linode IDs to Hashtopolis agent IDs using the IP each agent last connected from.
+
+    Agents in seen are not looked at again, and every agent looked at is added to it; repeated polls then only
+    fetch the details of newly registered agents.
+    """
+    agents = [a for a in get_agents(domain, token, retry_for) or [] if seen is None or a['agentId'] not in seen]
+    ip_to_linode = {ip: linode_id for linode_id, ips in instance_ips.items() for ip in ips}
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        details = list(executor.map(lambda a: get_agent(domain, token, a['agentId']), agents))
+
+    if seen is not None:
+        seen.update(a['agentId'] for a in agents)
+    matched = {}
+    for agent, detail in zip(agents, details):
+        linode_id = ip_to_linode.get(detail.get('lastActivity', {}).get('ip'))
+        if linode_id:
+            matched[linode_id] = {'agentId': agent['agentId'], **detail}
+
+    return matched
+
+
+def task_speeds(domain: str, token: str):
+    """Current speed of every agent working on an unfinished task, with the task's hash mode."""
+    response = user_api(domain, token, 'task', 'listTasks')
+    if response.get('response') != 'OK':
+        raise RuntimeError(response.get('message', 'listTasks failed'))
+
+    modes, samples = {}, []
+    # supertasks (type 1) show up again as their subtasks
+    for task in [t for t in response['tasks'] if t.get('type', 0) == 0]:
+        detail = user_api(domain, token, 'task', 'getTask', taskId=task['taskId'])
+        if detail.get('response') != 'OK' or detail.get('isComplete'):
+            continue
+        hashlist_id = detail['hashlistId']
+        if hashlist_id not in modes:
+            modes[hashlist_id] = user_api(domain, token, 'hashlist', 'getHashlist',
+                                          hashlistId=hashlist_id).get('hashtypeId')
+        for agent in detail.get('agents', []):
+            if modes[hashlist_id] is not None and float(agent.get('speed') or 0) > 0:
+                samples.append({'agent_id': agent['agentId'], 'hash_mode': modes[hashlist_id],
+                                'task_id': task['taskId'], 'speed': float(agent['speed']),
+                                'benchmark': str(agent.get('benchmark', ''))})
+
+    return samples
+
+
+@tracing.traced()
+def collect_speeds(config: dict, client: LinodeClient):
+    """Store the devices and task speeds of every agent, keyed by its Linode type and region."""
+    domain, token = config['settings']['domain'], config['keys']['hashtopolis']
+    agents = inventory.agents(config, inventory.get(config, client, refresh=True))
+    vpc = network.get_vpc_info(config, client)
+    vpc_addresses = network.get_vpc_address_map(client, vpc['vpc']['id']) if vpc else {}
+    matched = match_agents(domain, token, instance_ips(agents, vpc_addresses))
+
+    linodes = {}
+    for linode_id, agent in matched.items():
+        linodes[agent['agentId']] = {
+            'linode_id': linode_id,
+            'label': agents[linode_id]['label'],
+            'linode_type': agents[linode_id]['type'],
+            'region': agents[linode_id]['region'],
+            'agent_id': agent['agentId']
+        }
+    samples = [{**linodes[s['agent_id']], **s} for s in task_speeds(domain, token) if s['agent_id'] in linodes]
+
+    speeds.store([{**linodes[a['agentId']], 'devices': ', '.join(a.get('devices') or []),
+                   'cpu_only': int(bool(a.get('isCpuOnly')))} for a in matched.values()], samples)
+    print(f'# Recorded devices of {len(matched)} agents and {len(samples)} speed samples')
+
+    return samples
+
+
+def record_speeds(config: dict, client: LinodeClient):
+    """collect_speeds() after agents synchronized; a failure here must not fail the deploy."""
+    if str(config['settings'].get('collect_speeds', 1)) != '1':
+        return
+    try:
+        collect_speeds(config, client)
+    except (requests.exceptions.RequestException, RuntimeError, KeyError, sqlite3.Error) as e:
+        print(f' ! agent speeds not recorded: {e}')
+
+
+def wait_until_registered(config: dict, agent, vpc_ip: str, deadline):
+    def registered():
+        return match_agents(config['settings']['domain'], config['keys']['hashtopolis'], {agent.id: {vpc_ip}},
+                            retry_for=deadline.remaining())
 
-    return vouchers
+    return readiness.wait_for(f'{agent.label} registered', registered, deadline, interval=10, max_interval=30)
 
 
-def get_agents(domain: str, token: str):
-    url = f'https://{domain}/api/user.php'
+def get_agents(domain: str, token: str, retry_for: float = LIST_AGENTS_RETRY):
+    """listAgents, retrying connection errors for retry_for seconds; None retries for as long as it takes."""
+    start_time = time.monotonic()
+    url = f'{http_client.hashtopolis_url(domain)}/api/user.php'
     payload = {
         "section": "agent",
         "request": "listAgents",
@@ -87,7 +773,7 @@ def get_agents(domain: str, token: str):
     }
     while True:
         try:
-            response = requests.post(url, json=payload).json()
+            response = http_client.post(url, json=payload, idempotent=True).json()
             if response.get('response') == 'OK':
                 return response['agents']
             elif response.get('message') == 'Invalid access key!':
@@ -95,6 +781,8 @@ def get_agents(domain: str, token: str):
             else:
                 print('# Can\'t get hashtopolis agents')
                 sys.exit(1)
-        except requests.exceptions.ConnectionError:
-            time.sleep(5)
+        except requests.exceptions.RequestException:
+            if retry_for is not None and time.monotonic() - start_time >= retry_for:
+                raise
+            tracing.sleep(5, 'retry listAgents')
             continue
@@ -1,115 +1,142 @@
 import sys
-import time
+from urllib.parse import urlsplit
 
 import linode_api4
-import requests
 from linode_api4 import LinodeClient, StackScript
 
+import http_client
 import network
+import readiness
+import tracing
+from journal import Journal
 
+SERVER_STEPS = ('server.dns', 'server.certbot_rule', 'server.booted', 'server.nginx', 'server.final_rules',
+                'server.rebooted')
 
-def deploy_server(config: dict, client: LinodeClient, region: str, firewall_id: str, server_vpc_ip: str, vpc_subnet: str):
+
+@tracing.traced()
+def deploy_server(config: dict, client: LinodeClient, region: str, firewall_id: str, vpc: dict, server_vpc_ip: str,
+                  vpc_subnet: str, linode_type: str = 'g6-standard-2', journal: Journal = None):
     linode_image = 'linode/debian11'
-    linode_type = 'g6-standard-2'
     linode_label = config['settings']['cluster_prefix'] + 'server'
 
-    print('# Deploying Hashtopolis server')
-    ht_server, p_ = client.linode.instance_create(
-        linode_type,
-        region,
-        image=linode_image,
-        label=linode_label,
-        firewall=firewall_id,
-        booted=False,
-        stackscript=StackScript(client, int(config['stackscripts']['server'])),
-        stackscript_data={
-            'DOMAIN_NAME': config['settings']['domain']
-        }
-    )
-
-    print(f'# Updating A record for {config['settings']['domain']}')
-    network.update_a_record(
-        config['keys']['godaddy_key'],
-        config['keys']['godaddy_secret'],
-        '.'.join(config['settings']['domain'].split('.')[-2:]),
-        config['settings']['domain'].split('.')[0],
-        ht_server.ipv4[0]
-    )
+    journal = journal or Journal()
+    domain = config['settings']['domain']
+    base_url = http_client.hashtopolis_url(domain)
 
-    print(' - waiting for proper DNS resolution')
-    if network.wait_for_dns_update(config['settings']['domain'], ht_server.ipv4[0]):
-        print('\n - DNS record match')
+    print('# Deploying Hashtopolis server')
+    if journal.done('server.instance'):
+        ht_server = linode_api4.Instance(client, journal.get('server.instance'))
+        print(f' - {linode_label} already created, resuming')
     else:
-        print('\n - no DNS change, timeout')
+        for step in SERVER_STEPS:
+            journal.forget(step)
+        ht_server, p_ = network.create_instance_in_vpc(
+            config,
+            client,
+            vpc,
+            server_vpc_ip,
+            linode_type,
+            region,
+            image=linode_image,
+            label=linode_label,
+            firewall=firewall_id,
+            booted=False,
+            stackscript=StackScript(client, int(config['stackscripts']['server'])),
+            stackscript_data={
+                'DOMAIN_NAME': domain
+            }
+        )
+        journal.record('server.instance', ht_server.id, ('instances', ht_server.id))
+
+    if not journal.done('server.dns'):
+        print(f'# Updating A record for {domain}')
+        network.update_a_record(
+            config['keys']['godaddy_key'],
+            config['keys']['godaddy_secret'],
+            '.'.join(domain.split('.')[-2:]),
+            domain.split('.')[0],
+            ht_server.ipv4[0]
+        )
+
+        print(' - waiting for proper DNS resolution')
+        if network.wait_for_dns_update(
+                domain,
+                ht_server.ipv4[0],
+                nameservers=config['settings'].get('dns_nameservers'),
+                public_resolvers=config['settings'].get('dns_public_resolvers', []),
+                quorum=float(config['settings'].get('dns_quorum', 1.0))
+        ):
+            print('\n - DNS record match')
+            journal.record('server.dns', ht_server.ipv4[0])
+        else:
+            print('\n - no DNS change, timeout')
+            sys.exit(1)
+    http_client.pin_host(domain, ht_server.ipv4[0])
+
+    if not journal.done('server.certbot_rule'):
+        print('# Adding certbot firewall exception, this is temporary')
+        network.set_rules(client.token, firewall_id, [
+            {
+                'label': 'allow-certbot-verification',
+                'ports': [80, 443],
+                'allowed_ipv4s': ['0.0.0.0/0']
+            }
+        ])
+        journal.record('server.certbot_rule')
+
+    deadline = readiness.Deadline(int(config['settings'].get('server_ready_timeout', 900)))
+    try:
+        if not journal.done('server.booted') or ht_server.status == 'offline':
+            print(f'# Booting {linode_label}')
+            boot_poller = client.polling.event_poller_create('linode', 'linode_boot', entity_id=ht_server.id)
+            ht_server.boot()
+            readiness.wait_for_event('boot', boot_poller, deadline)
+        readiness.wait_for('instance running', readiness.instance_status(ht_server, 'running'), deadline)
+        journal.record('server.booted')
+        print(' - booted')
+
+        if not journal.done('server.nginx'):
+            print(f'# Waiting for {linode_label} StackScripts to do their job')
+            url = urlsplit(base_url)
+            port = url.port or 443
+            readiness.wait_for(f'port {port} open', readiness.tcp_reachable(url.hostname, port), deadline,
+                               max_interval=10)
+            if url.scheme == 'https':
+                readiness.wait_for('TLS certificate', readiness.tls_reachable(url.hostname, port), deadline,
+                                   max_interval=10)
+            readiness.wait_for('nginx', readiness.http_responds(base_url), deadline, max_interval=10)
+            journal.record('server.nginx')
+            print(' - nginx is up')
+
+        if not journal.done('server.final_rules'):
+            print('# Setting final firewall rules')
+            network.set_rules(client.token, firewall_id, [
+                {
+                    'label': 'allow-admin-only',
+                    'ports': [22, 80, 443],
+                    'allowed_ipv4s': [network.get_this_machine_ip()]
+                }, {
+                    'label': 'allow-agents',
+                    'ports': [8080, 443],
+                    'allowed_ipv4s': [vpc_subnet]
+                }
+            ])
+            journal.record('server.final_rules')
+
+        if not journal.done('server.rebooted'):
+            print('# Waiting to finish all processes')
+            reboot_poller = client.polling.event_poller_create('linode', 'linode_reboot', entity_id=ht_server.id)
+            readiness.wait_for('reboot accepted', ht_server.reboot, deadline)
+            readiness.wait_for_event('reboot', reboot_poller, deadline)
+            journal.record('server.rebooted')
+        readiness.wait_for('Hashtopolis API', readiness.json_api_responds(
+            f'{base_url}/api/user.php',
+            {'section': 'test', 'request': 'connection'}
+        ), deadline, max_interval=10)
+    except readiness.ReadinessError as e:
+        print(f'\n ! server not ready: {e}')
         sys.exit(1)
 
-    print('# Adding certbot firewall exception, this is temporary')
-    network.set_rules(client.token, firewall_id, [
-        {
-            'label': 'allow-certbot-verification',
-            'ports': [80, 443],
-            'allowed_ipv4s': ['0.0.0.0/0']
-        }
-    ])
-
-    network.add_to_vpc_subnet(config, client, ht_server.id, server_vpc_ip)
-
-    print(f'# Booting {linode_label}')
-    ht_server.boot()
-    print(' - booted')
-
-    print(f'# Waiting for {linode_label} StackScripts to do their job')
-    sleep_time = 230
-    for i in range(sleep_time, 0, -1):
-        print(f'\r - sleeping {int(i // 60)}:{int(i % 60):02} ', end='', flush=True)
-        time.sleep(1)
-
-    print('\n - waiting for nginx')
-    server_url = 'https://' + config['settings']['domain']
-    check_for_nginx(server_url)
-    print(' - nginx is up')
-
-    print('# Setting final firewall rules')
-    network.set_rules(client.token, firewall_id, [
-        {
-            'label': 'allow-admin-only',
-            'ports': [22, 80, 443],
-            'allowed_ipv4s': [network.get_this_machine_ip()]
-        }, {
-            'label': 'allow-agents',
-            'ports': [8080, 443],
-            'allowed_ipv4s': [vpc_subnet]
-        }
-    ])
-
-    print('# Waiting to finish all processes')
-    poller = client.polling.event_poller_create(
-        'linode',
-        'linode_reboot',
-        entity_id=ht_server.id,
-    )
-
-    while True:
-        try:
-            ht_server.reboot()
-            print('# Rebooting')
-            poller.wait_for_next_event_finished()
-            break
-        except linode_api4.errors.ApiError:
-            time.sleep(10)
-            continue
-
     print('# Hashtopolis server deployed successfully')
-
-
-def check_for_nginx(server_url: str):
-    interval = 4
-    while True:
-        time.sleep(interval)
-        try:
-            if '502 Bad Gateway' in requests.get(server_url, timeout=4).text:
-                break
-            else:
-                continue
-        except (requests.exceptions.ConnectTimeout, requests.exceptions.ConnectionError, requests.exceptions.SSLError):
-            pass
+    return ht_server.id
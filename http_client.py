@@ -0,0 +1,236 @@
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+import tracing
+
+# The MEWA_* variables point mewa at a local stand-in such as fakecloud.py
+LINODE_API = os.environ.get('MEWA_LINODE_API', 'https://api.linode.com/v4')
+GODADDY_API = os.environ.get('MEWA_GODADDY_API', 'https://api.godaddy.com/v1')
+IP_ECHO_URL = os.environ.get('MEWA_IP_ECHO_URL', 'https://forcedeye.com/ip')
+HASHTOPOLIS_URL = os.environ.get('MEWA_HASHTOPOLIS_URL')
+
+SERVICES = {
+    LINODE_API: 'linode',
+    GODADDY_API: 'godaddy'
+}
+
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+RETRY_STATUSES = (500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+POOL_SIZE = 32
+
+# Linode allows 800 requests per minute per token on most endpoints
+LINODE_RATE = 800 / 60
+LINODE_BURST = 40
+
+
+class HttpError(requests.exceptions.HTTPError):
+    def __init__(self, response: requests.Response):
+        self.status = response.status_code
+        super().__init__(f'{response.request.method} {response.url} returned {self.status}: {response.text[:200]}',
+                         response=response)
+
+
+class PinnedHostAdapter(HTTPAdapter):
+    def __init__(self, hostname: str, **kwargs):
+        self.hostname = hostname
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['server_hostname'] = self.hostname
+        kwargs['assert_hostname'] = self.hostname
+        super().init_poolmanager(*args, **kwargs)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            tracing.sleep(wait, 'rate limit')
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self.tokens = 0.0
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+_buckets = {
+    LINODE_API: TokenBucket(LINODE_RATE, LINODE_BURST)
+}
+_pinned_hosts = {}
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=POOL_SIZE)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def pin_host(hostname: str, ip: str):
+    """Send requests for hostname straight to ip, bypassing local resolver caches."""
+    adapter = PinnedHostAdapter(hostname, pool_connections=1, pool_maxsize=POOL_SIZE)
+    get_session().mount(f'https://{ip}/', adapter)
+    get_session().mount(f'https://{ip}:', adapter)
+    _pinned_hosts[hostname] = ip
+
+
+def resolve(hostname: str):
+    return _pinned_hosts.get(hostname, hostname)
+
+
+def hashtopolis_url(domain: str):
+    return HASHTOPOLIS_URL or f'https://{domain}'
+
+
+def service(url: str):
+    # the server's domain changes with every cluster, its API path does not
+    if urlsplit(url).path.endswith('/api/user.php'):
+        return 'hashtopolis'
+    return next((name for prefix, name in SERVICES.items() if url.startswith(prefix)), urlsplit(url).hostname)
+
+
+def backoff(attempt: int):
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def rate_limit_wait(response: requests.Response):
+    retry_after = response.headers.get('Retry-After')
+    if retry_after and retry_after.isdigit():
+        return int(retry_after)
+
+    reset = response.headers.get('X-RateLimit-Reset')
+    if reset and reset.isdigit():
+        return max(1, int(reset) - int(time.time()))
+
+    return None
+
+
+def never_sent(e: requests.exceptions.RequestException):
+    """Connect timeouts and refused connections fail before any of the request reaches the server."""
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    return bool(e.args) and isinstance(getattr(e.args[0], 'reason', None), NewConnectionError)
+
+
+def request(method: str, url: str, raise_for_status: bool = True, retries: int = MAX_RETRIES, idempotent: bool = None,
+            **kwargs):
+    """Send with retries; requests that are not idempotent (POST unless told otherwise) are only retried when
+    the server can't have acted on them: failed connects and 429s, never 5xx or timeouts after sending."""
+    if idempotent is None:
+        idempotent = method in IDEMPOTENT_METHODS
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    name = tracing.endpoint(method, url, kwargs.get('json'))
+    service_name = service(url)
+    parts = urlsplit(url)
+    bucket = next((b for prefix, b in _buckets.items() if url.startswith(prefix)), None)
+    if parts.hostname in _pinned_hosts:
+        url = parts._replace(netloc=parts.netloc.replace(parts.hostname, _pinned_hosts[parts.hostname])).geturl()
+        kwargs['headers'] = {**kwargs.get('headers', {}), 'Host': parts.netloc}
+    session = get_session()
+
+    with tracing.span(name, 'http', service=service_name, latency=0.0) as attrs:
+        attempt = 0
+        while True:
+            attrs['retries'] = attempt
+            tracing.check_interrupted(name)
+            if bucket:
+                bucket.acquire()
+
+            sent = time.time()
+            try:
+                response = session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                attrs['latency'] += time.time() - sent
+                if attempt >= retries or not (idempotent or never_sent(e)):
+                    raise
+                tracing.sleep(backoff(attempt), 'backoff')
+                attempt += 1
+                continue
+            attrs['latency'] += time.time() - sent
+            attrs['status'] = response.status_code
+
+            if response.status_code == 429:
+                wait = rate_limit_wait(response) or backoff(attempt)
+                if bucket:
+                    bucket.pause(wait)
+                if attempt >= retries:
+                    break
+                if not bucket:
+                    tracing.sleep(wait, 'rate limit')
+                attempt += 1
+                continue
+
+            if bucket and response.headers.get('X-RateLimit-Remaining') == '0':
+                bucket.pause(rate_limit_wait(response) or 1)
+
+            if response.status_code in RETRY_STATUSES and idempotent and attempt < retries:
+                tracing.sleep(backoff(attempt), 'backoff')
+                attempt += 1
+                continue
+
+            break
+
+    if raise_for_status and not response.ok:
+        raise HttpError(response)
+
+    return response
+
+
+def get(url: str, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url: str, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def put(url: str, **kwargs):
+    return request('PUT', url, **kwargs)
+
+
+def delete(url: str, **kwargs):
+    return request('DELETE', url, **kwargs)
+
+
+def linode_headers(token: str):
+    return {
+        'accept': 'application/json',
+        'content-type': 'application/json',
+        'authorization': f'Bearer {token}'
+    }
@@ -0,0 +1,95 @@
+import json
+
+import linode_api4
+from linode_api4 import LinodeClient, StackScript
+
+import hashtopolis_agents as hta
+import http_client
+import inventory
+import readiness
+
+DEFAULT_AGENT_DIR = '/root/htpclient'
+DEFAULT_AGENT_SERVICE = 'hashtopolis-agent'
+
+
+def image_prefix(config: dict):
+    return config['settings']['cluster_prefix'].replace('_', '-') + 'agent-'
+
+
+def image_revision(config: dict, client: LinodeClient):
+    stackscript = StackScript(client, int(config['stackscripts']['agent']))
+    return f'ss{stackscript.id}-{stackscript.updated:%Y%m%d%H%M}'
+
+
+def find_agent_image(config: dict, client: LinodeClient):
+    """Return the private image built from the current agent StackScript revision, dropping stale ones."""
+    label = image_prefix(config) + image_revision(config, client)
+    found = None
+
+    for image in inventory.linode_list(client.token, 'images', {'label': {'+contains': image_prefix(config)}}):
+        if image['is_public'] or not image['label'].startswith(image_prefix(config)):
+            continue
+        if image['label'] == label and image['status'] == 'available':
+            found = image['id']
+        elif image['label'] != label:
+            print(f'# Removing stale agent image {image["label"]}')
+            http_client.delete(f'{http_client.LINODE_API}/images/{image["id"]}',
+                               headers=http_client.linode_headers(client.token))
+
+    return found
+
+
+def first_boot_user_data(config: dict, voucher: str, api_url: str):
+    agent_dir = config.get('images', {}).get('agent_dir', DEFAULT_AGENT_DIR)
+    agent_service = config.get('images', {}).get('agent_service', DEFAULT_AGENT_SERVICE)
+    agent_config = json.dumps({
+        'url': api_url,
+        'voucher': voucher,
+        'token': '',
+        'uuid': ''
+    })
+
+    return '\n'.join([
+        '#cloud-config',
+        'write_files:',
+        f'  - path: {agent_dir}/config.json',
+        '    permissions: "0600"',
+        f"    content: '{agent_config}'",
+        'runcmd:',
+        f'  - [systemctl, restart, {agent_service}]',
+        ''
+    ])
+
+
+def capture_agent_image(config: dict, client: LinodeClient, agent: linode_api4.Instance, vpc_ip: str):
+    """Snapshot a freshly installed agent into a private image; the agent is booted again afterwards."""
+    label = image_prefix(config) + image_revision(config, client)
+    deadline = readiness.Deadline(int(config['settings'].get('image_build_timeout', 1800)))
+
+    print(f'# Building agent image {label} from {agent.label}')
+    try:
+        hta.wait_until_registered(config, agent, vpc_ip, deadline)
+
+        agent.shutdown()
+        readiness.wait_for(f'{agent.label} offline', readiness.instance_status(agent, 'offline'), deadline)
+
+        disk = next(d for d in agent.disks if d.filesystem != 'swap')
+        image = client.images.create(disk, label=label, cloud_init=True,
+                                     description=f'mewa agent, StackScript {config["stackscripts"]["agent"]}',
+                                     tags=['mewa'])
+
+        def available():
+            image.invalidate()
+            if image.status == 'failed':
+                raise readiness.ReadinessError(f'{label} failed')
+            return image.status == 'available'
+
+        readiness.wait_for(f'{label} available', available, deadline, interval=10, max_interval=30)
+        return image.id
+    except (readiness.ReadinessError, linode_api4.errors.ApiError) as e:
+        print(f'\n ! agent image not built, falling back to StackScripts: {e}')
+        return None
+    finally:
+        agent.invalidate()
+        if agent.status == 'offline':
+            readiness.wait_for(f'{agent.label} boot accepted', agent.boot, readiness.Deadline(120))
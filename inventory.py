@@ -0,0 +1,127 @@
+import json
+import re
+import time
+
+from linode_api4 import LinodeClient
+
+import http_client
+import state
+
+PAGE_SIZE = 500
+
+
+def linode_list(token: str, path: str, x_filter: dict = None):
+    headers = http_client.linode_headers(token)
+    if x_filter:
+        headers['X-Filter'] = json.dumps(x_filter)
+
+    items = []
+    page, pages = 1, 1
+    while page <= pages:
+        response = http_client.get(f'{http_client.LINODE_API}/{path}', headers=headers,
+                                   params={'page': page, 'page_size': PAGE_SIZE}).json()
+        items += response['data']
+        pages = response.get('pages', 1)
+        page += 1
+
+    return items
+
+
+def instance_pattern(cluster_prefix: str):
+    return re.compile(rf'^{re.escape(cluster_prefix)}(server|agent_\d+|pool_\d+)$')
+
+
+def firewall_labels(cluster_prefix: str):
+    return {cluster_prefix + 'server_firewall', cluster_prefix + 'agent_firewall'}
+
+
+def vpc_label(cluster_prefix: str, region: str = None):
+    """The cluster's VPC, or the VPC of agents placed outside the server's region."""
+    label = cluster_prefix.replace('_', '-') + 'vpc'
+    return f'{label}-{region}' if region else label
+
+
+def vpc_pattern(cluster_prefix: str):
+    return re.compile(rf'^{re.escape(vpc_label(cluster_prefix))}(-[a-z0-9-]+)?$')
+
+
+def fetch(config: dict, client: LinodeClient):
+    cluster_prefix = config['settings']['cluster_prefix']
+    vpc_prefix = cluster_prefix.replace('_', '-')
+    pattern = instance_pattern(cluster_prefix)
+
+    instances = linode_list(client.token, 'linode/instances', {'label': {'+contains': cluster_prefix}})
+    firewalls = linode_list(client.token, 'networking/firewalls', {'label': {'+contains': cluster_prefix}})
+    vpcs = linode_list(client.token, 'vpcs', {'label': {'+contains': vpc_prefix}})
+
+    return {
+        'created': time.time(),
+        'instances': [
+            {
+                'id': i['id'],
+                'label': i['label'],
+                'status': i['status'],
+                'type': i['type'],
+                'region': i['region'],
+                'ipv4': i['ipv4'],
+                'created': i['created']
+            } for i in instances if pattern.match(i['label'])
+        ],
+        'firewalls': [
+            {
+                'id': f['id'],
+                'label': f['label']
+            } for f in firewalls if f['label'] in firewall_labels(cluster_prefix)
+        ],
+        'vpcs': [
+            {
+                'id': v['id'],
+                'label': v['label'],
+                'region': v['region'],
+                'subnets': [{'id': s['id'], 'label': s['label'], 'ipv4': s['ipv4']} for s in v['subnets']]
+            } for v in vpcs if vpc_pattern(cluster_prefix).match(v['label'])
+        ]
+    }
+
+
+def build_index(raw: dict):
+    return {
+        kind: {
+            'by_id': {item['id']: item for item in raw[kind]},
+            'by_label': {item['label']: item for item in raw[kind]}
+        } for kind in ('instances', 'firewalls', 'vpcs')
+    }
+
+
+def cache_name(config: dict):
+    return f'inventory-{config["settings"]["cluster_prefix"]}.json'
+
+
+def get(config: dict, client: LinodeClient, refresh: bool = False):
+    ttl = int(config['settings'].get('inventory_ttl', 30))
+    raw = None if refresh else state.load(cache_name(config))
+
+    if raw is None or time.time() - raw['created'] > ttl:
+        raw = fetch(config, client)
+        if ttl > 0:
+            state.save(cache_name(config), raw)
+
+    return build_index(raw)
+
+
+def invalidate(config: dict):
+    state.remove(cache_name(config))
+
+
+def agents(config: dict, inv: dict):
+    pattern = re.compile(rf'^{re.escape(config["settings"]["cluster_prefix"])}agent_\d+$')
+    return {i['id']: i for i in inv['instances']['by_id'].values() if pattern.match(i['label'])}
+
+
+def pool(config: dict, inv: dict):
+    pattern = re.compile(rf'^{re.escape(config["settings"]["cluster_prefix"])}pool_\d+$')
+    return {i['id']: i for i in inv['instances']['by_id'].values() if pattern.match(i['label'])}
+
+
+def server(config: dict, inv: dict):
+    return inv['instances']['by_label'].get(config['settings']['cluster_prefix'] + 'server')
@@ -0,0 +1,111 @@
+import ipaddress
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+
+from linode_api4 import LinodeClient
+
+import network
+import state
+
+DB_NAME = 'ipam.sqlite'
+
+SCHEMA = '''
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS allocations (
+    vpc_id INTEGER NOT NULL, address INTEGER NOT NULL, label TEXT NOT NULL, seen REAL NOT NULL,
+    PRIMARY KEY (vpc_id, address)
+) WITHOUT ROWID;
+CREATE UNIQUE INDEX IF NOT EXISTS allocations_label ON allocations (vpc_id, label);
+'''
+
+
+def connect():
+    db = sqlite3.connect(state.path(DB_NAME), timeout=30, isolation_level=None)
+    db.executescript(SCHEMA)
+    return db
+
+
+@contextmanager
+def transaction():
+    """BEGIN IMMEDIATE takes the write lock up front, other processes wait for it for up to 30 s."""
+    with closing(connect()) as db:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+
+def server_address(cidr: str):
+    """The server's address, the host after the gateway."""
+    return str(ipaddress.ip_network(cidr).network_address + 2)
+
+
+def first_agent_address(cidr: str):
+    return int(ipaddress.ip_network(cidr).network_address) + 3
+
+
+def allocate(config: dict, client: LinodeClient, vpc_id: int, cidr: str, labels: list, used: set = None):
+    """Addresses for labels in the VPC, in the same order; a label that already has one keeps it.
+
+    Taken are the addresses of Linodes in the VPC and the ones recorded here. A recorded address that no Linode
+    has used for ipam_reservation_ttl hours is handed out again, which covers creates that never happened.
+    The transaction holds the database lock, so parallel deploys on this machine never get the same address.
+    Memory and time grow with the addresses taken, not with the size of the subnet.
+    """
+    ttl = float(config['settings'].get('ipam_reservation_ttl', 6)) * 3600
+    last = int(ipaddress.ip_network(cidr).broadcast_address) - 1
+    if used is None:
+        used = network.get_used_vpc_addresses(client, vpc_id)
+    used = {int(ipaddress.ip_address(address)) for address in used}
+    now = time.time()
+
+    with transaction() as db:
+        rows = db.execute('SELECT address, label, seen FROM allocations WHERE vpc_id = ?', (vpc_id,)).fetchall()
+        expired = [(vpc_id, a) for a, _, seen in rows if a not in used and now - seen > ttl]
+        db.executemany('DELETE FROM allocations WHERE vpc_id = ? AND address = ?', expired)
+        db.executemany('UPDATE allocations SET seen = ? WHERE vpc_id = ? AND address = ?',
+                       [(now, vpc_id, a) for a, _, _ in rows if a in used])
+
+        expired = {a for _, a in expired}
+        held = {label: a for a, label, _ in rows if a not in expired}
+        taken = used | set(held.values())
+        candidate = first_agent_address(cidr)
+        addresses = []
+        for label in labels:
+            if label not in held:
+                while candidate in taken:
+                    candidate += 1
+                if candidate > last:
+                    raise RuntimeError(f'no free address left in {cidr}')
+                held[label] = candidate
+                taken.add(candidate)
+                db.execute('INSERT INTO allocations VALUES (?, ?, ?, ?)', (vpc_id, candidate, label, now))
+            addresses.append(str(ipaddress.ip_address(held[label])))
+
+    return addresses
+
+
+def release(labels: list, vpc_id: int = None):
+    """Give back the addresses of deleted Linodes, in one VPC or all of them."""
+    with transaction() as db:
+        if vpc_id is None:
+            db.executemany('DELETE FROM allocations WHERE label = ?', [(label,) for label in labels])
+        else:
+            db.executemany('DELETE FROM allocations WHERE vpc_id = ? AND label = ?',
+                           [(vpc_id, label) for label in labels])
+
+
+def relabel(old: str, new: str):
+    """A pool member taken as an agent keeps its address under the new label."""
+    with transaction() as db:
+        db.execute('DELETE FROM allocations WHERE label = ?', (new,))
+        db.execute('UPDATE allocations SET label = ? WHERE label = ?', (new, old))
+
+
+def forget_vpc(vpc_id: int):
+    with transaction() as db:
+        db.execute('DELETE FROM allocations WHERE vpc_id = ?', (vpc_id,))
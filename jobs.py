@@ -0,0 +1,299 @@
+import base64
+import os
+import re
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+
+import hashtopolis_agents as hta
+import http_client
+import planner
+import state
+import tracing
+from journal import Journal
+
+UPLOAD_TIMEOUT = 600
+UPLOAD_ATTEMPTS = 3
+# inline files are sent in one request, larger ones have to come from a URL or the server's import directory
+INLINE_FILE_LIMIT = 256 * 2 ** 20
+FILE_TYPES = {'wordlist': 0, 'rule': 1}
+
+
+def api(config: dict, section: str, request: str, **params):
+    response = hta.user_api(config['settings']['domain'], config['keys']['hashtopolis'], section, request, **params)
+    if response.get('response') != 'OK':
+        raise RuntimeError(f'{section}.{request}: {response.get("message", "failed")}')
+
+    return response
+
+
+def journal_name(name: str):
+    return f'job-{re.sub(r"[^A-Za-z0-9_.-]", "_", name)}.json'
+
+
+def read_parts(filename: str, part_size: int, offset: int = 0, index: int = 0):
+    """Yield (index, offset, end, data) parts of about part_size bytes, cut at line ends.
+
+    Parts only depend on the file and part_size, so a resumed upload can seek to a known offset.
+    """
+    with open(filename, 'rb') as file:
+        file.seek(offset)
+        while True:
+            data = file.read(part_size)
+            if not data:
+                return
+            if not data.endswith(b'\n'):
+                data += file.readline()
+            yield index, offset, offset + len(data), data
+            index, offset = index + 1, offset + len(data)
+
+
+def part_name(params: dict, index: int):
+    # the upload id keeps parts of an earlier upload with the same name from being taken for this one's
+    return f'{params["name"]} {params["upload_id"]} part {index + 1:04}'
+
+
+def find_hashlist(config: dict, name: str):
+    return next((h['hashlistId'] for h in api(config, 'hashlist', 'listHashlists')['hashlists']
+                 if h['name'] == name), None)
+
+
+@tracing.traced()
+def upload_part(config: dict, index: int, data: bytes, params: dict):
+    """createHashlist without automatic retries: a timed out upload may still be imported, look for it first."""
+    url = f'{http_client.hashtopolis_url(config["settings"]["domain"])}/api/user.php'
+    payload = {
+        'section': 'hashlist',
+        'request': 'createHashlist',
+        'accessKey': config['keys']['hashtopolis'],
+        'name': part_name(params, index),
+        'isSalted': params['salted'],
+        'isSecret': True,
+        'isHexSalt': False,
+        'separator': params['separator'],
+        'format': 0,
+        'hashtypeId': params['mode'],
+        'accessGroupId': params['access_group'],
+        'useBrain': False,
+        'brainFeatures': 0,
+        'data': base64.b64encode(data).decode()
+    }
+
+    for attempt in range(UPLOAD_ATTEMPTS):
+        try:
+            response = http_client.post(url, json=payload, retries=0,
+                                        timeout=(http_client.CONNECT_TIMEOUT, UPLOAD_TIMEOUT)).json()
+            if response.get('response') == 'OK':
+                return response['hashlistId']
+            raise RuntimeError(f'{payload["name"]}: {response.get("message", "createHashlist failed")}')
+        except requests.exceptions.RequestException as e:
+            hashlist_id = find_hashlist(config, payload['name'])
+            if hashlist_id:
+                return hashlist_id
+            if attempt == UPLOAD_ATTEMPTS - 1:
+                raise RuntimeError(f'{payload["name"]}: {e}')
+            tracing.sleep(http_client.backoff(attempt + 2), 'retry hashlist upload')
+
+
+def upload_hashlist(config: dict, journal: Journal):
+    """Stream the hash file as hashlist parts, a few in flight, and join them in a superhashlist.
+
+    Memory use is bounded by part size times uploads in flight, whatever the file size.
+    """
+    params = journal.params
+    size = params['size']
+    done = {int(step.split('.')[1]): result for step, result in journal.data['steps'].items()
+            if step.startswith('parts.')}
+
+    # seek past the parts finished in a row, parts finished out of order further on are skipped as they come
+    offset, index = 0, 0
+    while index in done:
+        offset, index = done[index]['end'], index + 1
+    uploaded = offset + sum(p['end'] - p['offset'] for i, p in done.items() if i > index)
+    if done:
+        print(f' - {len(done)} parts already uploaded, resuming')
+
+    existing = {h['name']: h['hashlistId'] for h in api(config, 'hashlist', 'listHashlists')['hashlists']}
+
+    def upload(part_index, part_offset, end, data):
+        hashlist_id = existing.get(part_name(params, part_index)) or upload_part(config, part_index, data, params)
+        journal.record(f'parts.{part_index}', {'hashlistId': hashlist_id, 'offset': part_offset, 'end': end})
+        return end - part_offset
+
+    with ThreadPoolExecutor(max_workers=params['uploads']) as executor:
+        pending = set()
+        for part in read_parts(params['file'], params['part_size'], offset, index):
+            if part[0] in done:
+                continue
+            if len(pending) >= params['uploads']:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    uploaded += future.result()
+                print(f'\r - uploaded {uploaded / 2 ** 20:.0f}/{size / 2 ** 20:.0f} MB', end='', flush=True)
+            pending.add(executor.submit(upload, *part))
+        for future in pending:
+            uploaded += future.result()
+    print(f'\r - uploaded {uploaded / 2 ** 20:.0f}/{size / 2 ** 20:.0f} MB')
+
+    parts = [journal.get(f'parts.{i}')['hashlistId']
+             for i in sorted(int(s.split('.')[1]) for s in journal.data['steps'] if s.startswith('parts.'))]
+    if len(parts) == 1:
+        return parts[0]
+
+    if not journal.done('superhashlist'):
+        response = api(config, 'superhashlist', 'createSuperhashlist', name=params['name'], hashlists=parts)
+        superhashlist_id = response.get('superhashlistId') or max(
+            s['hashlistId'] for s in api(config, 'superhashlist', 'listSuperhashlists')['superhashlists']
+            if s['name'] == params['name'])
+        journal.record('superhashlist', superhashlist_id)
+        print(f' - superhashlist {superhashlist_id} joins {len(parts)} parts')
+
+    return journal.get('superhashlist')
+
+
+def find_file(config: dict, filename: str):
+    return next((f['fileId'] for f in api(config, 'file', 'listFiles')['files'] if f['filename'] == filename), None)
+
+
+def add_file(config: dict, source: str, file_type: int, access_group: int):
+    """A file already on the server by name, a URL the server downloads, or a local file sent inline."""
+    filename = os.path.basename(source.split('?')[0])
+    file_id = find_file(config, filename)
+    if file_id:
+        return filename, file_id
+
+    if re.match(r'https?://', source):
+        api(config, 'file', 'addFile', filename=filename, fileType=file_type, source='url', accessGroupId=access_group,
+            data=source)
+    elif os.path.isfile(source):
+        if os.path.getsize(source) > INLINE_FILE_LIMIT:
+            raise RuntimeError(f'{source} is too large to send inline, pass a URL or put it in the server\'s '
+                               f'import directory and pass its name')
+        with open(source, 'rb') as file:
+            data = base64.b64encode(file.read()).decode()
+        api(config, 'file', 'addFile', filename=filename, fileType=file_type, source='inline',
+            accessGroupId=access_group, data=data)
+    else:
+        raise RuntimeError(f'{source} is neither a local file, a URL nor a file on the server')
+
+    print(f' - {filename} added')
+    return filename, find_file(config, filename)
+
+
+def latest_cracker_version(config: dict, cracker: str = 'hashcat'):
+    crackers = api(config, 'cracker', 'listCrackers')['crackers']
+    cracker_id = next((c['crackerTypeId'] for c in crackers if c['crackerTypeName'] == cracker), None)
+    if cracker_id is None:
+        raise RuntimeError(f'no {cracker} binary on the server')
+
+    versions = api(config, 'cracker', 'getCracker', crackerTypeId=cracker_id)['crackerVersions']
+    return max(v['versionId'] for v in versions)
+
+
+def attack_command(files: dict, mask: str = None, attack: str = None):
+    if attack:
+        return attack if '#HL#' in attack else f'#HL# {attack}'
+    if mask:
+        return f'#HL# -a 3 {mask}'
+
+    command = f'#HL# -a 0 {files["wordlist"]}'
+    return f'{command} -r {files["rule"]}' if 'rule' in files else command
+
+
+def submit(config: dict, hash_file: str, mode: int, name: str = None, wordlist: str = None, rules: str = None,
+           mask: str = None, attack: str = None, chunk_time: int = 600, priority: int = 0, max_agents: int = 0,
+           cpu_only: bool = False, small: bool = False, salted: bool = False, separator: str = ':'):
+    """Upload a hashlist of any size and create a task for it; running it again resumes an interrupted upload."""
+    if not (wordlist or mask or attack):
+        print('# Pass --wordlist, --mask or --attack')
+        sys.exit(1)
+
+    name = name or os.path.basename(hash_file)
+    stat = os.stat(hash_file)
+    params = {
+        'name': name,
+        'upload_id': f'{int(time.time()):x}',
+        'file': os.path.abspath(hash_file),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'mode': mode,
+        'salted': salted,
+        'separator': separator,
+        'part_size': int(float(config['settings'].get('hashlist_part_mb', 16)) * 2 ** 20),
+        'uploads': int(config['settings'].get('hashlist_uploads', 2)),
+        'access_group': int(config['settings'].get('hashtopolis_access_group', 1))
+    }
+
+    data = state.load(journal_name(name))
+    if data and {k: data['params'].get(k) for k in ('file', 'size', 'mtime')} != \
+            {k: params[k] for k in ('file', 'size', 'mtime')}:
+        print(f'# {hash_file} changed since the last upload of {name}, starting over')
+        data = None
+    journal = Journal(journal_name(name), data)
+    if not data:
+        journal.data['params'] = params
+        journal.save()
+    params = journal.params
+
+    print(f'# Uploading {hash_file} ({params["size"] / 2 ** 20:.0f} MB) as {name}')
+    try:
+        hashlist_id = upload_hashlist(config, journal)
+
+        files = {}
+        for kind, source in (('wordlist', wordlist), ('rule', rules)):
+            if source:
+                files[kind], file_id = add_file(config, source, FILE_TYPES[kind], params['access_group'])
+                files[f'{kind}_id'] = file_id
+
+        command = attack_command(files, mask, attack)
+        response = api(config, 'task', 'createTask',
+                       name=name,
+                       hashlistId=hashlist_id,
+                       attackCmd=command,
+                       chunksize=chunk_time,
+                       statusTimer=5,
+                       benchmarkType='speed',
+                       color='',
+                       isCpuOnly=cpu_only,
+                       isSmall=small,
+                       skip=0,
+                       crackerVersionId=latest_cracker_version(config),
+                       files=[files[f'{k}_id'] for k in ('wordlist', 'rule') if f'{k}_id' in files],
+                       priority=priority,
+                       maxAgents=max_agents,
+                       preprocessorId=0,
+                       preprocessorCommand='')
+    except (requests.exceptions.RequestException, RuntimeError) as e:
+        print(f'\n ! {e}')
+        print('# Progress is saved, run the same command again to continue')
+        sys.exit(1)
+
+    journal.finish()
+    print(f'# Task {response["taskId"]} created: {command}')
+    return response['taskId']
+
+
+def list_tasks(config: dict):
+    tasks = api(config, 'task', 'listTasks')['tasks']
+    if not tasks:
+        print('# No tasks')
+        return
+
+    print(f'   {"id":>5} {"name":<32} {"priority":>8} {"progress":>9} {"speed":>12}')
+    for task in tasks:
+        if task.get('type', 0) != 0:
+            print(f'   {task.get("supertaskId", ""):>5} {task["name"][:32]:<32} {task.get("priority", 0):>8} supertask')
+            continue
+        detail = api(config, 'task', 'getTask', taskId=task['taskId'])
+        keyspace = detail.get('keyspace') or 0
+        progress = f'{detail.get("searched", 0) / keyspace:.0%}' if keyspace else '-'
+        speed = sum(float(a.get('speed') or 0) for a in detail.get('agents', []))
+        print(f'   {task["taskId"]:>5} {task["name"][:32]:<32} {task.get("priority", 0):>8} {progress:>9} '
+              f'{planner.format_speed(speed):>12}')
+
+
+def set_priority(config: dict, task_id: int, priority: int):
+    api(config, 'task', 'setTaskPriority', taskId=task_id, priority=priority)
+    print(f'# Task {task_id} priority set to {priority}')
@@ -0,0 +1,86 @@
+import threading
+import time
+
+from linode_api4 import LinodeClient
+
+import inventory
+import state
+
+
+class Journal:
+    """Finished deploy steps with their results, saved atomically after every step.
+
+    Without a name nothing is written, so callers outside a deploy can pass Journal().
+    """
+
+    def __init__(self, name: str = None, data: dict = None):
+        self.name = name
+        self.data = data or {'started': time.time(), 'params': {}, 'steps': {}, 'resources': {}}
+        self.lock = threading.Lock()
+
+    def save(self):
+        if self.name:
+            state.save(self.name, self.data)
+
+    @property
+    def params(self):
+        return self.data['params']
+
+    def done(self, step: str):
+        return step in self.data['steps']
+
+    def get(self, step: str, default=None):
+        return self.data['steps'].get(step, default)
+
+    def record(self, step: str, result=None, resource: tuple = None):
+        """Mark step as finished; resource is an (inventory kind, id) pair checked again on resume."""
+        with self.lock:
+            self.data['steps'][step] = result
+            if resource:
+                self.data['resources'][step] = list(resource)
+            self.save()
+
+    def forget(self, step: str):
+        with self.lock:
+            self.data['steps'].pop(step, None)
+            self.data['resources'].pop(step, None)
+            self.save()
+
+    def finish(self):
+        if self.name:
+            state.remove(self.name)
+
+
+def journal_name(config: dict):
+    return f'deploy-{config["settings"]["cluster_prefix"]}.json'
+
+
+def start(config: dict, params: dict):
+    journal = Journal(journal_name(config))
+    journal.data['params'] = params
+    journal.save()
+    return journal
+
+
+def load(config: dict):
+    data = state.load(journal_name(config))
+    return Journal(journal_name(config), data) if data else None
+
+
+def discard(config: dict):
+    state.remove(journal_name(config))
+
+
+def validate(config: dict, client: LinodeClient, journal: Journal):
+    """Drop steps whose instances, firewalls or VPC no longer exist so they are redone.
+
+    A step named 'server.instance' belongs to 'server', which is dropped with it.
+    """
+    inv = inventory.get(config, client, refresh=True)
+    for step, (kind, resource_id) in list(journal.data['resources'].items()):
+        if resource_id not in inv[kind]['by_id']:
+            print(f' - {step}: {kind[:-1]} {resource_id} no longer exists, redoing')
+            journal.forget(step)
+            owner = step.partition('.')[0]
+            if owner != step:
+                journal.forget(owner)
@@ -0,0 +1,264 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from linode_api4 import LinodeClient
+
+import inventory
+import jobs
+import tracing
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# agents that have not contacted the server for this long are reported as unresponsive
+STALE_AGENT = 300
+# hashcat status codes as Hashtopolis reports them for chunks
+CHUNK_STATES = {0: 'init', 1: 'autotune', 2: 'running', 3: 'paused', 4: 'exhausted', 5: 'cracked', 6: 'aborted',
+                7: 'quit', 8: 'bypass', 9: 'aborted_checkpoint', 10: 'aborted_runtime'}
+RUNNING_CHUNK_STATE = 2
+# chunks in these states do not change any more
+FINISHED_CHUNK_STATES = {4, 5, 6, 7, 8, 9, 10}
+
+_lock = threading.Lock()
+_cache = {'text': '', 'updated': 0.0, 'duration': 0.0, 'up': 0, 'runs': 0, 'errors': 0}
+# finished chunks are fetched once, running ones on every pass
+_chunks = {}
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def family(name: str, kind: str, help_text: str, samples: list):
+    """Prometheus text for one metric family; samples are (labels, value) pairs."""
+    lines = [f'# HELP mewa_{name} {help_text}', f'# TYPE mewa_{name} {kind}']
+    for labels, value in samples:
+        label_text = ','.join(f'{k}="{escape(v)}"' for k, v in labels.items())
+        series = f'mewa_{name}{{{label_text}}}' if label_text else f'mewa_{name}'
+        lines.append(f'{series} {float(value):g}')
+
+    return lines
+
+
+def histogram_family(name: str, help_text: str, histograms: dict):
+    """histograms maps label tuples, as ((key, value), ...), to tracing histograms."""
+    lines = [f'# HELP mewa_{name} {help_text}', f'# TYPE mewa_{name} histogram']
+    for label_items, h in sorted(histograms.items()):
+        labels = ','.join(f'{k}="{escape(v)}"' for k, v in label_items)
+        for bound, count in zip(h['bounds'], h['buckets']):
+            lines.append(f'mewa_{name}_bucket{{{labels},le="{bound:g}"}} {count}')
+        lines.append(f'mewa_{name}_bucket{{{labels},le="+Inf"}} {h["count"]}')
+        lines.append(f'mewa_{name}_sum{{{labels}}} {h["sum"]:g}')
+        lines.append(f'mewa_{name}_count{{{labels}}} {h["count"]}')
+
+    return lines
+
+
+def agent_state(agent: dict, working: set, now: float):
+    if not agent.get('isActive'):
+        return 'inactive'
+    if now - float((agent.get('lastActivity') or {}).get('time') or 0) > STALE_AGENT:
+        return 'unresponsive'
+    return 'working' if agent['agentId'] in working else 'idle'
+
+
+def fetch_chunks(config: dict, executor: ThreadPoolExecutor, chunk_ids: list):
+    with _lock:
+        pending = [i for i in chunk_ids if _chunks.get(i, {}).get('state') not in FINISHED_CHUNK_STATES]
+    for chunk in executor.map(lambda i: jobs.api(config, 'task', 'getChunk', chunkId=i), pending):
+        with _lock:
+            _chunks[chunk['chunkId']] = chunk
+
+
+@tracing.traced()
+def collect(config: dict, client: LinodeClient):
+    """One pass over Linode and Hashtopolis, rendered to Prometheus text for the scrapes to come."""
+    now = time.time()
+    inv = inventory.get(config, client, refresh=True)
+    server = inventory.server(config, inv)
+    roles = [('agent', inventory.agents(config, inv).values()), ('pool', inventory.pool(config, inv).values()),
+             ('server', [server] if server else [])]
+    instances = {}
+    for role, members in roles:
+        for instance in members:
+            key = (role, instance['type'], instance['region'], instance['status'])
+            instances[key] = instances.get(key, 0) + 1
+
+    parallelism = max(1, int(config['settings'].get('parallelism', 8)))
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        listed = [t for t in jobs.api(config, 'task', 'listTasks')['tasks'] if t.get('type', 0) == 0]
+        tasks = list(executor.map(lambda t: {**t, **jobs.api(config, 'task', 'getTask', taskId=t['taskId'])},
+                                  listed))
+        agents = list(executor.map(lambda a: jobs.api(config, 'agent', 'get', agentId=a['agentId']),
+                                   jobs.api(config, 'agent', 'listAgents')['agents']))
+        fetch_chunks(config, executor, [c for t in tasks if not t.get('isComplete') for c in t.get('chunkIds', [])])
+
+    names = {a['agentId']: a['name'] for a in agents}
+    working, agent_speeds, task_rows = set(), [], []
+    for task in tasks:
+        labels = {'task': task['taskId'], 'name': task.get('name', '')}
+        on_task = [a for a in task.get('agents', []) if float(a.get('speed') or 0) > 0]
+        working.update(a['agentId'] for a in on_task)
+        agent_speeds += [({'agent': a['agentId'], 'name': names.get(a['agentId'], ''), 'task': task['taskId']},
+                          float(a['speed'])) for a in on_task]
+        task_rows.append((labels, task, sum(float(a['speed']) for a in on_task)))
+
+    states = {state: 0 for state in ('working', 'idle', 'unresponsive', 'inactive')}
+    for agent in agents:
+        states[agent_state(agent, working, now)] += 1
+
+    open_tasks = [(labels, task, speed) for labels, task, speed in task_rows if not task.get('isComplete')]
+    task_ids = {task['taskId'] for _, task, _ in open_tasks}
+    with _lock:
+        for chunk_id in [i for i, c in _chunks.items() if c['taskId'] not in task_ids]:
+            del _chunks[chunk_id]
+        chunks = list(_chunks.values())
+    running = [c for c in chunks if c.get('state') == RUNNING_CHUNK_STATE]
+    chunk_states = {}
+    for chunk in chunks:
+        key = (chunk['taskId'], chunk.get('state'))
+        chunk_states[key] = chunk_states.get(key, 0) + 1
+
+    def remaining(task):
+        return max(0.0, float(task.get('keyspace') or 0) - float(task.get('searched') or 0))
+
+    lines = []
+    lines += family('instances', 'gauge', 'Linodes of the cluster by role, type, region and status',
+                    [(dict(zip(('role', 'type', 'region', 'status'), k)), v) for k, v in sorted(instances.items())])
+    lines += family('agents', 'gauge', 'Hashtopolis agents by state',
+                    [({'state': state}, count) for state, count in states.items()])
+    lines += family('agent_last_seen_seconds', 'gauge', 'Seconds since the agent last contacted the server',
+                    [({'agent': a['agentId'], 'name': a['name']},
+                      now - float((a.get('lastActivity') or {}).get('time') or 0)) for a in agents])
+    lines += family('agent_speed_hashes_per_second', 'gauge', 'Speed of each agent on its current task',
+                    agent_speeds)
+    lines += family('speed_hashes_per_second', 'gauge', 'Speed of all agents together',
+                    [({}, sum(speed for _, _, speed in task_rows))])
+    lines += family('task_keyspace', 'gauge', 'Keyspace of the task, 0 until an agent has measured it',
+                    [(labels, task.get('keyspace') or 0) for labels, task, _ in open_tasks])
+    lines += family('task_searched', 'gauge', 'Candidates of the task searched so far',
+                    [(labels, task.get('searched') or 0) for labels, task, _ in open_tasks])
+    lines += family('task_progress_ratio', 'gauge', 'Searched share of the keyspace',
+                    [(labels, float(task.get('searched') or 0) / float(task['keyspace']))
+                     for labels, task, _ in open_tasks if task.get('keyspace')])
+    lines += family('task_speed_hashes_per_second', 'gauge', 'Speed of all agents on the task',
+                    [(labels, speed) for labels, _, speed in open_tasks])
+    lines += family('task_agents', 'gauge', 'Agents working on the task',
+                    [(labels, len([a for a in task.get('agents', []) if float(a.get('speed') or 0) > 0]))
+                     for labels, task, _ in open_tasks])
+    lines += family('task_priority', 'gauge', 'Priority of the task', [(labels, task.get('priority', 0))
+                                                                       for labels, task, _ in open_tasks])
+    lines += family('task_eta_seconds', 'gauge', 'Remaining keyspace over the current speed, only while agents work',
+                    [(labels, remaining(task) / speed) for labels, task, speed in open_tasks
+                     if speed and task.get('keyspace')])
+    lines += family('chunks', 'gauge', 'Chunks of open tasks by hashcat state',
+                    [({'task': task_id, 'state': CHUNK_STATES.get(state, state)}, count)
+                     for (task_id, state), count in sorted(chunk_states.items(), key=str)])
+    lines += family('chunk_progress_ratio', 'gauge', 'Progress of running chunks',
+                    [({'task': c['taskId'], 'chunk': c['chunkId'], 'agent': c.get('agentId', '')},
+                      float(c.get('progress') or 0) / 10000) for c in running])
+    lines += family('chunk_age_seconds', 'gauge', 'Seconds since a running chunk was dispatched',
+                    [({'task': c['taskId'], 'chunk': c['chunkId'], 'agent': c.get('agentId', '')},
+                      now - float(c.get('dispatchTime') or now)) for c in running])
+    lines += family('chunk_last_activity_seconds', 'gauge', 'Seconds since a running chunk last reported progress',
+                    [({'task': c['taskId'], 'chunk': c['chunkId'], 'agent': c.get('agentId', '')},
+                      now - float(c.get('lastActivity') or c.get('dispatchTime') or now)) for c in running])
+
+    return '\n'.join(lines) + '\n'
+
+
+def local_metrics():
+    """Collector health and the API and phase totals of this process; rendered per scrape, no upstream calls."""
+    totals = tracing.totals()
+    with _lock:
+        cache = dict(_cache)
+
+    http = totals['http']
+    lines = []
+    lines += family('collector_up', 'gauge', 'Whether the last collection succeeded', [({}, cache['up'])])
+    lines += family('collector_last_success_timestamp_seconds', 'gauge', 'When the cached metrics were collected',
+                    [({}, cache['updated'])])
+    lines += family('collector_duration_seconds', 'gauge', 'Duration of the last collection',
+                    [({}, cache['duration'])])
+    lines += family('collector_runs_total', 'counter', 'Collections attempted', [({}, cache['runs'])])
+    lines += family('collector_errors_total', 'counter', 'Collections that failed', [({}, cache['errors'])])
+    lines += family('api_requests_total', 'counter', 'API calls by service and HTTP status, error when none came',
+                    [({'service': service, 'status': status}, h['count'])
+                     for (service, status), h in sorted(http.items())])
+    lines += family('api_retries_total', 'counter', 'Retried attempts of API calls by service and final status',
+                    [({'service': service, 'status': status}, h['retries'])
+                     for (service, status), h in sorted(http.items())])
+    lines += histogram_family('api_latency_seconds', 'API call latency including retries',
+                              {(('service', service), ('status', status)): h for (service, status), h in http.items()})
+    lines += histogram_family('phase_duration_seconds', 'Duration of provisioning phases and waits',
+                              {(('kind', kind), ('name', name)): h for (kind, name), h in totals['phase'].items()})
+
+    return '\n'.join(lines) + '\n'
+
+
+def render():
+    with _lock:
+        text = _cache['text']
+
+    return text + local_metrics()
+
+
+def collector(config: dict, client: LinodeClient, interval: float, stop: threading.Event):
+    while not stop.is_set():
+        start = time.time()
+        try:
+            text = collect(config, client)
+            with _lock:
+                _cache.update(text=text, updated=time.time(), up=1)
+        except Exception as e:
+            # whatever a poll throws, the thread keeps going and the next scrape shows up 0
+            print(f' ! metrics collection failed: {type(e).__name__}: {e}')
+            with _lock:
+                _cache.update(up=0, errors=_cache['errors'] + 1)
+        with _lock:
+            _cache.update(duration=time.time() - start, runs=_cache['runs'] + 1)
+        stop.wait(interval)
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start(config: dict, client: LinodeClient, host: str = None, port: int = None, interval: float = None):
+    """Collector and HTTP server on daemon threads; scrapes are answered from the last collection."""
+    host = host or config['settings'].get('metrics_host', '0.0.0.0')
+    port = int(port or config['settings'].get('metrics_port', 9108))
+    interval = float(interval or config['settings'].get('metrics_interval', 30))
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    stop = threading.Event()
+    threading.Thread(target=collector, args=(config, client, interval, stop), name='metrics-collector',
+                     daemon=True).start()
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    print(f'# Metrics on http://{host}:{port}/metrics, collected every {interval:g} s')
+
+    return server, stop
+
+
+def serve(config: dict, client: LinodeClient, host: str = None, port: int = None, interval: float = None):
+    server, stop = start(config, client, host, port, interval)
+    try:
+        stop.wait()
+    except KeyboardInterrupt:
+        print('\n# Metrics stopped')
+    finally:
+        stop.set()
+        server.shutdown()
@@ -1,64 +1,237 @@
+import argparse
 import sys
 import time
 
 import linode_api4
 from linode_api4 import LinodeClient
 
+import autoscale
 import configuration as conf
 import hashtopolis_agents as hta
 import hashtopolis_server as hts
+import http_client
+import images
+import inventory
+import ipam
+import jobs
+import journal
+import metrics
 import misc
 import network
+import planner
+import reconcile
+import results
+import scale
+import scheduler
+import speeds
+import teardown
+import tracing
+import warm_pool
 
 
 def deploy(config: dict, client: LinodeClient, server: bool, linodes: bool, vpc_subnet: str = '10.0.77.0/24'):
-    start_time = time.time()
-    linode_region_label, linode_region_id = conf.pick_region(client)
+    linode_region_label, linode_region_id = conf.pick_region(config)
     linode_type_label, linode_type_id = '', ''
     linode_amount = 0
 
     if linodes:
-        linode_type_label, linode_type_id = conf.pick_type()
-        linode_amount = conf.pick_amount()
+        linode_type_label, linode_type_id = conf.pick_type(config)
+        linode_amount = conf.pick_amount(int(config['settings'].get('max_agents', 30)))
+
+    if journal.load(config):
+        print('# An unfinished deploy was found, starting a new one discards it (use "mewa resume" to continue it)')
 
+    agent_regions = config['settings'].get('agent_regions') or []
+    spill_over = f' (then {", ".join(agent_regions)} when out of capacity)' if agent_regions else ''
     if server and linodes:
         print(f'A Hashcat server and {linode_amount} {linode_type_label} '
-              f'instances will be deployed in {linode_region_label} at https://{config['settings']['domain']}. '
+              f'instances will be deployed in {linode_region_label}{spill_over} at https://{config['settings']['domain']}. '
               f'Continue?', end=' ')
     elif server:
         print(f'# A hashcat server will be deployed in {linode_region_label} at https://{config['settings']['domain']}. '
               f'Continue?', end=' ')
     elif linodes:
         print(f'# {linode_amount} {linode_type_label} '
-              f'instances will be deployed in {linode_region_label}. '
+              f'instances will be deployed in {linode_region_label}{spill_over}. '
               f'Continue?', end=' ')
 
     misc.confirmation()
-    print('# Setting up VPC network')
-    vpc_addresses = network.get_vpc_addr_list(vpc_subnet, linode_amount)
-    try:
-        network.build_vpc(config, client, linode_region_id)
-    except linode_api4.errors.ApiError:
-        print(' - VPC already exists')
-    print(' - done')
+    run_deploy(config, client, journal.start(config, {
+        'server': server,
+        'linodes': linodes,
+        'region': linode_region_id,
+        'type': linode_type_id,
+        'amount': linode_amount,
+        'vpc_subnet': vpc_subnet
+    }))
+
+
+def resume(config: dict, client: LinodeClient):
+    deploy_journal = journal.load(config)
+    if not deploy_journal:
+        print('# No unfinished deploy found')
+        return
+
+    params = deploy_journal.params
+    print(f'# Resuming deploy of {"a server and " if params["server"] else ""}{params["amount"]} agents '
+          f'in {params["region"]}, {len(deploy_journal.data["steps"])} steps already done')
+    journal.validate(config, client, deploy_journal)
+    run_deploy(config, client, deploy_journal)
+
+
+def run_deploy(config: dict, client: LinodeClient, deploy_journal: journal.Journal):
+    start_time = time.time()
+    params = deploy_journal.params
+    server, linodes = params['server'], params['linodes']
+    linode_region_id, linode_type_id, linode_amount = params['region'], params['type'], params['amount']
+    vpc_subnet = params['vpc_subnet']
+
+    inventory.invalidate(config)
+    cluster_prefix = config['settings']['cluster_prefix']
+    domain = config['settings']['domain']
+    token = config['keys']['hashtopolis']
+    parallelism = int(config['settings'].get('parallelism', 8))
+
+    def recorded(step, kind, resource_id):
+        deploy_journal.record(f'{step}.id', resource_id, (kind, resource_id))
+        return resource_id
+
+    def setup_vpc(_):
+        print('# Setting up VPC network')
+        try:
+            vpc = network.build_vpc(config, client, linode_region_id, vpc_subnet)
+        except linode_api4.errors.ApiError:
+            print(' - VPC already exists')
+            vpc = network.get_vpc_info(config, client)
+        recorded('vpc', 'vpcs', vpc['vpc']['id'])
+        print(' - done')
+        return vpc
+
+    def allocate(r):
+        # labels are picked once: on resume the agents this deploy already created would shift them
+        labels = deploy_journal.get('addresses.labels')
+        if labels is None:
+            existing_agents = inventory.agents(config, inventory.get(config, client))
+            labels = reconcile.next_agent_labels(config, [a['label'] for a in existing_agents.values()],
+                                                 linode_amount)
+            deploy_journal.record('addresses.labels', labels)
+        return {
+            'vpc_addresses': [ipam.server_address(vpc_subnet)] + ipam.allocate(config, client, r['vpc']['vpc']['id'],
+                                                                               vpc_subnet, labels),
+            'labels': labels
+        }
+
+    def firewall(name):
+        return lambda r: recorded(name, 'firewalls', network.get_firewall(client, cluster_prefix + name))
+
+    tasks = [
+        scheduler.Task('vpc', setup_vpc),
+        scheduler.Task('addresses', allocate, ('vpc',))
+    ]
 
     if server:
-        server_firewall_id = network.get_firewall(client, config['settings']['cluster_prefix'] + 'server_firewall')
-        hts.deploy_server(config, client, linode_region_id, server_firewall_id, vpc_addresses[0], vpc_subnet)
+        tasks += [
+            scheduler.Task('server_firewall', firewall('server_firewall')),
+            scheduler.Task('server', lambda r: hts.deploy_server(
+                config, client, linode_region_id, r['server_firewall'], r['vpc'], r['addresses']['vpc_addresses'][0],
+                vpc_subnet, journal=deploy_journal
+            ), ('server_firewall', 'vpc', 'addresses'))
+        ]
 
     if linodes:
-        agent_firewall_id = network.get_firewall(client, config['settings']['cluster_prefix'] + 'agent_firewall')
-        hta.deploy_linodes(config, client, linode_region_id, agent_firewall_id, linode_type_id, linode_amount, vpc_addresses)
+        tasks.append(scheduler.Task('agent_firewall', firewall('agent_firewall')))
+
+        image_id = None
+        if str(config['settings'].get('golden_image', 0)) == '1':
+            image_id = images.find_agent_image(config, client)
+
+        if 'overlap' not in params:
+            params['overlap'] = server and (image_id is not None or str(config['settings'].get('golden_image', 0)) != '1')
+            deploy_journal.save()
+
+        if params['overlap']:
+            # Vouchers are generated locally so agents can be created while the server is still coming up;
+            # only registering the vouchers and booting the agents has to wait for it.
+            def fanout(r):
+                return hta.Fanout(config, client, linode_region_id, r['vpc'], r['agent_firewall'], linode_type_id,
+                                  r['addresses']['vpc_addresses'], image_id, vpc_subnet, deploy_journal)
+
+            def create(r):
+                jobs = list(zip(r['addresses']['labels'], r['vouchers'], r['addresses']['vpc_addresses'][1:]))
+                agent_fanout = fanout(r)
+                created, failed = hta.create_agents(config, client, agent_fanout, jobs, boot=False,
+                                                    journal=deploy_journal)
+                return ({label: a.id for label, a in created.items()}, {label: str(e) for label, e in failed.items()},
+                        {label: agent_fanout.placed[label] for label in created})
+
+            def register(r):
+                hta.ensure_api_key(config)
+                return hta.register_vouchers(r['vouchers'], domain, token, parallelism)
+
+            def boot(r):
+                created = {label: linode_api4.Instance(client, i) for label, i in r['agents'][0].items()}
+                failed = dict(r['agents'][1])
+                placements = r['agents'][2]
+                registered = set(r['vouchers_registered'])
+                vouchers = dict(zip(r['addresses']['labels'], r['vouchers']))
+                for label in [label for label in created if vouchers[label] not in registered]:
+                    failed[label] = 'voucher not registered'
+                    created.pop(label)
+                if any(placements[label][0] != linode_region_id for label in created):
+                    hta.open_server_firewall(config, client, linode_region_id)
+                offline = {label: a for label, a in created.items() if a.status in hta.BOOTABLE}
+                failed.update(hta.boot_agents(config, offline))
+                hta.report_failed(failed, linode_amount)
+                return {label: hta.registration_entry(a, vouchers[label], *placements[label], linode_region_id)
+                        for label, a in created.items() if label not in failed}
+
+            def sync(r):
+                agent_fanout = fanout(r)
+                for label, entry in r['agents_booted'].items():
+                    agent_fanout.adopt(label, entry['region'], entry['vpc_ip'])
+                failed = hta.wait_for_registration(config, client, r['agents_booted'], agent_fanout)
+                hta.record_speeds(config, client)
+                reserve_size = int(config['settings'].get('voucher_reserve', 0))
+                if reserve_size:
+                    hta.fill_voucher_reserve(reserve_size, domain, token, parallelism)
+                return failed
+
+            tasks += [
+                scheduler.Task('vouchers', lambda r: [hta.generate_voucher() for _ in range(linode_amount)]),
+                scheduler.Task('agents', create, ('vpc', 'addresses', 'agent_firewall', 'vouchers')),
+                scheduler.Task('vouchers_registered', register, ('server', 'vouchers')),
+                scheduler.Task('agents_booted', boot, ('agents', 'vouchers_registered', 'addresses', 'vouchers')),
+                scheduler.Task('agents_synced', sync,
+                               ('agents_booted', 'addresses', 'vouchers', 'vpc', 'agent_firewall'))
+            ]
+        else:
+            tasks.append(scheduler.Task('agents', lambda r: sorted(hta.deploy_linodes(
+                config, client, linode_region_id, r['agent_firewall'], linode_type_id, linode_amount, r['vpc'],
+                r['addresses']['vpc_addresses'], r['addresses']['labels'], journal=deploy_journal
+            )), ('vpc', 'addresses', 'agent_firewall') + (('server',) if server else ())))
+
+    try:
+        scheduler.run(tasks, parallelism, deploy_journal)
+    except scheduler.TaskFailed as e:
+        inventory.invalidate(config)
+        tracing.summary(time.time() - start_time)
+        print(f'# Deploy {e}')
+        print('# Progress is saved, run "python3 mewa.py resume" to continue from the failed step')
+        sys.exit(1)
+
+    deploy_journal.finish()
+    inventory.invalidate(config)
+    tracing.summary(time.time() - start_time)
 
     print(f'# All done, it took {int((time.time() - start_time) // 60):>02}:{int(time.time() - start_time) % 60:>02}s')
     print(f'vist https://{config['settings']['domain']}')
 
 
 def remove(config: dict, client: LinodeClient, no_prompt=False):
-    cluster_prefix = config['settings']['cluster_prefix']
-    agents = {i.id: i.label for i in client.linode.instances() if cluster_prefix in i.label}
-    firewalls = {i.id: i.label for i in client.networking.firewalls() if cluster_prefix in i.label}
-    vpc = {i.id: i.label for i in client.vpcs() if cluster_prefix.replace("_", "-") in i.label}
+    inv = inventory.get(config, client, refresh=True)
+    agents = {i['id']: i['label'] for i in inv['instances']['by_id'].values()}
+    firewalls = {f['id']: f['label'] for f in inv['firewalls']['by_id'].values()}
+    vpc = {v['id']: v['label'] for v in inv['vpcs']['by_id'].values()}
 
     if len(agents) == 0 and len(firewalls) == 0 and len(vpc) == 0:
         print('# No entities to remove')
@@ -76,27 +249,14 @@ def remove(config: dict, client: LinodeClient, no_prompt=False):
         print(f'# Continue?', end=' ')
         misc.confirmation()
 
-    for a in agents:
-        print(f'# Removing {agents[a]}...')
-        misc.delete_linode(client.token, a)
-        print(' - done')
-
-    for f in firewalls:
-        print(f'# Removing {firewalls[f]}...')
-        network.remove_firewall(client.token, f)
-        print(' - done')
-
-    for v in vpc:
-        print(f'# Removing {vpc[v]}')
-        network.remove_vpc(client, str(v))
-        print(' - done')
-
+    teardown.run(config, client, agents, firewalls, vpc)
+    journal.discard(config)
     print('# Finished')
 
 
 def remove_only_agents(config: dict, client: LinodeClient):
-    cluster_prefix = config['settings']['cluster_prefix']
-    agents = {i.id: i.label for i in client.linode.instances() if cluster_prefix + 'agent_' in i.label}
+    inv = inventory.get(config, client, refresh=True)
+    agents = {i: a['label'] for i, a in inventory.agents(config, inv).items()}
     if len(agents) == 0:
         print('# No agents to remove')
         print('# Exiting')
@@ -109,10 +269,25 @@ def remove_only_agents(config: dict, client: LinodeClient):
     print(f'# Continue?', end=' ')
     misc.confirmation()
 
-    for a in agents:
-        print(f'# Removing {agents[a]}...')
-        misc.delete_linode(client.token, a)
-        print(' - done')
+    teardown.run(config, client, agents)
+    hta.open_server_firewall(config, client)
+
+
+def status(config: dict, client: LinodeClient):
+    inv = inventory.get(config, client)
+    if not any(inv[kind]['by_id'] for kind in inv):
+        print('# No entities found')
+        return
+
+    print('# Instances:')
+    for i in sorted(inv['instances']['by_id'].values(), key=lambda i: i['label']):
+        print(f' - {i["label"]:<32} {i["status"]:<12} {i["type"]:<20} {i["region"]:<12} {i["ipv4"][0]}')
+    print('# Firewalls:')
+    for f in inv['firewalls']['by_id'].values():
+        print(f' - {f["label"]}')
+    print('# VPCs:')
+    for v in inv['vpcs']['by_id'].values():
+        print(f' - {v["label"]} {v["region"]} {", ".join(s["ipv4"] for s in v["subnets"])}')
 
 
 def pick_action():
@@ -122,21 +297,177 @@ def pick_action():
     print('4. Clean up')
     print('5. Configure')
     print('6. Remove only agents')
-    print('7. Exit')
+    print('7. Status')
+    print('8. Exit')
 
     while True:
         action = int(input('# Choose an option: '))
-        if 1 <= action <= 6:
+        if 1 <= action <= 8:
             print()
             return action
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(prog='mewa', description='Hashtopolis cluster on Linode')
+    parser.add_argument('--trace', metavar='FILE', help='append timing spans to FILE as JSON lines')
+    parser.add_argument('--chrome-trace', metavar='FILE', help='write spans to FILE for chrome://tracing or Perfetto')
+    commands = parser.add_subparsers(dest='command')
+
+    apply_parser = commands.add_parser('apply', help='reconcile the cluster with a desired state file')
+    apply_parser.add_argument('file', help='desired state, e.g. cluster.yaml')
+    apply_parser.add_argument('-y', '--yes', action='store_true', help='do not ask for confirmation')
+
+    scale_parser = commands.add_parser('scale', help='add or remove agents on a running cluster')
+    scale_parser.add_argument('--agents', type=int, required=True, help='number of agents to run')
+    scale_parser.add_argument('--type', help='Linode type for new agents, defaults to the running ones')
+    scale_parser.add_argument('-y', '--yes', action='store_true', help='do not ask for confirmation')
+
+    pool_parser = commands.add_parser('pool', help='manage the warm pool of powered-off agents')
+    pool_parser.add_argument('pool_action', choices=['fill', 'status'])
+    pool_parser.add_argument('--size', type=int, help='pool size, defaults to warm_pool_size')
+    pool_parser.add_argument('--type', help='Linode type, defaults to warm_pool_type or the running agents')
+
+    commands.add_parser('resume', help='continue an interrupted or failed deploy')
+
+    plan_parser = commands.add_parser('plan', help='recommend a Linode type and agent count for a cracking job')
+    plan_parser.add_argument('--mode', type=int, required=True, help='hashcat hash mode, e.g. 1000')
+    plan_parser.add_argument('--keyspace', required=True, help='candidate count, 95^8 or a mask like ?u?l?l?l?d?d')
+    plan_parser.add_argument('--deadline', type=float, help='hours until it has to be done')
+    plan_parser.add_argument('--budget', type=float, help='maximum cost in USD')
+    plan_parser.add_argument('--optimize', choices=['time', 'cost'])
+    plan_parser.add_argument('--region', help='use this region\'s prices')
+    plan_parser.add_argument('--refresh', action='store_true', help='download the Linode catalog again')
+
+    jobs_parser = commands.add_parser('jobs', help='upload hashlists and create tasks on the Hashtopolis server')
+    jobs_commands = jobs_parser.add_subparsers(dest='jobs_action', required=True)
+    submit_parser = jobs_commands.add_parser('submit', help='upload a hashlist of any size and create a task for it')
+    submit_parser.add_argument('hashlist', help='file with one hash per line')
+    submit_parser.add_argument('--mode', type=int, required=True, help='hashcat hash mode, e.g. 1000')
+    submit_parser.add_argument('--name', help='hashlist and task name, defaults to the file name')
+    submit_parser.add_argument('--wordlist', help='local file, URL or name of a file on the server')
+    submit_parser.add_argument('--rules', help='local file, URL or name of a file on the server')
+    submit_parser.add_argument('--mask', help='brute-force mask, e.g. ?u?l?l?l?d?d')
+    submit_parser.add_argument('--attack', help='raw hashcat arguments, #HL# is the hashlist')
+    submit_parser.add_argument('--chunk-time', type=int, default=600, help='seconds of work per chunk')
+    submit_parser.add_argument('--priority', type=int, default=0)
+    submit_parser.add_argument('--max-agents', type=int, default=0, help='0 for no limit')
+    submit_parser.add_argument('--cpu-only', action='store_true')
+    submit_parser.add_argument('--small', action='store_true', help='give the task to one agent at a time')
+    submit_parser.add_argument('--salted', action='store_true', help='hashes are hash<separator>salt')
+    submit_parser.add_argument('--separator', default=':')
+    jobs_commands.add_parser('list', help='tasks with progress and speed')
+    priority_parser = jobs_commands.add_parser('priority', help='change the priority of a task')
+    priority_parser.add_argument('task_id', type=int)
+    priority_parser.add_argument('priority', type=int)
+
+    autoscale_parser = commands.add_parser('autoscale', help='keep resizing the fleet to the Hashtopolis task queue')
+    autoscale_parser.add_argument('--dry-run', action='store_true', help='print decisions without scaling')
+    autoscale_parser.add_argument('--once', action='store_true', help='decide and act once, then exit')
+    autoscale_parser.add_argument('--metrics-port', type=int, help='also serve Prometheus metrics on this port')
+
+    metrics_parser = commands.add_parser('metrics', help='serve cluster and cracking metrics for Prometheus')
+    metrics_parser.add_argument('--host', help='address to listen on, defaults to metrics_host')
+    metrics_parser.add_argument('--port', type=int, help='defaults to metrics_port')
+    metrics_parser.add_argument('--interval', type=float, help='seconds between collections, defaults to '
+                                                               'metrics_interval')
+
+    results_parser = commands.add_parser('results', help='cracked hashes')
+    results_commands = results_parser.add_subparsers(dest='results_action', required=True)
+    export_parser = results_commands.add_parser('export', help='append new cracks to a potfile and/or JSON lines')
+    export_parser.add_argument('--potfile', help='hash:plain lines, cracked.pot if no output is given')
+    export_parser.add_argument('--jsonl', help='one JSON object per crack')
+    export_parser.add_argument('--hashlist', type=int, nargs='+', help='only these hashlist or superhashlist IDs')
+    export_parser.add_argument('--follow', action='store_true', help='keep polling for new cracks')
+    export_parser.add_argument('--interval', type=float, default=60, help='seconds between polls with --follow')
+    lookup_parser = results_commands.add_parser('lookup', help='look hashes up in the local index')
+    lookup_parser.add_argument('hashes', nargs='*')
+    lookup_parser.add_argument('--file', help='file with one hash per line')
+
+    speeds_parser = commands.add_parser('speeds', help='agent speeds measured on the fleet')
+    speeds_parser.add_argument('speeds_action', choices=['collect', 'stats'])
+    speeds_parser.add_argument('--type', help='only this Linode type')
+    speeds_parser.add_argument('--region', help='only this region')
+    speeds_parser.add_argument('--mode', type=int, help='only this hashcat hash mode')
+    speeds_parser.add_argument('--days', type=float, default=30, help='samples from the last DAYS days')
+
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
     config_filename = 'mewa_config.yaml'
     config = conf.get_config(config_filename)
-    client = LinodeClient(config['keys']['linode'])
+    client = LinodeClient(config['keys']['linode'], base_url=http_client.LINODE_API)
+    tracing.configure(args.trace, args.chrome_trace)
+    tracing.instrument_session(client.session, 'linode')
 
     try:
+        if args.command == 'apply':
+            reconcile.apply(config, client, args.file, args.yes)
+            return
+        elif args.command == 'scale':
+            scale.scale(config, client, args.agents, args.type, args.yes)
+            return
+        elif args.command == 'plan':
+            planner.run(config, args.mode, args.keyspace, args.deadline, args.budget, args.optimize, args.region,
+                        args.refresh, speeds.medians())
+            return
+        elif args.command == 'jobs':
+            if args.jobs_action == 'submit':
+                jobs.submit(config, args.hashlist, args.mode, args.name, args.wordlist, args.rules, args.mask,
+                            args.attack, args.chunk_time, args.priority, args.max_agents, args.cpu_only, args.small,
+                            args.salted, args.separator)
+            elif args.jobs_action == 'list':
+                jobs.list_tasks(config)
+            else:
+                jobs.set_priority(config, args.task_id, args.priority)
+            return
+        elif args.command == 'autoscale':
+            if args.metrics_port:
+                metrics.start(config, client, port=args.metrics_port)
+            autoscale.run(config, client, args.dry_run, args.once)
+            return
+        elif args.command == 'metrics':
+            metrics.serve(config, client, args.host, args.port, args.interval)
+            return
+        elif args.command == 'results':
+            if args.results_action == 'export':
+                potfile = args.potfile or (None if args.jsonl else 'cracked.pot')
+                if args.follow:
+                    results.follow(config, potfile, args.jsonl, args.hashlist, args.interval)
+                else:
+                    print(f'# {results.export(config, potfile, args.jsonl, args.hashlist)} new cracked hashes, '
+                          f'{results.count()} in total')
+            else:
+                hashes = list(args.hashes)
+                if args.file:
+                    with open(args.file) as file:
+                        hashes += [line.strip() for line in file if line.strip()]
+                found = results.lookup(hashes)
+                for h in hashes:
+                    print(f'{h}:{found[h]}' if h in found else f'{h} not cracked')
+            return
+        elif args.command == 'speeds':
+            if args.speeds_action == 'collect':
+                hta.collect_speeds(config, client)
+            else:
+                speeds.print_stats(speeds.stats(args.days, args.type, args.region, args.mode), args.days,
+                                   speeds.devices(args.days))
+            return
+        elif args.command == 'resume':
+            resume(config, client)
+            return
+        elif args.command == 'pool':
+            if args.pool_action == 'fill':
+                try:
+                    warm_pool.fill(config, client, args.size, args.type)
+                except RuntimeError as e:
+                    print(f'# {e}')
+                    sys.exit(1)
+            else:
+                warm_pool.report(config, client)
+            return
+
         action = pick_action()
 
         if action == 1:
@@ -152,6 +483,8 @@ def main():
         elif action == 6:
             remove_only_agents(config, client)
         elif action == 7:
+            status(config, client)
+        elif action == 8:
             sys.exit(0)
     except KeyboardInterrupt:
         if str(config['settings']['autoclean_when_failed']) == '1':
@@ -1,5 +1,6 @@
 import sys
-import requests
+
+import http_client
 
 
 def confirmation():
@@ -15,10 +16,5 @@ def confirmation():
 
 
 def delete_linode(token: str, linode_id: str):
-    url = f'https://api.linode.com/v4/linode/instances/{linode_id}'
-    headers = {
-        'accept': 'application/json',
-        'authorization': f'Bearer {token}'
-    }
-
-    requests.delete(url, headers=headers)
+    url = f'{http_client.LINODE_API}/linode/instances/{linode_id}'
+    http_client.delete(url, headers=http_client.linode_headers(token))
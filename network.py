@@ -1,20 +1,33 @@
-import ipaddress
+import math
+import re
 import time
+from concurrent.futures import ThreadPoolExecutor
 
+import dns.exception
+import dns.message
+import dns.query
+import dns.rdatatype
 import dns.resolver
 import linode_api4
-import requests
 from linode_api4 import LinodeClient
 
+import http_client
+import inventory
+import misc
+import tracing
 
-def get_firewalls_list(client: LinodeClient):
-    return client.networking.firewalls()
+# Linode words "no room for this plan here" differently across regions and plan classes; "not available" is left
+# out, it is also what a misspelt type or image gets
+CAPACITY_ERROR = re.compile(r'\b(not enough|no|insufficient|out of|at) capacity\b|\bout of stock\b|\bsold out\b',
+                            re.I)
+REMOTE_AGENTS_RULE = 'allow-remote-agents'
+# addresses Linode accepts in a single firewall rule
+RULE_ADDRESSES = 255
 
 
 def firewall_exists(client: LinodeClient, firewall_name: str):
-    for firewall in get_firewalls_list(client):
-        if firewall.label == firewall_name:
-            return firewall.id
+    for firewall in inventory.linode_list(client.token, 'networking/firewalls', {'label': firewall_name}):
+        return firewall['id']
 
     return None
 
@@ -41,13 +54,8 @@ def get_firewall(client: LinodeClient, firewall_label: str):
 
 
 def remove_firewall(token: str, firewall_id: int):
-    url = f'https://api.linode.com/v4/networking/firewalls/{firewall_id}'
-    headers = {
-        'accept': 'application/json',
-        'authorization': f'Bearer {token}'
-    }
-
-    requests.delete(url, headers=headers)
+    url = f'{http_client.LINODE_API}/networking/firewalls/{firewall_id}'
+    http_client.delete(url, headers=http_client.linode_headers(token))
 
 
 def set_rules(token: str, firewall_id: str, rules: list):
@@ -55,19 +63,41 @@ def set_rules(token: str, firewall_id: str, rules: list):
     for rule in rules:
         print(f' - {rule['label']} ACCEPT TCP {rule['ports']} {', '.join(rule['allowed_ipv4s'])}')
 
-    url = f"https://api.linode.com/v4/networking/firewalls/{firewall_id}/rules"
-
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Content-Type': 'application/json'
-    }
+    url = f'{http_client.LINODE_API}/networking/firewalls/{firewall_id}/rules'
 
     data = {
         'inbound': translate_inbound_rules(rules),
         'outbound': []
     }
 
-    requests.put(url, headers=headers, json=data)
+    http_client.put(url, headers=http_client.linode_headers(token), json=data)
+
+
+def set_remote_agent_rules(token: str, firewall_id: str, ips: list):
+    """Let agents outside the server's VPC reach it over HTTPS, from their public IPs only; other rules stay."""
+    current = get_rules(token, firewall_id)
+    inbound = [r for r in current.get('inbound', []) if not str(r.get('label', '')).startswith(REMOTE_AGENTS_RULE)]
+    allowed = {a for r in current.get('inbound', []) if str(r.get('label', '')).startswith(REMOTE_AGENTS_RULE)
+               for a in r.get('addresses', {}).get('ipv4', [])}
+    if allowed == {f'{ip}/32' for ip in ips}:
+        return
+    rules = [{
+        'label': f'{REMOTE_AGENTS_RULE}-{number}',
+        'ports': [443],
+        'allowed_ipv4s': [f'{ip}/32' for ip in ips[start:start + RULE_ADDRESSES]]
+    } for number, start in enumerate(range(0, len(ips), RULE_ADDRESSES), start=1)]
+
+    print(f'# Allowing {len(ips)} out-of-region agents through the server firewall')
+    url = f'{http_client.LINODE_API}/networking/firewalls/{firewall_id}/rules'
+    http_client.put(url, headers=http_client.linode_headers(token),
+                    json={'inbound': inbound + translate_inbound_rules(rules), 'outbound': current.get('outbound', [])})
+
+
+def is_capacity_error(e: Exception):
+    if not isinstance(e, linode_api4.errors.ApiError) or e.status not in (400, 503):
+        return False
+    reasons = [str(error.get('reason', '')) for error in (e.json or {}).get('errors', [])] or [str(e)]
+    return any(CAPACITY_ERROR.search(reason) for reason in reasons)
 
 
 def translate_inbound_rules(rules: list):
@@ -87,8 +117,7 @@ def translate_inbound_rules(rules: list):
 
 
 def get_this_machine_ip():
-    url = 'https://forcedeye.com/ip'
-    my_ip = requests.get(url).text.split()[0].strip()
+    my_ip = http_client.get(http_client.IP_ECHO_URL).text.split()[0].strip()
     print(f'# This machine\'s IP: {my_ip}')
 
     return str(my_ip + '/32')
@@ -96,7 +125,7 @@ def get_this_machine_ip():
 
 def update_a_record(api_key, api_secret, domain, record_name, new_ip, ttl=600):
     print('# Updating DNS')
-    url = f'https://api.godaddy.com/v1/domains/{domain}/records/A/{record_name}'
+    url = f'{http_client.GODADDY_API}/domains/{domain}/records/A/{record_name}'
     headers = {
         'Authorization': f'sso-key {api_key}:{api_secret}',
         'Content-Type': 'application/json'
@@ -106,91 +135,166 @@ def update_a_record(api_key, api_secret, domain, record_name, new_ip, ttl=600):
         'ttl': ttl
     }]
 
-    response = requests.put(url, json=payload, headers=headers)
-    if response.json()['message'] == 'Authenticated user is not allowed access':
+    response = http_client.put(url, json=payload, headers=headers, raise_for_status=False)
+    if response.ok:
+        print(' - updated')
+    elif response.status_code == 403 and response.json().get('message') == 'Authenticated user is not allowed access':
         print(' - you have fewer than 10 domains on godaddy')
         print(' - this is godaddy\'s policy for allowing api access')
         print(' ! you need to update this record manually')
         print(f' ! {new_ip}')
         print(f' ! {record_name}.{domain}')
     else:
-        print(' - updated')
+        raise http_client.HttpError(response)
+
+
+def parse_nameserver(nameserver: str):
+    host, _, port = nameserver.partition(':')
+    return host, int(port) if port else 53
 
 
-def wait_for_dns_update(domain, expected_ip, timeout=800, interval=11):
+def get_authoritative_nameservers(domain: str):
+    zone = dns.resolver.zone_for_name(domain)
+    nameservers = []
+    for ns in dns.resolver.resolve(zone, 'NS'):
+        try:
+            nameservers += [a.to_text() for a in dns.resolver.resolve(ns.target, 'A')]
+        except dns.exception.DNSException:
+            continue
+
+    return nameservers
+
+
+def query_a_record(domain: str, nameserver: str, timeout: float = 3):
+    host, port = parse_nameserver(nameserver)
+    query = dns.message.make_query(domain, 'A')
+    with tracing.span(f'A {domain} @{nameserver}', 'dns'):
+        response = dns.query.udp(query, host, timeout=timeout, port=port)
+
+    return {rr.to_text() for rrset in response.answer if rrset.rdtype == dns.rdatatype.A for rr in rrset}
+
+
+def check_dns_propagation(domain: str, expected_ip: str, nameservers: list):
+    def check(nameserver):
+        try:
+            return expected_ip in query_a_record(domain, nameserver)
+        except (dns.exception.DNSException, OSError):
+            return False
+
+    with ThreadPoolExecutor(max_workers=len(nameservers)) as executor:
+        return dict(zip(nameservers, executor.map(check, nameservers)))
+
+
+def wait_for_dns_update(domain, expected_ip, timeout=800, interval=3, nameservers=None, public_resolvers=(),
+                        quorum=1.0):
+    with tracing.span(f'DNS {domain} -> {expected_ip}', 'wait'):
+        return _wait_for_dns_update(domain, expected_ip, timeout, interval, nameservers, public_resolvers, quorum)
+
+
+def _wait_for_dns_update(domain, expected_ip, timeout, interval, nameservers, public_resolvers, quorum):
     start_time = time.time()
-    once_printed = False
+
+    if not nameservers:
+        try:
+            nameservers = get_authoritative_nameservers(domain)
+        except dns.exception.DNSException:
+            nameservers = []
+    nameservers = list(nameservers) + list(public_resolvers)
+
+    if not nameservers:
+        print(' - no nameservers found, asking the local resolver')
+        return wait_for_local_dns_update(domain, expected_ip, timeout)
+
+    required = max(1, math.ceil(len(nameservers) * quorum))
+    print(f' - asking {len(nameservers)} nameservers, {required} must agree')
 
     while time.time() - start_time < timeout:
         time_left = int(timeout - (time.time() - start_time))
+        results = check_dns_propagation(domain, expected_ip, nameservers)
+        updated = sum(results.values())
+
+        print(f'\r - {updated}/{len(nameservers)} nameservers updated, timeout in {time_left} s ', end='', flush=True)
+        if updated >= required:
+            return True
+
+        tracing.sleep(interval, 'poll DNS propagation')
+
+    return False
+
 
-        if not once_printed and time.time() - start_time > 600:
-            print(f'\r - sometimes it takes a while', flush=True)
-            once_printed = True
+def wait_for_local_dns_update(domain, expected_ip, timeout=800, interval=11):
+    start_time = time.time()
 
-        print(f'\r - 600s TTL: {600 + int(start_time - time.time())} s, timeout in {time_left} s ', end='', flush=True)
+    while time.time() - start_time < timeout:
+        time_left = int(timeout - (time.time() - start_time))
+        print(f'\r - timeout in {time_left} s ', end='', flush=True)
 
         try:
             answers = dns.resolver.resolve(domain, 'A')
-            current_ip = answers[0].to_text()
-            if current_ip == expected_ip:
+            if answers[0].to_text() == expected_ip:
                 return True
-        except dns.resolver.NXDOMAIN:
+        except dns.exception.DNSException:
             pass
 
-        time.sleep(interval)
+        tracing.sleep(interval, 'poll local DNS')
 
     return False
 
 
-def build_vpc(config: dict, client: LinodeClient, region: str, vpc_subnet='10.0.77.0/24'):
-    return client.vpcs.create(
-        label=config['settings']['cluster_prefix'].replace("_", "-") + 'vpc',
+def build_vpc(config: dict, client: LinodeClient, region: str, vpc_subnet='10.0.77.0/24', label: str = None):
+    label = label or inventory.vpc_label(config['settings']['cluster_prefix'])
+    vpc = client.vpcs.create(
+        label=label,
         region=region,
         subnets=[
             {
-                'label': config['settings']['cluster_prefix'].replace("_", "-") + 'vpc-subnet',
+                'label': f'{label}-subnet',
                 'ipv4': vpc_subnet
             }
         ]
-    ).id
+    )
+    subnet = vpc.subnets[0]
 
+    return {
+        'vpc': {
+            'label': vpc.label,
+            'id': vpc.id
+        },
+        'subnet': {
+            'label': subnet.label,
+            'id': subnet.id
+        }
+    }
 
-def get_vpc_info(config: dict, client: LinodeClient):
-    related_entities = {}
-    vpc_info = client.vpcs()
-    for v in vpc_info:
-        if config['settings']['cluster_prefix'].replace("_", "-") + 'vpc' == v.label:
-            related_entities['vpc'] = {
-                'label': v.label,
-                'id': v.id,
 
-            }
-            for s in v.subnets:
-                if config['settings']['cluster_prefix'].replace("_", "-") + 'vpc-subnet' == s.label:
-                    related_entities['subnet'] = {
-                        'label': s.label,
-                        'id': s.id
-                    }
+def get_vpc_info(config: dict, client: LinodeClient, label: str = None, refresh: bool = False):
+    related_entities = {}
+    label = label or inventory.vpc_label(config['settings']['cluster_prefix'])
+    vpcs = inventory.get(config, client, refresh)['vpcs']['by_label']
+    v = vpcs.get(label)
+    if v:
+        related_entities['vpc'] = {
+            'label': v['label'],
+            'id': v['id'],
+        }
+        for s in v['subnets']:
+            if f'{label}-subnet' == s['label']:
+                related_entities['subnet'] = {
+                    'label': s['label'],
+                    'id': s['id']
+                }
 
     return related_entities
 
 
 def remove_vpc(client: LinodeClient, vpc_id: str):
-    url = 'https://api.linode.com/v4/vpcs/' + vpc_id
-    headers = {'authorization': 'Bearer ' + client.token}
-    requests.delete(url, headers=headers)
+    url = f'{http_client.LINODE_API}/vpcs/{vpc_id}'
+    http_client.delete(url, headers=http_client.linode_headers(client.token))
 
 
 def get_interface_data(client: LinodeClient, linode_id: int):
-    url = f'https://api.linode.com/v4/linode/instances/{linode_id}/configs'
-
-    headers = {
-        'accept': 'application/json',
-        'authorization': 'Bearer ' + client.token
-    }
-
-    response = requests.get(url, headers=headers).json()
+    url = f'{http_client.LINODE_API}/linode/instances/{linode_id}/configs'
+    response = http_client.get(url, headers=http_client.linode_headers(client.token)).json()
 
     interface_data = response['data'][0]['interfaces']
     vpc_interface = next((interface for interface in interface_data if interface['purpose'] == 'vpc'), None)
@@ -204,20 +308,69 @@ def get_interface_data(client: LinodeClient, linode_id: int):
     }
 
 
-def get_vpc_addr_list(cidr: str, agents_amount: int):
-    net = list(ipaddress.ip_network(cidr).hosts())
-    return [str(ip) for ip in net[1:2 + agents_amount]]
+def get_vpc_address_map(client: LinodeClient, vpc_id: int):
+    return {ip['address']: ip['linode_id'] for ip in inventory.linode_list(client.token, f'vpcs/{vpc_id}/ips')
+            if ip.get('address')}
+
+
+def get_used_vpc_addresses(client: LinodeClient, vpc_id: int):
+    return set(get_vpc_address_map(client, vpc_id))
 
 
-def add_to_vpc_subnet(config: dict, client: LinodeClient, linode_id: int, vpc_ip: str):
+def get_rules(token: str, firewall_id: int):
+    url = f'{http_client.LINODE_API}/networking/firewalls/{firewall_id}/rules'
+    return http_client.get(url, headers=http_client.linode_headers(token)).json()
+
+
+def get_vpc_interfaces(vpc: dict, vpc_ip: str):
+    return [
+        {
+            'purpose': 'vpc',
+            'primary': True,
+            'subnet_id': vpc['subnet']['id'],
+            'ipv4': {
+                'nat_1_1': 'any',
+                'vpc': vpc_ip
+            }
+        }
+    ]
+
+
+def create_instance_in_vpc(config: dict, client: LinodeClient, vpc: dict, vpc_ip: str, *args, **kwargs):
+    # no new instances once Ctrl+C was hit, the clean up that follows would have to chase them
+    tracing.check_interrupted(f'create {kwargs.get("label")}')
+    try:
+        with tracing.span(f'create {kwargs.get("label")}'):
+            return client.linode.instance_create(*args, interfaces=get_vpc_interfaces(vpc, vpc_ip), **kwargs)
+    except linode_api4.errors.ApiError as e:
+        # only a rejection of interfaces as a whole means the API can't take them at creation; errors on
+        # interfaces[0].* (address in use, subnet not found) would fail the same way when attached afterwards
+        if not any(error.get('field') == 'interfaces' for error in (e.json or {}).get('errors', [])):
+            raise
+        print(f' - {kwargs.get("label")}: VPC interface rejected at creation, attaching it afterwards')
+
+    result = client.linode.instance_create(*args, **kwargs)
+    instance = result[0] if isinstance(result, tuple) else result
+    try:
+        add_to_vpc_subnet(config, client, instance.id, vpc_ip, vpc)
+    except Exception:
+        # the caller never learns about an instance outside the VPC, don't leave it running under the label
+        misc.delete_linode(client.token, instance.id)
+        raise
+
+    return result
+
+
+def add_to_vpc_subnet(config: dict, client: LinodeClient, linode_id: int, vpc_ip: str, vpc: dict = None):
     linode_instance = linode_api4.Instance(client, linode_id)
 
     print(f'# Configuring VPC for {linode_instance.label}')
     print(f' - VPC IP: {vpc_ip}')
     inter = get_interface_data(client, linode_id)
-    vpc = get_vpc_info(config, client)
+    if vpc is None:
+        vpc = get_vpc_info(config, client)
 
-    url = f'https://api.linode.com/v4/linode/instances/{linode_id}/configs/{inter['config_id']}/interfaces'
+    url = f'{http_client.LINODE_API}/linode/instances/{linode_id}/configs/{inter['config_id']}/interfaces'
 
     payload = {
         'purpose': 'vpc',
@@ -232,11 +385,5 @@ def add_to_vpc_subnet(config: dict, client: LinodeClient, linode_id: int, vpc_ip
         },
         'ip_ranges': []
     }
-    headers = {
-        'accept': 'application/json',
-        'content-type': 'application/json',
-        'authorization': 'Bearer ' + client.token
-    }
-
-    requests.post(url, json=payload, headers=headers)
+    http_client.post(url, json=payload, headers=http_client.linode_headers(client.token))
     print(' - added successfully')
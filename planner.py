@@ -0,0 +1,164 @@
+import math
+import re
+import sys
+
+import catalog
+
+SERVER_TYPE = 'g6-standard-2'
+SETUP_HOURS = 0.25
+
+HASH_MODES = {
+    0: 'MD5',
+    100: 'SHA1',
+    1000: 'NTLM',
+    1400: 'SHA2-256',
+    1800: 'sha512crypt',
+    3200: 'bcrypt',
+    500: 'md5crypt',
+    5600: 'NetNTLMv2',
+    13100: 'Kerberos 5 TGS-REP',
+    22000: 'WPA-PBKDF2-PMKID+EAPOL'
+}
+
+# Rough hashcat -b speeds in H/s, per GPU for GPU models and per vCPU for CPU plans.
+# Speeds measured on the fleet (speeds.py) replace them, the speeds section of the config file overrides both.
+GPU_SPEEDS = {
+    'rtx6000': {0: 48e9, 100: 15e9, 1000: 85e9, 1400: 6.5e9, 1800: 950e3, 3200: 25e3, 500: 20e6, 5600: 3.4e9,
+                13100: 1.0e9, 22000: 650e3},
+    'rtx4000': {0: 55e9, 100: 17e9, 1000: 95e9, 1400: 7.5e9, 1800: 1.0e6, 3200: 35e3, 500: 25e6, 5600: 4.0e9,
+                13100: 1.1e9, 22000: 800e3}
+}
+CPU_SPEEDS = {0: 120e6, 100: 60e6, 1000: 200e6, 1400: 25e6, 1800: 3e3, 3200: 300, 500: 80e3, 5600: 10e6,
+              13100: 5e6, 22000: 1.5e3}
+SHARED_CPU_FACTOR = 0.6
+
+MASK_CHARSETS = {'l': 26, 'u': 26, 'd': 10, 's': 33, 'a': 95, 'b': 256, 'h': 16, 'H': 16}
+
+
+def parse_keyspace(text: str):
+    """Accepts 1000000, 95^8, 26^6*10^2 or a hashcat mask such as ?u?l?l?l?l?d?d."""
+    text = text.strip()
+    if '?' in text:
+        size = 1
+        for charset, literal in re.findall(r'\?(.)|(.)', text):
+            if charset and charset in '1234':
+                raise ValueError(f'custom charset ?{charset} has no known size, pass the keyspace as a number')
+            if charset and charset not in MASK_CHARSETS:
+                raise ValueError(f'unknown mask charset ?{charset}')
+            size *= MASK_CHARSETS[charset] if charset else 1
+        return size
+
+    size = 1
+    for factor in text.split('*'):
+        base, _, exponent = factor.partition('^')
+        try:
+            size *= int(base) ** int(exponent or 1)
+        except ValueError:
+            raise ValueError(f'{text} is not a number, a product of powers or a mask') from None
+    return size
+
+
+def agent_speed(config: dict, linode_type: dict, mode: int, measured: dict = None):
+    configured = (config.get('speeds') or {}).get(linode_type['id'], {})
+    if mode in configured or str(mode) in configured:
+        return float(configured.get(mode, configured.get(str(mode))))
+    if (measured or {}).get(linode_type['id'], {}).get(mode):
+        return measured[linode_type['id']][mode]
+
+    if linode_type['gpus']:
+        model = next((m for m in GPU_SPEEDS if m in linode_type['id']), None)
+        speed = GPU_SPEEDS.get(model, {}).get(mode)
+        return speed * linode_type['gpus'] if speed else None
+
+    speed = CPU_SPEEDS.get(mode)
+    if not speed or not linode_type['vcpus']:
+        return None
+    return speed * linode_type['vcpus'] * (1 if linode_type['class'] == 'dedicated' else SHARED_CPU_FACTOR)
+
+
+def estimate(linode_type: dict, server_type: dict, speed: float, agents: int, keyspace: int, region: str = None,
+             efficiency: float = 0.9):
+    hours = SETUP_HOURS + keyspace / (speed * agents * efficiency) / 3600
+    hourly = agents * catalog.hourly_price(linode_type, region) + catalog.hourly_price(server_type, region)
+    # Linode bills started hours, capped at the monthly price
+    monthly = agents * linode_type['monthly'] + server_type['monthly']
+    cost = min(math.ceil(hours) * hourly, monthly * math.ceil(hours / 730)) if monthly else math.ceil(hours) * hourly
+
+    return {
+        'type': linode_type['id'],
+        'label': linode_type['label'],
+        'agents': agents,
+        'speed': speed * agents,
+        'hours': hours,
+        'cost': cost
+    }
+
+
+def plan(config: dict, cat: dict, mode: int, keyspace: int, deadline: float = None, budget: float = None,
+         optimize: str = None, max_agents: int = 30, region: str = None, measured: dict = None):
+    """Best agent count per Linode type, sorted by the objective.
+
+    optimize='cost' finds the cheapest fleet that meets the deadline, optimize='time' the fastest one within
+    the budget; without an explicit choice it is cost when a deadline is given and time otherwise.
+    """
+    optimize = optimize or ('cost' if deadline else 'time')
+    server_type = catalog.find_type(cat, SERVER_TYPE) or {'hourly': 0.0, 'monthly': 0.0, 'region_prices': {}}
+    key = (lambda o: (o['cost'], o['hours'])) if optimize == 'cost' else (lambda o: (o['hours'], o['cost']))
+
+    options = []
+    for linode_type in cat['types']:
+        speed = agent_speed(config, linode_type, mode, measured)
+        if not speed:
+            continue
+
+        feasible = [
+            o for o in (estimate(linode_type, server_type, speed, n, keyspace, region)
+                        for n in range(1, max_agents + 1))
+            if (deadline is None or o['hours'] <= deadline) and (budget is None or o['cost'] <= budget)
+        ]
+        if feasible:
+            options.append(min(feasible, key=key))
+
+    return sorted(options, key=key)
+
+
+def format_speed(speed: float):
+    for unit, size in (('TH/s', 1e12), ('GH/s', 1e9), ('MH/s', 1e6), ('kH/s', 1e3)):
+        if speed >= size:
+            return f'{speed / size:.1f} {unit}'
+    return f'{speed:.0f} H/s'
+
+
+def format_hours(hours: float):
+    if hours >= 48:
+        return f'{hours / 24:.1f} d'
+    return f'{int(hours)}:{int(hours * 60) % 60:02} h'
+
+
+def print_plan(options: list, mode: int, keyspace: int, top: int = 5):
+    print(f'# {HASH_MODES.get(mode, f"mode {mode}")}, keyspace {keyspace:.3g}')
+    if not options:
+        print(' ! no Linode type can do it within the deadline and budget, '
+              'raise max_agents or add measured speeds to the config')
+        return
+
+    print(f'   {"type":<24} {"agents":>6} {"fleet speed":>12} {"time":>10} {"cost":>10}')
+    for o in options[:top]:
+        print(f'   {o["type"]:<24} {o["agents"]:>6} {format_speed(o["speed"]):>12} {format_hours(o["hours"]):>10} '
+              f'{"$" + format(o["cost"], ".2f"):>10}')
+    best = options[0]
+    print(f'# Recommended: {best["agents"]} x {best["label"]}')
+
+
+def run(config: dict, mode: int, keyspace: str, deadline: float = None, budget: float = None, optimize: str = None,
+        region: str = None, refresh: bool = False, measured: dict = None):
+    try:
+        size = parse_keyspace(keyspace)
+    except ValueError as e:
+        print(f'# Can\'t read the keyspace: {e}')
+        sys.exit(1)
+    cat = catalog.get(config, refresh)
+    max_agents = int(config['settings'].get('max_agents', 30))
+    if any(mode in modes for modes in (measured or {}).values()):
+        print(f'# Using fleet measurements for {", ".join(sorted(t for t in measured if mode in measured[t]))}')
+    print_plan(plan(config, cat, mode, size, deadline, budget, optimize, max_agents, region, measured), mode, size)
@@ -0,0 +1,118 @@
+import socket
+import ssl
+import time
+
+import requests
+
+import http_client
+import tracing
+
+
+class ReadinessError(Exception):
+    pass
+
+
+class Deadline:
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.start_time = time.monotonic()
+
+    def elapsed(self):
+        return time.monotonic() - self.start_time
+
+    def remaining(self):
+        return max(0.0, self.seconds - self.elapsed())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+def wait_for(description: str, check, deadline: Deadline, interval: float = 2, max_interval: float = 20,
+             factor: float = 1.5):
+    """Call check() with growing pauses until it returns something truthy or the deadline passes.
+
+    Exceptions raised by check() count as "not ready yet"; the last one is reported
+    in the ReadinessError if the deadline runs out.
+    """
+    with tracing.span(description, 'wait'):
+        return _wait_for(description, check, deadline, interval, max_interval, factor)
+
+
+def _wait_for(description: str, check, deadline: Deadline, interval: float, max_interval: float, factor: float):
+    start_time = time.monotonic()
+    reason = 'no response'
+
+    while True:
+        try:
+            result = check()
+            if result:
+                print(f'\r - {description}: ready after {int(time.monotonic() - start_time)} s ', flush=True)
+                return result
+            reason = 'not ready'
+        except ReadinessError:
+            raise
+        except Exception as e:
+            reason = str(e) or type(e).__name__
+
+        if deadline.expired():
+            raise ReadinessError(f'{description}: gave up after {int(time.monotonic() - start_time)} s ({reason})')
+
+        print(f'\r - {description}: waiting {int(time.monotonic() - start_time)} s ', end='', flush=True)
+        tracing.sleep(min(interval, deadline.remaining()), f'poll {description}')
+        interval = min(max_interval, interval * factor)
+
+
+def wait_for_event(description: str, poller, deadline: Deadline):
+    try:
+        with tracing.span(f'{description} event', 'wait'):
+            poller.wait_for_next_event_finished(timeout=max(1, int(deadline.remaining())), interval=2)
+    except Exception as e:
+        raise ReadinessError(f'{description}: {e or type(e).__name__}')
+    print(f' - {description}: finished')
+
+
+def instance_status(instance, status: str):
+    def check():
+        instance.invalidate()
+        if instance.status in ('offline', 'stopped') and status == 'running':
+            raise ReadinessError(f'{instance.label} went {instance.status}')
+        return instance.status == status
+
+    return check
+
+
+def tcp_reachable(host: str, port: int, timeout: float = 4):
+    def check():
+        with socket.create_connection((http_client.resolve(host), port), timeout=timeout):
+            return True
+
+    return check
+
+
+def tls_reachable(host: str, port: int = 443, timeout: float = 4):
+    def check():
+        context = ssl.create_default_context()
+        with socket.create_connection((http_client.resolve(host), port), timeout=timeout) as sock:
+            with context.wrap_socket(sock, server_hostname=host):
+                return True
+
+    return check
+
+
+def http_responds(url: str, timeout: float = 4):
+    def check():
+        http_client.get(url, raise_for_status=False, retries=0, timeout=timeout)
+        return True
+
+    return check
+
+
+def json_api_responds(url: str, payload: dict, timeout: float = 4):
+    def check():
+        response = http_client.post(url, json=payload, raise_for_status=False, retries=0, timeout=timeout)
+        try:
+            return 'response' in response.json()
+        except requests.exceptions.JSONDecodeError:
+            raise ValueError(f'HTTP {response.status_code}, not an API response')
+
+    return check
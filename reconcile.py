@@ -0,0 +1,196 @@
+import re
+import time
+
+import yaml
+from linode_api4 import LinodeClient
+
+import hashtopolis_agents as hta
+import hashtopolis_server as hts
+import inventory
+import ipam
+import misc
+import network
+import scale
+
+DEFAULT_SUBNET = '10.0.77.0/24'
+DEFAULT_SERVER_TYPE = 'g6-standard-2'
+
+
+def load_desired(filename: str):
+    with open(filename, 'r') as file:
+        desired = yaml.safe_load(file) or {}
+
+    if 'region' not in desired:
+        raise ValueError(f'{filename}: region is required')
+
+    desired.setdefault('vpc_subnet', DEFAULT_SUBNET)
+    desired['server'] = {'type': DEFAULT_SERVER_TYPE, **(desired.get('server') or {})}
+    desired['agents'] = {'type': None, 'count': 0, **(desired.get('agents') or {})}
+    desired['firewall'] = desired.get('firewall') or {}
+    if desired['agents']['count'] and not desired['agents']['type']:
+        raise ValueError(f'{filename}: agents.type is required when agents.count is set')
+
+    return desired
+
+
+def agent_number(label: str):
+    return int(re.search(r'_(\d+)$', label).group(1))
+
+
+def next_agent_labels(config: dict, existing: list, amount: int, kind: str = 'agent'):
+    used = {agent_number(label) for label in existing}
+    labels = []
+    number = 1
+    while len(labels) < amount:
+        if number not in used:
+            labels.append(config['settings']['cluster_prefix'] + f'{kind}_{number:02}')
+        number += 1
+
+    return labels
+
+
+def rules_differ(current: list, desired: list):
+    def normalize(rules):
+        return sorted(
+            (r['label'], r['protocol'], r['action'], r['ports'].replace(' ', ''), tuple(sorted(r['addresses'].get('ipv4', []))))
+            for r in rules
+        )
+
+    return normalize(current) != normalize(desired)
+
+
+def plan(config: dict, client: LinodeClient, desired: dict):
+    cluster_prefix = config['settings']['cluster_prefix']
+    inv = inventory.get(config, client, refresh=True)
+    actions = []
+
+    vpc = inv['vpcs']['by_label'].get(cluster_prefix.replace('_', '-') + 'vpc')
+    if not vpc:
+        actions.append({'action': 'create_vpc', 'region': desired['region']})
+    elif vpc['region'] != desired['region']:
+        raise ValueError(f'{vpc["label"]} is in {vpc["region"]}, not {desired["region"]}; remove the cluster first')
+
+    for name in ('server', 'agent'):
+        label = cluster_prefix + f'{name}_firewall'
+        firewall = inv['firewalls']['by_label'].get(label)
+        if not firewall:
+            actions.append({'action': 'create_firewall', 'label': label})
+        if desired['firewall'].get(name) is not None:
+            rules = network.translate_inbound_rules(desired['firewall'][name])
+            if not firewall or rules_differ(network.get_rules(client.token, firewall['id'])['inbound'], rules):
+                actions.append({'action': 'set_rules', 'label': label, 'rules': desired['firewall'][name]})
+
+    server = inventory.server(config, inv)
+    if not server:
+        actions.append({'action': 'create_server', 'type': desired['server']['type']})
+    elif server['type'] != desired['server']['type']:
+        actions.append({'action': 'note', 'message': f'server is {server["type"]}, not {desired["server"]["type"]}; '
+                                                      f'redeploy it to change the type'})
+
+    # agents that spilled over into agent_regions count like the ones in the server's region
+    regions = {desired['region'], *(config['settings'].get('agent_regions') or [])}
+    agents = inventory.agents(config, inv)
+    keep = {i: a for i, a in agents.items() if a['type'] == desired['agents']['type'] and a['region'] in regions}
+    remove = {i: a for i, a in agents.items() if i not in keep}
+    surplus = len(keep) - desired['agents']['count']
+    if surplus > 0:
+        for i in sorted(keep, key=lambda i: agent_number(keep[i]['label']), reverse=True)[:surplus]:
+            remove[i] = keep.pop(i)
+
+    if remove:
+        actions.append({'action': 'remove_agents', 'agents': {i: a['label'] for i, a in remove.items()}})
+    if len(keep) < desired['agents']['count']:
+        actions.append({
+            'action': 'create_agents',
+            'type': desired['agents']['type'],
+            'labels': next_agent_labels(config, [a['label'] for a in keep.values()],
+                                        desired['agents']['count'] - len(keep))
+        })
+
+    return actions
+
+
+def print_plan(actions: list):
+    print('# Plan:')
+    for a in actions:
+        if a['action'] == 'create_vpc':
+            print(f' + VPC in {a["region"]}')
+        elif a['action'] == 'create_firewall':
+            print(f' + {a["label"]}')
+        elif a['action'] == 'set_rules':
+            print(f' ~ {a["label"]} inbound rules')
+        elif a['action'] == 'create_server':
+            print(f' + Hashtopolis server ({a["type"]})')
+        elif a['action'] == 'remove_agents':
+            for label in a['agents'].values():
+                print(f' - {label}')
+        elif a['action'] == 'create_agents':
+            for label in a['labels']:
+                print(f' + {label} ({a["type"]})')
+        elif a['action'] == 'note':
+            print(f' ! {a["message"]}')
+
+
+def execute(config: dict, client: LinodeClient, desired: dict, actions: list, prompt: bool = True):
+    """Carry out the plan; without prompt, an invalid Hashtopolis API key raises instead of waiting for a fix."""
+    cluster_prefix = config['settings']['cluster_prefix']
+    rules = {a['label']: a['rules'] for a in actions if a['action'] == 'set_rules'}
+    actions = {a['action']: a for a in actions if a['action'] != 'set_rules'}
+
+    print('# Setting up VPC network')
+    if 'create_vpc' in actions:
+        vpc = network.build_vpc(config, client, desired['region'], desired['vpc_subnet'])
+        inventory.invalidate(config)
+    else:
+        vpc = network.get_vpc_info(config, client)
+    print(' - done')
+
+    server_firewall_id = network.get_firewall(client, cluster_prefix + 'server_firewall')
+    agent_firewall_id = network.get_firewall(client, cluster_prefix + 'agent_firewall')
+    server_vpc_ip = ipam.server_address(desired['vpc_subnet'])
+
+    if 'create_server' in actions:
+        hts.deploy_server(config, client, desired['region'], server_firewall_id, vpc, server_vpc_ip,
+                          desired['vpc_subnet'], actions['create_server']['type'])
+
+    if 'remove_agents' in actions:
+        # drained and deregistered from Hashtopolis like a scale in, so no chunks stay assigned to dead agents
+        inv = inventory.get(config, client, refresh=True)
+        removals = {i: inv['instances']['by_id'][i] for i in actions['remove_agents']['agents']
+                    if i in inv['instances']['by_id']}
+        scale.scale_in(config, client, removals, network.get_vpc_address_map(client, vpc['vpc']['id']), len(removals))
+
+    if 'create_agents' in actions:
+        create = actions['create_agents']
+        vpc_addresses = [server_vpc_ip] + ipam.allocate(config, client, vpc['vpc']['id'], desired['vpc_subnet'],
+                                                        create['labels'])
+        hta.deploy_linodes(config, client, desired['region'], agent_firewall_id, create['type'], len(create['labels']),
+                           vpc, vpc_addresses, create['labels'], prompt=prompt)
+
+    for name, firewall_id in (('server', server_firewall_id), ('agent', agent_firewall_id)):
+        if cluster_prefix + f'{name}_firewall' in rules:
+            network.set_rules(client.token, firewall_id, rules[cluster_prefix + f'{name}_firewall'])
+    if cluster_prefix + 'server_firewall' in rules and config['settings'].get('agent_regions'):
+        # set_rules replaces the rules that let out-of-region agents in
+        hta.open_server_firewall(config, client, desired['region'])
+
+    inventory.invalidate(config)
+
+
+def apply(config: dict, client: LinodeClient, filename: str, no_prompt: bool = False):
+    start_time = time.time()
+    desired = load_desired(filename)
+    actions = plan(config, client, desired)
+
+    print_plan(actions)
+    if all(a['action'] == 'note' for a in actions):
+        print(f'# Cluster already matches {filename}')
+        return
+
+    if not no_prompt:
+        print('# Continue?', end=' ')
+        misc.confirmation()
+
+    execute(config, client, desired, actions, prompt=not no_prompt)
+
+    print(f'# Applied, it took {int((time.time() - start_time) // 60):>02}:{int(time.time() - start_time) % 60:>02}s')
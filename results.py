@@ -0,0 +1,156 @@
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+import requests
+
+import jobs
+import state
+import tracing
+
+DB_NAME = 'cracked.sqlite'
+LOOKUP_BATCH = 500
+
+SCHEMA = '''
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+PRAGMA cache_size = -65536;
+CREATE TABLE IF NOT EXISTS cracked (
+    hash TEXT NOT NULL, hash_mode INTEGER NOT NULL, plain TEXT, hashlist_id INTEGER, crackpos INTEGER, found REAL,
+    PRIMARY KEY (hash, hash_mode)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cracked_hashlist ON cracked (hashlist_id, hash);
+CREATE TABLE IF NOT EXISTS cursors (hashlist_id INTEGER PRIMARY KEY, name TEXT, cracked INTEGER, updated REAL);
+CREATE TEMP TABLE IF NOT EXISTS incoming (
+    hash TEXT, hash_mode INTEGER, plain TEXT, hashlist_id INTEGER, crackpos INTEGER, found REAL
+);
+'''
+
+
+def connect():
+    db = sqlite3.connect(state.path(DB_NAME), timeout=30)
+    db.executescript(SCHEMA)
+    return db
+
+
+def hashlists(config: dict, hashlist_ids: list = None):
+    """Plain hashlists to poll; superhashlists stand for their parts, which is where the cracks are counted."""
+    supers = {s['hashlistId'] for s in jobs.api(config, 'superhashlist', 'listSuperhashlists')['superhashlists']}
+    if not hashlist_ids:
+        return [h['hashlistId'] for h in jobs.api(config, 'hashlist', 'listHashlists')['hashlists']
+                if h['hashlistId'] not in supers]
+
+    expanded = []
+    for hashlist_id in hashlist_ids:
+        if hashlist_id in supers:
+            expanded += jobs.api(config, 'superhashlist', 'getSuperhashlist', superhashlistId=hashlist_id)['hashlists']
+        else:
+            expanded.append(hashlist_id)
+
+    return list(dict.fromkeys(expanded))
+
+
+def changed(config: dict, db: sqlite3.Connection, hashlist_ids: list):
+    """getHashlist for every hashlist, keep the ones whose cracked count moved since the saved cursor.
+
+    A different name under the same ID means the server was redeployed, its cursor starts over.
+    """
+    parallelism = int(config['settings'].get('parallelism', 8))
+    with ThreadPoolExecutor(max_workers=max(1, parallelism)) as executor:
+        details = list(executor.map(lambda i: jobs.api(config, 'hashlist', 'getHashlist', hashlistId=i),
+                                    hashlist_ids))
+
+    cursors = {row[0]: row[1:] for row in db.execute('SELECT hashlist_id, name, cracked FROM cursors')}
+    return [d for d in details if d['cracked'] and cursors.get(d['hashlistId']) != (d['name'], d['cracked'])]
+
+
+def potfile_line(row: tuple):
+    return f'{row[0]}:{row[1]}\n'
+
+
+def jsonl_line(row: tuple):
+    # only the strings go through json, dumping a dict per line is three times slower
+    return (f'{{"hash": {json.dumps(row[0])}, "plain": {json.dumps(row[1])}, "mode": {row[2]}, '
+            f'"hashlist": {row[3]}, "found": {row[4]!r}}}\n')
+
+
+@tracing.traced()
+def export(config: dict, potfile: str = None, jsonl: str = None, hashlist_ids: list = None):
+    """Fetch cracks of hashlists that have new ones and append the hashes not seen before to the outputs.
+
+    Hashtopolis has no paged getCracked, so the cursor is the cracked count of each hashlist: unchanged
+    hashlists cost one getHashlist, changed ones are downloaded whole. Cracks the index already has for the
+    hashlist are dropped before anything is staged, so only the new ones cost writes and output.
+    jobs.py uploads big files in parts, which keeps each download to the size of one part.
+    Delivery is at least once: the outputs are flushed before the index commits, so an export that dies in
+    between writes those hashes again on the next run. Hashcat and the jsonl readers take repeated lines.
+    """
+    outputs = [(open(path, 'a'), fmt) for path, fmt in ((potfile, potfile_line), (jsonl, jsonl_line)) if path]
+    new = 0
+    try:
+        with closing(connect()) as db:
+            for hashlist in changed(config, db, hashlists(config, hashlist_ids)):
+                found = time.time()
+                cracked = jobs.api(config, 'hashlist', 'getCracked', hashlistId=hashlist['hashlistId'])['cracked']
+                known = {row[0] for row in db.execute('SELECT hash FROM cracked WHERE hashlist_id = ?',
+                                                      (hashlist['hashlistId'],))}
+                cracked = [c for c in cracked if c['hash'] not in known]
+                with db:
+                    # staged in an unindexed table, then merged in key order, which keeps index writes local
+                    db.execute('DELETE FROM incoming')
+                    db.executemany('INSERT INTO incoming VALUES (?, ?, ?, ?, ?, ?)', (
+                        (c['hash'], hashlist['hashtypeId'], c['plain'], hashlist['hashlistId'], c.get('crackpos'),
+                         found) for c in cracked))
+                    # a hashlist can hold the same hash more than once, it's written once like in the index
+                    rows = db.execute('SELECT hash, plain, hash_mode, hashlist_id, MIN(found) FROM incoming i '
+                                      'WHERE NOT EXISTS (SELECT 1 FROM cracked c '
+                                      'WHERE c.hash = i.hash AND c.hash_mode = i.hash_mode) '
+                                      'GROUP BY hash, hash_mode')
+                    for chunk in iter(lambda: rows.fetchmany(10000), []):
+                        for file, fmt in outputs:
+                            file.writelines(fmt(row) for row in chunk)
+                        new += len(chunk)
+                    for file, _ in outputs:
+                        file.flush()
+                    db.execute('INSERT OR IGNORE INTO cracked SELECT * FROM incoming ORDER BY hash, hash_mode')
+                    db.execute('INSERT OR REPLACE INTO cursors VALUES (?, ?, ?, ?)',
+                               (hashlist['hashlistId'], hashlist['name'], hashlist['cracked'], time.time()))
+    finally:
+        for file, _ in outputs:
+            file.close()
+
+    return new
+
+
+def follow(config: dict, potfile: str = None, jsonl: str = None, hashlist_ids: list = None, interval: float = 60):
+    print(f'# Exporting new cracks every {interval:g} seconds, Ctrl+C to stop')
+    try:
+        while True:
+            try:
+                new = export(config, potfile, jsonl, hashlist_ids)
+                if new:
+                    print(f' - {new} new cracked hashes at {time.strftime("%H:%M:%S")}')
+            except (requests.exceptions.RequestException, RuntimeError) as e:
+                print(f' ! {e}')
+            tracing.sleep(interval, 'poll cracked hashes')
+    except KeyboardInterrupt:
+        print('\n# Stopped')
+
+
+def lookup(hashes: list):
+    """Plains of the given hashes, from the local index only."""
+    found = {}
+    with closing(connect()) as db:
+        for start in range(0, len(hashes), LOOKUP_BATCH):
+            batch = hashes[start:start + LOOKUP_BATCH]
+            found.update(db.execute(f'SELECT hash, plain FROM cracked WHERE hash IN ({", ".join("?" * len(batch))})',
+                                    batch).fetchall())
+
+    return found
+
+
+def count():
+    with closing(connect()) as db:
+        return db.execute('SELECT COUNT(*) FROM cracked').fetchone()[0]
@@ -0,0 +1,137 @@
+import time
+from collections import Counter
+
+from linode_api4 import LinodeClient
+
+import hashtopolis_agents as hta
+import inventory
+import ipam
+import misc
+import network
+import reconcile
+import teardown
+import tracing
+import warm_pool
+
+
+def pick_removals(agents: dict, matched: dict, amount: int):
+    """Prefer agents that are not working on a chunk, then the highest numbered ones."""
+    def busy(linode_id):
+        return matched.get(linode_id, {}).get('lastActivity', {}).get('action') == 'sendProgress'
+
+    ordered = sorted(agents, key=lambda i: (busy(i), -reconcile.agent_number(agents[i]['label'])))
+    return ordered[:amount]
+
+
+def drain(config: dict, agent_ids: list):
+    domain = config['settings']['domain']
+    token = config['keys']['hashtopolis']
+    timeout = int(config['settings'].get('drain_timeout', 120))
+
+    print(f'# Deactivating {len(agent_ids)} Hashtopolis agents')
+    for agent_id in agent_ids:
+        hta.set_agent_active(domain, token, agent_id, False)
+
+    start_time = time.time()
+    working = list(agent_ids)
+    while working and time.time() - start_time < timeout:
+        working = [a for a in working
+                   if hta.get_agent(domain, token, a).get('lastActivity', {}).get('action') == 'sendProgress']
+        print(f'\r - {len(working)} agents still finishing their chunks, {int(time.time() - start_time)} s ',
+              end='', flush=True)
+        if working:
+            tracing.sleep(5, 'poll draining agents')
+    print()
+
+    if working:
+        print(f' - drain timeout, releasing the chunks of {len(working)} agents')
+
+    for agent_id in agent_ids:
+        hta.delete_agent(domain, token, agent_id)
+    print(' - agents deregistered')
+
+
+def scale_out(config: dict, client: LinodeClient, agents: dict, vpc: dict, vpc_subnet: str, amount: int,
+              type_id: str, region: str, used: set, prompt: bool = True, refill: bool = False):
+    cluster_prefix = config['settings']['cluster_prefix']
+    labels = reconcile.next_agent_labels(config, [a['label'] for a in agents.values()], amount)
+
+    taken = warm_pool.take(config, client, amount, type_id, labels)
+    labels = labels[len(taken):]
+    if labels:
+        vpc_addresses = [ipam.server_address(vpc_subnet)] + ipam.allocate(config, client, vpc['vpc']['id'],
+                                                                          vpc_subnet, labels, used)
+        firewall_id = network.get_firewall(client, cluster_prefix + 'agent_firewall')
+        hta.deploy_linodes(config, client, region, firewall_id, type_id, len(labels), vpc, vpc_addresses, labels,
+                           prompt=prompt)
+
+    if refill:
+        warm_pool.refill_in_background(config, client)
+    elif taken and int(config['settings'].get('warm_pool_size', 0)):
+        print(f'# {len(taken)} agents came from the warm pool, "python3 mewa.py pool fill" refills it')
+
+
+def scale_in(config: dict, client: LinodeClient, agents: dict, vpc_addresses: dict, amount: int):
+    matched = hta.match_agents(config['settings']['domain'], config['keys']['hashtopolis'],
+                               hta.instance_ips(agents, vpc_addresses))
+    removals = pick_removals(agents, matched, amount)
+
+    agent_ids = [matched[i]['agentId'] for i in removals if i in matched]
+    if agent_ids:
+        drain(config, agent_ids)
+
+    teardown.run(config, client, {i: agents[i]['label'] for i in removals})
+    hta.open_server_firewall(config, client)
+
+
+def scale(config: dict, client: LinodeClient, target: int, type_id: str = None, no_prompt: bool = False,
+          refill: bool = False):
+    """Add or remove agents until target are running; returns whether the fleet was changed.
+
+    With refill, pool members taken are replaced on a background thread, which only a long running caller keeps.
+    """
+    max_agents = int(config['settings'].get('max_agents', 30))
+    if not 0 <= target <= max_agents:
+        print(f'# {target} agents is outside 0-{max_agents}, raise settings.max_agents to go further')
+        return False
+
+    inv = inventory.get(config, client, refresh=True)
+    agents = inventory.agents(config, inv)
+    vpc = network.get_vpc_info(config, client)
+    if not vpc or not inventory.server(config, inv):
+        print('# No running cluster found, deploy the server first')
+        return False
+
+    vpc_subnet = inv['vpcs']['by_id'][vpc['vpc']['id']]['subnets'][0]['ipv4']
+    region = inv['vpcs']['by_id'][vpc['vpc']['id']]['region']
+    if type_id is None and agents:
+        type_id = Counter(a['type'] for a in agents.values()).most_common(1)[0][0]
+
+    difference = target - len(agents)
+    if difference == 0:
+        print(f'# Already running {target} agents')
+        return False
+    if difference > 0 and not type_id:
+        print('# No agents to copy the type from, pass --type')
+        return False
+
+    if difference > 0:
+        print(f'# {difference} {type_id} agents will be added to the {len(agents)} running in {region}. Continue?',
+              end=' ')
+    else:
+        print(f'# {-difference} of {len(agents)} agents will be deregistered and removed. Continue?', end=' ')
+    if no_prompt:
+        print()
+    else:
+        misc.confirmation()
+
+    vpc_addresses = network.get_vpc_address_map(client, vpc['vpc']['id'])
+    if difference > 0:
+        scale_out(config, client, agents, vpc, vpc_subnet, difference, type_id, region, set(vpc_addresses),
+                  prompt=not no_prompt, refill=refill)
+    else:
+        scale_in(config, client, agents, vpc_addresses, -difference)
+
+    inventory.invalidate(config)
+    print(f'# Running {target} agents')
+    return True
@@ -0,0 +1,119 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import tracing
+
+
+class Task:
+    def __init__(self, name: str, fn, deps: tuple = ()):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.status = 'pending'
+        self.result = None
+        self.error = None
+        self.start_time = None
+        self.end_time = None
+        self.resumed = False
+
+
+class TaskFailed(Exception):
+    def __init__(self, tasks: dict):
+        self.tasks = tasks
+        failed = [t.name for t in tasks.values() if t.status == 'failed']
+        super().__init__(f'failed: {", ".join(failed)}')
+
+
+def run(tasks: list, parallelism: int = 8, journal=None):
+    """Run tasks as soon as their dependencies finish; fn receives a dict of dependency results.
+
+    A failed task marks every task depending on it, directly or not, as skipped.
+    Raises TaskFailed after all runnable tasks are done if anything failed.
+    With a journal, results are recorded under the task name and tasks already recorded are not run again,
+    as long as everything they depend on was resumed as well.
+    """
+    tasks = {t.name: t for t in tasks}
+    for t in tasks.values():
+        unknown = [d for d in t.deps if d not in tasks]
+        if unknown:
+            raise ValueError(f'{t.name} depends on unknown tasks: {", ".join(unknown)}')
+
+    if journal is not None:
+        resuming = True
+        while resuming:
+            resuming = False
+            for t in tasks.values():
+                if t.status == 'pending' and journal.done(t.name) and all(tasks[d].resumed for d in t.deps):
+                    t.status, t.result, t.resumed = 'done', journal.get(t.name), True
+                    resuming = True
+
+    start_time = time.time()
+    executor = ThreadPoolExecutor(max_workers=parallelism)
+    running = {}
+
+    def call(task):
+        task.start_time = time.time()
+        try:
+            with tracing.span(f'task {task.name}'):
+                return task.fn({d: tasks[d].result for d in task.deps})
+        finally:
+            task.end_time = time.time()
+
+    try:
+        while True:
+            skipping = True
+            while skipping:
+                skipping = False
+                for t in tasks.values():
+                    if t.status == 'pending' and any(tasks[d].status in ('failed', 'skipped') for d in t.deps):
+                        t.status = 'skipped'
+                        skipping = True
+            for t in tasks.values():
+                if t.status == 'pending' and all(tasks[d].status == 'done' for d in t.deps):
+                    t.status = 'running'
+                    running[executor.submit(call, t)] = t
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                t = running.pop(future)
+                try:
+                    t.result = future.result()
+                    t.status = 'done'
+                    if journal is not None:
+                        journal.record(t.name, t.result)
+                except BaseException as e:
+                    t.error = e
+                    t.status = 'failed'
+                    print(f'\n ! {t.name} failed: {e or type(e).__name__}')
+    except KeyboardInterrupt:
+        # running tasks give up at their next wait
+        tracing.interrupt()
+        raise
+    finally:
+        # on Ctrl+C, tasks that haven't started are dropped but running ones are waited for, so nothing
+        # creates instances behind the back of a clean up that runs next
+        if any(not f.done() for f in running):
+            print(f'\n# Waiting for running tasks to stop: {", ".join(t.name for t in running.values())}')
+        executor.shutdown(wait=True, cancel_futures=True)
+        tracing.resume()
+
+    print_timings(tasks, start_time)
+    if any(t.status == 'failed' for t in tasks.values()):
+        raise TaskFailed(tasks)
+
+    return {t.name: t.result for t in tasks.values()}
+
+
+def print_timings(tasks: dict, start_time: float):
+    print('# Task timings:')
+    for t in sorted(tasks.values(), key=lambda t: t.start_time or float('inf')):
+        if t.start_time is None:
+            print(f' - {t.name:<24} {"resumed" if t.resumed else t.status}')
+            continue
+        end_time = t.end_time or time.time()
+        print(f' - {t.name:<24} {t.status:<8} start {t.start_time - start_time:>7.1f} s  '
+              f'took {end_time - t.start_time:>7.1f} s')
+    print(f' - wall-clock {time.time() - start_time:.1f} s')
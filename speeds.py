@@ -0,0 +1,132 @@
+import sqlite3
+import statistics
+import time
+from collections import defaultdict
+from contextlib import closing
+
+import planner
+import state
+
+DB_NAME = 'speeds.sqlite'
+# An agent is an outlier when its median is this many MADs away from the group, and at least MIN_DEVIATION off
+OUTLIER_SCORE = 3.5
+MIN_DEVIATION = 0.2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS agents (
+    collected REAL, day TEXT, linode_id INTEGER, label TEXT, linode_type TEXT, region TEXT,
+    agent_id INTEGER, devices TEXT, cpu_only INTEGER
+);
+CREATE TABLE IF NOT EXISTS samples (
+    collected REAL, day TEXT, linode_id INTEGER, label TEXT, linode_type TEXT, region TEXT,
+    agent_id INTEGER, hash_mode INTEGER, task_id INTEGER, speed REAL, benchmark TEXT
+);
+CREATE INDEX IF NOT EXISTS samples_key ON samples (linode_type, region, hash_mode, day);
+'''
+
+
+def connect():
+    db = sqlite3.connect(state.path(DB_NAME), timeout=30)
+    db.executescript(SCHEMA)
+    return db
+
+
+def store(agents: list, samples: list, collected: float = None):
+    """agents and samples are dicts with the column names of the tables above, minus collected and day."""
+    collected = collected or time.time()
+    day = time.strftime('%Y-%m-%d', time.gmtime(collected))
+    with closing(connect()) as db, db:
+        db.executemany('INSERT INTO agents VALUES (:collected, :day, :linode_id, :label, :linode_type, :region, '
+                       ':agent_id, :devices, :cpu_only)', [{**a, 'collected': collected, 'day': day} for a in agents])
+        db.executemany('INSERT INTO samples VALUES (:collected, :day, :linode_id, :label, :linode_type, :region, '
+                       ':agent_id, :hash_mode, :task_id, :speed, :benchmark)',
+                       [{**s, 'collected': collected, 'day': day} for s in samples])
+
+
+def query(days: float = 30, linode_type: str = None, region: str = None, mode: int = None):
+    where, params = ['collected >= ?'], [time.time() - days * 86400]
+    for column, value in (('linode_type', linode_type), ('region', region), ('hash_mode', mode)):
+        if value is not None:
+            where.append(f'{column} = ?')
+            params.append(value)
+
+    with closing(connect()) as db:
+        return db.execute(f'SELECT linode_type, region, hash_mode, linode_id, label, speed FROM samples '
+                          f'WHERE {" AND ".join(where)}', params).fetchall()
+
+
+def outliers(by_agent: dict):
+    """Agents whose median speed is far from the other agents of the same type, region and mode."""
+    medians = {agent: statistics.median(speeds) for agent, speeds in by_agent.items()}
+    if len(medians) < 3:
+        return {}
+
+    center = statistics.median(medians.values())
+    mad = statistics.median(abs(m - center) for m in medians.values())
+    limit = max(OUTLIER_SCORE * 1.4826 * mad, MIN_DEVIATION * center)
+
+    return {agent: m for agent, m in medians.items() if abs(m - center) > limit}
+
+
+def stats(days: float = 30, linode_type: str = None, region: str = None, mode: int = None):
+    groups = defaultdict(lambda: defaultdict(list))
+    for type_id, region_id, hash_mode, linode_id, label, speed in query(days, linode_type, region, mode):
+        groups[(type_id, region_id, hash_mode)][(linode_id, label)].append(speed)
+
+    result = []
+    for (type_id, region_id, hash_mode), by_agent in sorted(groups.items()):
+        speeds = [s for agent_speeds in by_agent.values() for s in agent_speeds]
+        result.append({
+            'type': type_id,
+            'region': region_id,
+            'mode': hash_mode,
+            'samples': len(speeds),
+            'agents': len(by_agent),
+            'median': statistics.median(speeds),
+            'variance': statistics.pvariance(speeds),
+            'stdev': statistics.pstdev(speeds),
+            'outliers': {label: speed for (_, label), speed in outliers(by_agent).items()}
+        })
+
+    return result
+
+
+def medians(days: float = 30):
+    """Median measured speed per Linode type and hash mode over all regions, for the planner."""
+    by_type = defaultdict(lambda: defaultdict(list))
+    for type_id, _, hash_mode, _, _, speed in query(days):
+        by_type[type_id][hash_mode].append(speed)
+
+    return {type_id: {mode: statistics.median(speeds) for mode, speeds in modes.items()}
+            for type_id, modes in by_type.items()}
+
+
+def devices(days: float = 30):
+    """Latest device list seen per Linode type."""
+    with closing(connect()) as db:
+        rows = db.execute('SELECT linode_type, devices FROM agents WHERE collected >= ? ORDER BY collected',
+                          (time.time() - days * 86400,)).fetchall()
+
+    return dict(rows)
+
+
+def print_stats(rows: list, days: float, type_devices: dict = None):
+    print(f'# Measured agent speeds, last {days:g} days')
+    if not rows:
+        print(' - no samples yet, they are taken while agents work on tasks (python3 mewa.py speeds collect)')
+    else:
+        print(f'   {"type":<22} {"region":<12} {"mode":<22} {"agents":>6} {"samples":>7} {"median":>12} '
+              f'{"spread":>8}')
+    for r in rows:
+        mode = planner.HASH_MODES.get(r['mode'], str(r['mode']))
+        spread = f'{r["stdev"] / r["median"]:.0%}' if r['median'] else '-'
+        print(f'   {r["type"]:<22} {r["region"]:<12} {mode[:22]:<22} {r["agents"]:>6} {r["samples"]:>7} '
+              f'{planner.format_speed(r["median"]):>12} {spread:>8}')
+        for label, speed in sorted(r['outliers'].items(), key=lambda o: o[1]):
+            print(f' ! {label} runs at {planner.format_speed(speed)}, '
+                  f'{speed / r["median"] - 1:+.0%} from the {r["type"]} median')
+
+    if type_devices:
+        print('# Devices')
+    for type_id, type_devices in sorted((type_devices or {}).items()):
+        print(f' - {type_id}: {type_devices}')
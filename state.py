@@ -0,0 +1,39 @@
+import json
+import os
+import tempfile
+
+STATE_DIR = '.mewa'
+
+
+def path(name: str):
+    os.makedirs(STATE_DIR, exist_ok=True)
+    return os.path.join(STATE_DIR, name)
+
+
+def load(name: str, default=None):
+    try:
+        with open(path(name), 'r') as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return default
+
+
+def save(name: str, data):
+    target = path(name)
+    fd, tmp_path = tempfile.mkstemp(dir=STATE_DIR, prefix=f'.{name}.')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump(data, file, indent=1)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, target)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def remove(name: str):
+    try:
+        os.unlink(path(name))
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,106 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from linode_api4 import LinodeClient
+
+import http_client
+import inventory
+import ipam
+import misc
+import network
+import readiness
+
+
+def delete_ignoring_missing(delete, *args):
+    try:
+        delete(*args)
+    except http_client.HttpError as e:
+        if e.status != 404:
+            raise
+
+
+def delete_all(delete, resources: dict, parallelism: int, report: dict):
+    def task(resource_id):
+        try:
+            delete(resource_id)
+            return None
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=max(1, min(parallelism, len(resources)))) as executor:
+        for resource_id, error in zip(resources, executor.map(task, resources)):
+            report[resources[resource_id]] = f'failed: {error}' if error else 'deleted'
+            print(f' - {resources[resource_id]}: {report[resources[resource_id]]}')
+
+
+def retry_while_in_use(delete, description: str, deadline: readiness.Deadline):
+    def check():
+        try:
+            delete()
+            return True
+        except http_client.HttpError as e:
+            if e.status == 404:
+                return True
+            if e.status == 400:
+                raise ValueError(str(e))
+            raise readiness.ReadinessError(str(e))
+
+    readiness.wait_for(description, check, deadline, interval=2, max_interval=10)
+
+
+def run(config: dict, client: LinodeClient, instances: dict, firewalls: dict = None, vpcs: dict = None):
+    firewalls = firewalls or {}
+    vpcs = vpcs or {}
+    parallelism = int(config['settings'].get('parallelism', 8))
+    deadline = readiness.Deadline(int(config['settings'].get('teardown_timeout', 600)))
+    report = {}
+
+    if instances:
+        print(f'# Removing {len(instances)} instances')
+        delete_all(lambda i: delete_ignoring_missing(misc.delete_linode, client.token, i),
+                   instances, parallelism, report)
+
+        def instances_gone():
+            remaining = inventory.linode_list(client.token, 'linode/instances',
+                                              {'label': {'+contains': config['settings']['cluster_prefix']}})
+            return not any(i['id'] in instances for i in remaining)
+
+        try:
+            readiness.wait_for('instances deleted', instances_gone, deadline, interval=3, max_interval=10)
+        except readiness.ReadinessError as e:
+            print(f'\n ! {e}')
+        ipam.release([label for label in instances.values() if report[label] == 'deleted'])
+
+    if firewalls:
+        print(f'# Removing {len(firewalls)} firewalls')
+        delete_all(lambda f: delete_ignoring_missing(network.remove_firewall, client.token, f),
+                   firewalls, parallelism, report)
+
+    for v in vpcs:
+        print(f'# Removing {vpcs[v]}')
+        try:
+            retry_while_in_use(lambda: network.remove_vpc(client, str(v)), f'{vpcs[v]} deleted', deadline)
+            ipam.forget_vpc(v)
+            report[vpcs[v]] = 'deleted'
+        except readiness.ReadinessError as e:
+            report[vpcs[v]] = f'failed: {e}'
+            print(f'\n ! {e}')
+
+    inventory.invalidate(config)
+    verify(config, client, {**instances, **firewalls, **vpcs}, report)
+
+    return report
+
+
+def verify(config: dict, client: LinodeClient, resources: dict, report: dict):
+    inv = inventory.get(config, client, refresh=True)
+    remaining = {item['label'] for kind in inv for item in inv[kind]['by_id'].values() if item['label'] in report}
+
+    print('# Teardown report:')
+    for label in report:
+        result = 'still exists' if label in remaining else report[label]
+        print(f' - {label:<40} {result}')
+
+    if remaining:
+        print(f' ! {len(remaining)} of {len(resources)} entities were not removed, run clean up again')
+    else:
+        print(f' - verified, all {len(resources)} entities are gone')
@@ -0,0 +1,60 @@
+import os
+import sys
+
+import pytest
+
+# the modules live flat in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark  # noqa: E402
+
+# mewa reads the endpoints at import time, so every fake cloud of the session listens on this port
+FAKECLOUD_PORT = benchmark.free_port()
+benchmark.point_at_fakecloud(FAKECLOUD_PORT)
+
+FAST = ['--provision-time', '0.2', '--boot-time', '0.2', '--shutdown-time', '0.2', '--install-time', '0.5',
+        '--agent-install-time', '0.5', '--image-install-time', '0.2', '--dns-delay', '0.2']
+
+
+@pytest.fixture
+def fakecloud(tmp_path, monkeypatch):
+    """Start fakecloud.py with the given arguments and return a config for it; state goes to tmp_path."""
+    import http_client
+
+    monkeypatch.chdir(tmp_path)
+    processes = []
+
+    def start(*args, agents: int = 4):
+        # pooled connections to an earlier fake cloud are dead
+        monkeypatch.setattr(http_client, '_session', None)
+        processes.append(benchmark.start_fakecloud(FAKECLOUD_PORT, [*FAST, *args]))
+        return benchmark.bench_config(FAKECLOUD_PORT, agents, 8)
+
+    yield start
+    for process in processes:
+        process.terminate()
+        process.wait()
+
+
+@pytest.fixture
+def client():
+    from linode_api4 import LinodeClient
+
+    import http_client
+
+    return LinodeClient('bench', base_url=http_client.LINODE_API)
+
+
+@pytest.fixture
+def deploy(client):
+    """Deploy a cluster with amount agents on the fake cloud, the way mewa.py does; server=False adds agents only."""
+    import journal
+    import mewa
+
+    def run(config: dict, amount: int = 0, server: bool = True):
+        j = journal.Journal()
+        j.data['params'] = {'server': server, 'linodes': bool(amount), 'region': 'us-east', 'type': 'g6-dedicated-8',
+                            'amount': amount, 'vpc_subnet': '10.0.0.0/16'}
+        mewa.run_deploy(config, client, j)
+
+    return run
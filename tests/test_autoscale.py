@@ -0,0 +1,92 @@
+from linode_api4.errors import ApiError
+
+import autoscale
+
+NOW = 1e6
+RULES = {**autoscale.DEFAULTS, 'min_agents': 0, 'max_agents': 20}
+
+
+def observation(agents: int, wanted: int = 0, idle: int = 0):
+    # one agent-hour of keyspace per wanted agent, at target_hours of 1
+    tasks = [{'id': 1, 'mode': 0, 'remaining': wanted * 3600.0, 'speed': 0.0, 'agent_speed': 1.0}] if wanted else []
+    return {'time': NOW, 'agents': agents, 'registered': agents, 'idle': idle, 'type': 'g6-dedicated-8',
+            'tasks': tasks}
+
+
+def test_grows_to_the_queue():
+    decision = autoscale.decide(observation(2, wanted=6), RULES, {})
+    assert decision['target'] == 6
+
+
+def test_hysteresis_holds_small_changes():
+    assert autoscale.decide(observation(10, wanted=11), RULES, {})['target'] == 10
+    assert autoscale.decide(observation(10, wanted=13), RULES, {})['target'] == 13
+    assert autoscale.decide(observation(10, wanted=9), RULES, {})['target'] == 10
+    assert autoscale.decide(observation(10, wanted=7), RULES, {})['target'] == 7
+
+
+def test_cooldowns_since_last_change():
+    up = {'last_change': NOW - RULES['cooldown_up'] + 1}
+    assert autoscale.decide(observation(2, wanted=6), RULES, up)['target'] == 2
+    up['last_change'] -= 2
+    assert autoscale.decide(observation(2, wanted=6), RULES, up)['target'] == 6
+
+    down = {'last_change': NOW - RULES['cooldown_down'] + 1}
+    assert autoscale.decide(observation(10, wanted=5), RULES, down)['target'] == 10
+    down['last_change'] -= 2
+    assert autoscale.decide(observation(10, wanted=5), RULES, down)['target'] == 5
+
+
+def test_idle_agents_reaped_after_grace():
+    decision = autoscale.decide(observation(4, idle=4), RULES, {})
+    assert decision['target'] == 4
+    assert decision['memory']['idle_since'] == NOW
+
+    memory = {'idle_since': NOW - RULES['idle_grace'], 'empty_since': NOW - RULES['idle_grace']}
+    assert autoscale.decide(observation(4, idle=4), RULES, memory)['target'] == 0
+
+
+def test_idle_reaping_keeps_what_the_queue_needs():
+    memory = {'idle_since': NOW - RULES['idle_grace'], 'last_change': NOW}
+    assert autoscale.decide(observation(6, wanted=4, idle=3), RULES, memory)['target'] == 4
+
+
+def test_busy_agents_clear_idle_memory():
+    memory = {'idle_since': NOW - 10}
+    assert 'idle_since' not in autoscale.decide(observation(4, wanted=4), RULES, memory)['memory']
+
+
+def test_clamped_to_limits():
+    rules = {**RULES, 'min_agents': 2, 'max_agents': 5}
+    assert autoscale.decide(observation(0), rules, {})['target'] == 2
+    assert autoscale.decide(observation(3, wanted=50), rules, {})['target'] == 5
+
+
+
+def test_daemon_outlives_failed_polls(tmp_path, monkeypatch, capsys):
+    config = {'settings': {'cluster_prefix': 'test_'}}
+    failures = iter([KeyError('hashlistId'), ApiError('Linode busy', 400), None])
+    polls = []
+
+    def scale(*args, **kwargs):
+        error = next(failures)
+        if error:
+            raise error
+        return True
+
+    def sleep(seconds, reason):
+        polls.append(seconds)
+        if len(polls) == 3:
+            raise KeyboardInterrupt
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(autoscale, 'observe', lambda config, client: observation(2, wanted=6))
+    monkeypatch.setattr(autoscale.scale, 'scale', scale)
+    monkeypatch.setattr(autoscale.tracing, 'sleep', sleep)
+    autoscale.run(config, None)
+
+    captured = capsys.readouterr()
+    assert "KeyError: 'hashlistId'" in captured.err
+    assert ' ! Linode busy' in captured.out
+    # only the change that went through started the cooldown
+    assert autoscale.state.load(autoscale.memory_name(config))['last_change'] > 0
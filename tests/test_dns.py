@@ -0,0 +1,31 @@
+import benchmark
+import network
+from conftest import FAKECLOUD_PORT
+
+DOMAIN = 'hashtopolis.bench.example'
+
+
+def publish(config, ip):
+    network.update_a_record(config['keys']['godaddy_key'], config['keys']['godaddy_secret'], 'bench.example',
+                            'hashtopolis', ip)
+
+
+def test_quorum_tolerates_a_dead_nameserver(fakecloud):
+    config = fakecloud()
+    publish(config, '192.0.2.10')
+    # nothing listens on a freed port, queries to it time out
+    nameservers = [f'127.0.0.1:{FAKECLOUD_PORT}', f'127.0.0.1:{benchmark.free_port()}']
+
+    assert network.wait_for_dns_update(DOMAIN, '192.0.2.10', timeout=10, interval=0.2, nameservers=nameservers,
+                                       quorum=0.5)
+    assert not network.wait_for_dns_update(DOMAIN, '192.0.2.10', timeout=2, interval=0.2, nameservers=nameservers,
+                                           quorum=1.0)
+
+
+def test_stale_record_is_not_taken_for_the_new_one(fakecloud):
+    config = fakecloud('--dns-delay', '30')
+    publish(config, '192.0.2.10')
+    nameservers = [f'127.0.0.1:{FAKECLOUD_PORT}']
+
+    assert network.check_dns_propagation(DOMAIN, '192.0.2.10', nameservers) == {nameservers[0]: False}
+    assert not network.wait_for_dns_update(DOMAIN, '192.0.2.10', timeout=1, interval=0.2, nameservers=nameservers)
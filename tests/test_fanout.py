@@ -0,0 +1,33 @@
+import collections
+
+import pytest
+
+import hashtopolis_agents as hta
+import inventory
+import network
+
+
+@pytest.mark.parametrize('args, settings', [
+    # the server and two agents fill us-east
+    (('--region-capacity', 'us-east=3'), {}),
+    ((), {'agents_per_region': 2})
+], ids=['capacity error', 'agents_per_region'])
+def test_agents_spill_over_to_the_next_region(fakecloud, deploy, client, args, settings):
+    config = fakecloud(*args)
+    config['settings'].update(agent_regions=['us-ord', 'eu-central'], **settings)
+    # one after the other, agents created alongside the server could take the slot it needs
+    deploy(config)
+    deploy(config, amount=4, server=False)
+
+    inv = inventory.get(config, client, refresh=True)
+    agents = inventory.agents(config, inv).values()
+    assert collections.Counter(a['region'] for a in agents) == {'us-east': 2, 'us-ord': 2}
+    assert sorted(v['label'] for v in inv['vpcs']['by_id'].values()) == ['bench-vpc', 'bench-vpc-us-ord']
+
+    # only the agents outside the server's region come in through its public HTTPS endpoint
+    firewall_id = network.firewall_exists(client, 'bench_server_firewall')
+    allowed = {a for r in network.get_rules(client.token, firewall_id)['inbound']
+               if r['label'].startswith(network.REMOTE_AGENTS_RULE) for a in r['addresses']['ipv4']}
+    assert allowed == {f'{a["ipv4"][0]}/32' for a in agents if a['region'] == 'us-ord'}
+
+    assert len(hta.get_agents(config['settings']['domain'], config['keys']['hashtopolis'])) == 4
@@ -0,0 +1,62 @@
+import time
+
+import pytest
+import requests
+
+import benchmark
+import http_client
+from conftest import FAKECLOUD_PORT
+
+
+@pytest.fixture
+def attempts(monkeypatch):
+    """Backoffs taken, one per retry, without the waiting."""
+    taken = []
+    monkeypatch.setattr(http_client, 'backoff', lambda attempt: taken.append(attempt) or 0)
+    return taken
+
+
+def injected_errors():
+    return benchmark.fake_stats(FAKECLOUD_PORT).get('injected errors', 0)
+
+
+def test_post_is_not_retried_once_sent(fakecloud, attempts):
+    fakecloud('--error-rate', '1')
+    url = f'{http_client.LINODE_API}/linode/instances'
+
+    with pytest.raises(http_client.HttpError):
+        http_client.post(url, json={}, headers=http_client.linode_headers('bench'))
+    assert injected_errors() == 1
+
+    with pytest.raises(http_client.HttpError):
+        http_client.get(url, headers=http_client.linode_headers('bench'))
+    assert injected_errors() == 1 + 1 + http_client.MAX_RETRIES
+
+    # a read made with POST, like the Hashtopolis user API, says so
+    with pytest.raises(http_client.HttpError):
+        http_client.post(url, json={}, headers=http_client.linode_headers('bench'), idempotent=True)
+    assert injected_errors() == 2 * (1 + http_client.MAX_RETRIES) + 1
+
+
+def test_post_is_retried_when_never_sent(attempts):
+    # nothing listens on the fake cloud's port outside the fakecloud fixture
+    with pytest.raises(requests.exceptions.ConnectionError):
+        http_client.post(f'http://127.0.0.1:{FAKECLOUD_PORT}/hashtopolis/api/user.php', json={})
+    assert len(attempts) == http_client.MAX_RETRIES
+
+
+def test_token_bucket_paces_after_the_burst():
+    bucket = http_client.TokenBucket(rate=20, capacity=5)
+    start = time.monotonic()
+    for _ in range(15):
+        bucket.acquire()
+    # the first 5 go at once, the other 10 at 20 a second
+    assert 0.45 <= time.monotonic() - start < 1.0
+
+
+def test_token_bucket_pause():
+    bucket = http_client.TokenBucket(rate=1000, capacity=10)
+    bucket.pause(0.3)
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start >= 0.29
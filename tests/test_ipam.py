@@ -0,0 +1,46 @@
+import pytest
+
+import ipam
+
+CONFIG = {'settings': {}}
+
+
+@pytest.fixture(autouse=True)
+def state_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+
+def test_server_and_first_agent_addresses():
+    assert ipam.server_address('10.0.0.0/24') == '10.0.0.2'
+    assert ipam.allocate(CONFIG, None, 1, '10.0.0.0/24', ['agent_01'], used=set()) == ['10.0.0.3']
+
+
+def test_no_duplicates_across_calls():
+    used = {'10.0.0.2', '10.0.0.4'}
+    first = ipam.allocate(CONFIG, None, 1, '10.0.0.0/24', ['agent_01', 'agent_02'], used=used)
+    second = ipam.allocate(CONFIG, None, 1, '10.0.0.0/24', ['agent_03', 'agent_04'], used=used)
+    assert first == ['10.0.0.3', '10.0.0.5']
+    assert second == ['10.0.0.6', '10.0.0.7']
+
+
+def test_label_keeps_its_address():
+    first = ipam.allocate(CONFIG, None, 1, '10.0.0.0/24', ['agent_01', 'agent_02'], used=set())
+    assert ipam.allocate(CONFIG, None, 1, '10.0.0.0/24', ['agent_02', 'agent_01'], used=set()) == first[::-1]
+
+
+def test_vpcs_are_separate():
+    assert ipam.allocate(CONFIG, None, 1, '10.0.0.0/24', ['agent_01'], used=set()) == ['10.0.0.3']
+    assert ipam.allocate(CONFIG, None, 2, '10.0.0.0/24', ['agent_02'], used=set()) == ['10.0.0.3']
+
+
+def test_released_addresses_are_reused():
+    ipam.allocate(CONFIG, None, 1, '10.0.0.0/24', ['agent_01', 'agent_02'], used=set())
+    ipam.release(['agent_01'])
+    assert ipam.allocate(CONFIG, None, 1, '10.0.0.0/24', ['agent_03'], used=set()) == ['10.0.0.3']
+
+
+def test_full_subnet():
+    # .0 network, .1 gateway, .2 server, .7 broadcast
+    assert len(ipam.allocate(CONFIG, None, 1, '10.0.0.0/29', ['a', 'b', 'c', 'd'], used=set())) == 4
+    with pytest.raises(RuntimeError):
+        ipam.allocate(CONFIG, None, 1, '10.0.0.0/29', ['e'], used=set())
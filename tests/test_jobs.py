@@ -0,0 +1,40 @@
+import hashlib
+
+import pytest
+
+import jobs
+
+
+def hash_file(path, count):
+    path.write_text(''.join(hashlib.md5(str(i).encode()).hexdigest() + '\n' for i in range(count)))
+    return str(path)
+
+
+def test_upload_resumes_after_a_failed_part(fakecloud, deploy, monkeypatch, tmp_path):
+    config = fakecloud()
+    deploy(config)
+    config['settings']['hashlist_part_mb'] = 0.25
+    config['settings']['hashlist_uploads'] = 1
+    hashes = hash_file(tmp_path / 'hashes.txt', 40000)
+    upload_part, calls = jobs.upload_part, []
+
+    def failing(config, index, data, params):
+        calls.append(index)
+        if calls == [0, 1, 2]:
+            raise RuntimeError('upload interrupted')
+        return upload_part(config, index, data, params)
+
+    monkeypatch.setattr(jobs, 'upload_part', failing)
+    with pytest.raises(SystemExit):
+        jobs.submit(config, hashes, 0, mask='?a?a')
+    assert calls == [0, 1, 2]
+
+    calls.clear()
+    assert jobs.submit(config, hashes, 0, mask='?a?a')
+    # 40000 lines of 33 bytes make 6 parts of 256 KB, the two uploaded before the failure are not sent again
+    assert calls == [2, 3, 4, 5]
+
+    parts = [h for h in jobs.api(config, 'hashlist', 'listHashlists')['hashlists'] if ' part ' in h['name']]
+    assert len(parts) == len({h['name'] for h in parts}) == 6
+    superhashlist, = jobs.api(config, 'superhashlist', 'listSuperhashlists')['superhashlists']
+    assert superhashlist['hashCount'] == 40000
@@ -0,0 +1,58 @@
+import pytest
+
+import hashtopolis_agents as hta
+import inventory
+import journal
+import mewa
+
+PARAMS = {'server': True, 'linodes': True, 'region': 'us-east', 'type': 'g6-dedicated-8', 'amount': 4,
+          'vpc_subnet': '10.0.0.0/16'}
+
+
+def agent_labels(config, client):
+    inv = inventory.get(config, client, refresh=True)
+    return sorted(a['label'] for a in inventory.agents(config, inv).values())
+
+
+def test_resume_finishes_an_interrupted_deploy(fakecloud, client, monkeypatch):
+    config = fakecloud()
+    provision_agent, calls = hta.provision_agent, []
+
+    def flaky(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 3:
+            # a single agent failing is reported and skipped, this one takes the whole task down
+            raise KeyboardInterrupt
+        return provision_agent(*args, **kwargs)
+
+    monkeypatch.setattr(hta, 'provision_agent', flaky)
+    with pytest.raises(SystemExit):
+        mewa.run_deploy(config, client, journal.start(config, PARAMS))
+    assert journal.load(config).done('server')
+    created = agent_labels(config, client)
+    assert len(created) < 4
+
+    monkeypatch.setattr(hta, 'provision_agent', provision_agent)
+    mewa.resume(config, client)
+
+    labels = agent_labels(config, client)
+    assert len(labels) == len(set(labels)) == 4
+    assert set(created) <= set(labels)
+    assert not journal.load(config)
+
+
+def test_resume_redoes_steps_whose_resources_are_gone(fakecloud, client, monkeypatch):
+    config = fakecloud()
+    deploy_journal = journal.start(config, PARAMS)
+    # stop right after the journal is saved, the way a crash would
+    monkeypatch.setattr(deploy_journal, 'finish', lambda: None)
+    mewa.run_deploy(config, client, deploy_journal)
+
+    inv = inventory.get(config, client, refresh=True)
+    gone = min(inventory.agents(config, inv).values(), key=lambda a: a['label'])
+    client.delete(f'/linode/instances/{gone["id"]}')
+
+    resumed = journal.load(config)
+    journal.validate(config, client, resumed)
+    assert not resumed.done(f'agents.{gone["label"]}')
+    assert resumed.done('server.instance')
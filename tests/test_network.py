@@ -0,0 +1,34 @@
+import pytest
+from linode_api4.errors import ApiError
+
+import network
+
+
+def api_error(status: int, reason: str):
+    return ApiError(reason, status, {'errors': [{'reason': reason, 'field': 'type'}]})
+
+
+@pytest.mark.parametrize('reason', [
+    'Not enough capacity in this region for that plan',
+    'No capacity available for this plan in us-east',
+    'The region is at capacity',
+    'This plan is sold out in the selected region',
+    'GPU plans are out of stock'
+])
+def test_capacity_errors(reason):
+    assert network.is_capacity_error(api_error(400, reason))
+
+
+@pytest.mark.parametrize('status, reason', [
+    (400, 'Linode type g6-dedicated-9 is not available'),
+    (400, 'Image private/123 is unavailable'),
+    (400, 'Region not currently available'),
+    (404, 'Not enough capacity in this region for that plan'),
+    (500, 'Not enough capacity in this region for that plan')
+])
+def test_other_errors(status, reason):
+    assert not network.is_capacity_error(api_error(status, reason))
+
+
+def test_only_api_errors():
+    assert not network.is_capacity_error(RuntimeError('out of capacity'))
@@ -0,0 +1,44 @@
+import pytest
+
+import planner
+
+CATALOG = {'types': [{'id': 'g6-dedicated-2', 'label': 'Dedicated 4GB', 'class': 'dedicated', 'vcpus': 2, 'gpus': 0,
+                      'hourly': 0.1, 'monthly': 72.0, 'region_prices': {}}]}
+
+
+@pytest.mark.parametrize('text, size', [
+    ('1000000', 1000000),
+    ('95^8', 95 ** 8),
+    ('26^6*10^2', 26 ** 6 * 10 ** 2),
+    ('?u?l?l?l?l?d?d', 26 ** 5 * 10 ** 2),
+    ('?a?a?a?a?a?a?a?a', 95 ** 8),
+    ('pass?d?d', 100),
+    ('?h?H?s?b', 16 * 16 * 33 * 256)
+])
+def test_parse_keyspace(text, size):
+    assert planner.parse_keyspace(text) == size
+
+
+@pytest.mark.parametrize('text', ['?1?d', '?x', 'abc', '10^x'])
+def test_parse_keyspace_rejects(text):
+    with pytest.raises(ValueError):
+        planner.parse_keyspace(text)
+
+
+def test_plan_cheapest_fleet_within_deadline():
+    # one dedicated 2 vCPU agent does 240 MH/s on MD5, 95^6 needs two of them to finish within the hour
+    options = planner.plan({}, CATALOG, 0, planner.parse_keyspace('?a?a?a?a?a?a'), deadline=1)
+    assert [(o['type'], o['agents']) for o in options] == [('g6-dedicated-2', 2)]
+    assert options[0]['hours'] <= 1
+    assert options[0]['cost'] == pytest.approx(0.2)
+
+
+def test_plan_fastest_within_budget():
+    # 25 agents need 3.8 h, 4 started hours at $2.50; a 26th agent still takes 4 hours and goes over $10
+    options = planner.plan({}, CATALOG, 0, 95 ** 7, budget=10, max_agents=30)
+    assert options[0]['agents'] == 25
+    assert options[0]['cost'] == pytest.approx(10)
+
+
+def test_plan_nothing_fits():
+    assert planner.plan({}, CATALOG, 0, 95 ** 8, deadline=1, max_agents=5) == []
@@ -0,0 +1,43 @@
+import collections
+
+import pytest
+
+import inventory
+import reconcile
+
+DESIRED = '''region: us-east
+vpc_subnet: 10.0.77.0/24
+server:
+  type: g6-standard-2
+agents:
+  type: g6-dedicated-8
+  count: {count}
+'''
+
+
+def desired(tmp_path, count: int):
+    path = tmp_path / 'cluster.yaml'
+    path.write_text(DESIRED.format(count=count))
+    return str(path)
+
+
+def test_apply_without_prompt_fails_on_an_invalid_key(fakecloud, client, tmp_path):
+    config = fakecloud()
+    config['keys']['hashtopolis'] = ''
+    with pytest.raises(RuntimeError, match='API key'):
+        reconcile.apply(config, client, desired(tmp_path, 2), no_prompt=True)
+
+
+def test_spilled_over_agents_are_kept(fakecloud, client, tmp_path):
+    # the server and two agents fill us-east, the other two agents spill over
+    config = fakecloud('--region-capacity', 'us-east=3')
+    config['settings']['agent_regions'] = ['us-ord', 'eu-central']
+    reconcile.apply(config, client, desired(tmp_path, 4), no_prompt=True)
+
+    agents = inventory.agents(config, inventory.get(config, client, refresh=True))
+    assert collections.Counter(a['region'] for a in agents.values()) == {'us-east': 2, 'us-ord': 2}
+
+    assert reconcile.plan(config, client, reconcile.load_desired(desired(tmp_path, 4))) == []
+    actions = reconcile.plan(config, client, reconcile.load_desired(desired(tmp_path, 3)))
+    assert actions == [{'action': 'remove_agents', 'agents': {
+        i: 'bench_agent_04' for i, a in agents.items() if a['label'] == 'bench_agent_04'}}]
@@ -0,0 +1,32 @@
+import time
+
+import pytest
+import requests
+
+import hashtopolis_agents as hta
+import http_client
+import inventory
+
+
+def test_unreachable_server_is_given_up_on(monkeypatch):
+    # no fake cloud is running, every listAgents is refused
+    monkeypatch.setattr(http_client, 'backoff', lambda attempt: 0)
+    monkeypatch.setattr(hta.tracing, 'sleep', lambda seconds, reason=None: time.sleep(0.01))
+    config = {'settings': {'domain': 'hashtopolis.bench.example', 'agent_registration_timeout': 1},
+              'keys': {'hashtopolis': 'bench'}}
+    start = time.monotonic()
+    with pytest.raises(requests.exceptions.ConnectionError):
+        hta.ensure_api_key(config)
+    assert time.monotonic() - start < 30
+
+
+def test_missed_deadlines_are_replaced_then_failed(fakecloud, deploy, client, capsys):
+    config = fakecloud('--agent-failure-rate', '1')
+    config['settings'].update(agent_registration_timeout=2, agent_replacements=1)
+    deploy(config, 2)
+
+    out = capsys.readouterr().out
+    assert '# 0/2 agents registered, 1 replaced' in out
+    assert out.count('not registered: ') == 2
+    # failed agents are kept for inspection
+    assert len(inventory.agents(config, inventory.get(config, client, refresh=True))) == 2
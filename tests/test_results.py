@@ -0,0 +1,48 @@
+import hashlib
+import time
+
+import jobs
+import results
+
+
+def submit(config, tmp_path, amount: int):
+    hashes = tmp_path / 'hashes.txt'
+    hashes.write_text(''.join(f'{hashlib.md5(str(i).encode()).hexdigest()}\n' for i in range(amount)))
+    jobs.submit(config, str(hashes), 0, mask='?a?a')
+
+
+def test_export_writes_each_crack_once(fakecloud, deploy, tmp_path, monkeypatch):
+    config = fakecloud('--crack-rate', '400')
+    deploy(config)
+    submit(config, tmp_path, 2000)
+
+    staged = []
+    connect = results.connect
+
+    def traced_connect():
+        db = connect()
+        db.set_trace_callback(lambda sql: sql.startswith('INSERT INTO incoming') and staged.append(sql))
+        return db
+
+    monkeypatch.setattr(results, 'connect', traced_connect)
+    first = results.export(config, 'cracked.pot')
+    time.sleep(1)
+    staged.clear()
+    second = results.export(config, 'cracked.pot')
+
+    # the second poll downloads every crack again but stages and writes only the new ones
+    assert first and second
+    assert len(staged) == second
+    lines = (tmp_path / 'cracked.pot').read_text().splitlines()
+    assert len(lines) == len(set(lines)) == first + second == results.count()
+
+
+def test_unchanged_hashlists_are_skipped(fakecloud, deploy, tmp_path):
+    config = fakecloud('--crack-rate', '100000')
+    deploy(config)
+    submit(config, tmp_path, 500)
+    time.sleep(0.5)
+
+    assert results.export(config, 'cracked.pot') == 500
+    assert results.export(config, 'cracked.pot') == 0
+    assert results.lookup([hashlib.md5(b'7').hexdigest()]) == {hashlib.md5(b'7').hexdigest(): 'pw1-7'}
@@ -0,0 +1,81 @@
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+import scheduler
+import tracing
+
+
+def test_dependencies_run_first():
+    order, lock = [], threading.Lock()
+
+    def step(name, delay=0.0):
+        def fn(results):
+            time.sleep(delay)
+            with lock:
+                order.append(name)
+            return name, results
+        return fn
+
+    results = scheduler.run([
+        scheduler.Task('boot', step('boot'), ('server', 'agents')),
+        scheduler.Task('server', step('server', 0.05)),
+        scheduler.Task('agents', step('agents', 0.01), ('vpc',)),
+        scheduler.Task('vpc', step('vpc'))
+    ], parallelism=4)
+
+    assert order.index('vpc') < order.index('agents') < order.index('boot')
+    assert order.index('server') < order.index('boot')
+    assert order[-1] == 'boot'
+    assert results['boot'] == ('boot', {'server': results['server'], 'agents': results['agents']})
+
+
+def test_independent_tasks_overlap():
+    barrier = threading.Barrier(2, timeout=5)
+    scheduler.run([scheduler.Task('a', lambda r: barrier.wait()), scheduler.Task('b', lambda r: barrier.wait())],
+                  parallelism=2)
+
+
+def test_failure_skips_dependents():
+    def fail(results):
+        raise RuntimeError('no capacity')
+
+    with pytest.raises(scheduler.TaskFailed) as e:
+        scheduler.run([
+            scheduler.Task('vpc', fail),
+            scheduler.Task('agents', lambda r: 'agents', ('vpc',)),
+            scheduler.Task('boot', lambda r: 'boot', ('agents',)),
+            scheduler.Task('server', lambda r: 'server')
+        ])
+
+    assert {name: t.status for name, t in e.value.tasks.items()} == {
+        'vpc': 'failed', 'agents': 'skipped', 'boot': 'skipped', 'server': 'done'}
+
+
+def test_unknown_dependency():
+    with pytest.raises(ValueError):
+        scheduler.run([scheduler.Task('boot', lambda r: None, ('agents',))])
+
+
+def test_ctrl_c_stops_waiting_tasks():
+    stopped = []
+
+    def wait_for_dns(results):
+        try:
+            tracing.sleep(600, 'poll DNS propagation')
+        except tracing.Interrupted:
+            stopped.append(time.monotonic())
+            raise
+
+    threading.Timer(0.2, os.kill, (os.getpid(), signal.SIGINT)).start()
+    start = time.monotonic()
+    with pytest.raises(KeyboardInterrupt):
+        scheduler.run([scheduler.Task('server', wait_for_dns), scheduler.Task('agents', lambda r: None, ('server',))])
+
+    # the running task was waited for, and it stopped right away
+    assert stopped and stopped[0] - start < 5
+    assert time.monotonic() - start < 5
+    tracing.sleep(0.01, 'after the interrupt')
@@ -0,0 +1,36 @@
+import time
+
+import inventory
+import scale
+import warm_pool
+
+
+def test_scale_takes_pool_members_and_returns(fakecloud, deploy, client, capsys):
+    config = fakecloud()
+    config['settings']['warm_pool_size'] = 2
+    deploy(config, 1)
+    warm_pool.fill(config, client)
+
+    start = time.monotonic()
+    assert scale.scale(config, client, 3, no_prompt=True)
+    assert time.monotonic() - start < 30
+
+    inv = inventory.get(config, client, refresh=True)
+    assert sorted(a['label'] for a in inventory.agents(config, inv).values()) == [
+        'bench_agent_01', 'bench_agent_02', 'bench_agent_03']
+    assert inventory.pool(config, inv) == {}
+    assert '2 agents came from the warm pool' in capsys.readouterr().out
+    assert not (warm_pool._refill and warm_pool._refill.is_alive())
+
+
+def test_refill_logs_failures(monkeypatch, capsys):
+    def fill(config, client):
+        raise RuntimeError('Can\'t get hashtopolis vouchers')
+
+    monkeypatch.setattr(warm_pool, 'fill', fill)
+    monkeypatch.setattr(warm_pool, '_refill', None)
+    warm_pool.refill_in_background({'settings': {'warm_pool_size': 2}}, None).join(5)
+
+    captured = capsys.readouterr()
+    assert ' ! warm pool refill failed: Can\'t get hashtopolis vouchers' in captured.out
+    assert 'Traceback' in captured.err
@@ -0,0 +1,244 @@
+import atexit
+import copy
+import functools
+import json
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+
+# long running commands (autoscale, metrics) would otherwise keep every span they ever made
+MAX_SPANS = 200000
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+_spans = deque(maxlen=MAX_SPANS)
+# cumulative counters for the metrics endpoint, they survive reset() and the span limit
+_totals = {'http': {}, 'phase': {}}
+_lock = threading.Lock()
+_local = threading.local()
+_jsonl = None
+_chrome_path = None
+# set while Ctrl+C is being handled, so threads that are waiting on something stop instead of waiting it out
+_interrupted = threading.Event()
+
+
+class Interrupted(Exception):
+    pass
+
+
+def configure(jsonl_path: str = None, chrome_path: str = None):
+    """Stream spans to jsonl_path as they finish and write a Chrome trace (chrome://tracing) at exit."""
+    global _jsonl, _chrome_path
+    if jsonl_path:
+        _jsonl = open(jsonl_path, 'a')
+    _chrome_path = chrome_path
+    atexit.register(close)
+
+
+def close():
+    global _jsonl
+    with _lock:
+        if _jsonl:
+            _jsonl.close()
+            _jsonl = None
+    if _chrome_path:
+        export_chrome(_chrome_path)
+
+
+def reset():
+    with _lock:
+        _spans.clear()
+
+
+def record(name: str, category: str, start: float, duration: float, **attrs):
+    stack = getattr(_local, 'stack', [])
+    item = {
+        'name': name,
+        'cat': category,
+        'start': start,
+        'duration': duration,
+        'thread': threading.current_thread().name,
+        'parent': stack[-1] if stack else None,
+        **attrs
+    }
+    with _lock:
+        _spans.append(item)
+        aggregate(item)
+        if _jsonl:
+            _jsonl.write(json.dumps(item, default=str) + '\n')
+            _jsonl.flush()
+
+
+def observe(histogram: dict, value: float):
+    histogram['count'] += 1
+    histogram['sum'] += value
+    for i, bound in enumerate(histogram['bounds']):
+        if value <= bound:
+            histogram['buckets'][i] += 1
+
+
+def histogram(bounds: tuple):
+    return {'bounds': bounds, 'buckets': [0] * len(bounds), 'count': 0, 'sum': 0.0}
+
+
+def aggregate(item: dict):
+    """HTTP calls by service and status ('error' when no response came), phases and waits by name."""
+    if item['cat'] == 'http':
+        key = (item['service'], str(item.get('status', 'error')))
+        if key not in _totals['http']:
+            _totals['http'][key] = {**histogram(LATENCY_BUCKETS), 'retries': 0}
+        observe(_totals['http'][key], item.get('latency', item['duration']))
+        _totals['http'][key]['retries'] += item.get('retries', 0)
+    elif item['cat'] in ('phase', 'wait'):
+        # numbers in names (agent labels, ports, addresses) would make a series per instance
+        key = (item['cat'], re.sub(r'\d+', '#', item['name']))
+        if key not in _totals['phase']:
+            _totals['phase'][key] = histogram(DURATION_BUCKETS)
+        observe(_totals['phase'][key], item['duration'])
+
+
+def totals():
+    with _lock:
+        return copy.deepcopy(_totals)
+
+
+@contextmanager
+def span(name: str, category: str = 'phase', **attrs):
+    """Time the block; the yielded dict can be filled with attributes (status, retries, ...) on the way."""
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    _local.stack.append(name)
+    start = time.time()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs['error'] = str(e) or type(e).__name__
+        raise
+    finally:
+        _local.stack.pop()
+        record(name, category, start, time.time() - start, **attrs)
+
+
+def traced(category: str = 'phase'):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(fn.__name__, category):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def sleep(seconds: float, reason: str):
+    """Every wait of mewa goes through here; after interrupt() it raises Interrupted instead of sleeping."""
+    check_interrupted(reason)
+    if seconds <= 0:
+        return
+    with span(reason, 'sleep'):
+        if _interrupted.wait(seconds):
+            raise Interrupted(reason)
+
+
+def check_interrupted(reason: str):
+    if _interrupted.is_set():
+        raise Interrupted(reason)
+
+
+def interrupt():
+    _interrupted.set()
+
+
+def resume():
+    _interrupted.clear()
+
+
+def endpoint(method: str, url: str, payload=None):
+    path = re.sub(r'/\d+(?=/|$)', '/{id}', urlsplit(url).path.removeprefix('/v4').removeprefix('/v1'))
+    if isinstance(payload, dict) and 'section' in payload and 'request' in payload:
+        path += f' {payload["section"]}.{payload["request"]}'
+    return f'{method} {path}'
+
+
+def instrument_session(session: requests.Session, service: str):
+    """Record calls made through a third party session, e.g. LinodeClient.session."""
+    def hook(response, *args, **kwargs):
+        duration = response.elapsed.total_seconds()
+        record(endpoint(response.request.method, response.url), 'http', time.time() - duration, duration,
+               service=service, status=response.status_code, retries=0, latency=duration)
+
+    session.hooks['response'].append(hook)
+
+
+def summary(wall_clock: float = None):
+    with _lock:
+        spans = list(_spans)
+    if not spans:
+        return
+
+    print('# Where the time went (spans nest and run in parallel, so totals overlap)')
+    if wall_clock is not None:
+        print(f' - wall-clock {wall_clock:.1f} s')
+
+    def table(title, groups, top=10):
+        rows = sorted(groups.items(), key=lambda g: -sum(s['latency'] for s in g[1]))[:top]
+        if not rows:
+            return
+        print(f'# {title}')
+        print(f'   {"":<52} {"count":>6} {"total s":>9} {"max s":>8} {"retries":>8}')
+        for name, items in rows:
+            latencies = [s['latency'] for s in items]
+            print(f'   {name[:52]:<52} {len(items):>6} {sum(latencies):>9.1f} {max(latencies):>8.1f} '
+                  f'{sum(s.get("retries", 0) for s in items):>8}')
+
+    by_category = defaultdict(list)
+    for s in spans:
+        by_category[s['cat']].append({**s, 'latency': s.get('latency', s['duration'])})
+
+    table('Categories', by_category, top=None)
+
+    services = defaultdict(list)
+    endpoints = defaultdict(list)
+    for s in by_category['http']:
+        services[s['service']].append(s)
+        endpoints[f'{s["service"]} {s["name"]}'].append(s)
+    table('API latency by service', services)
+    table('Slowest endpoints', endpoints)
+
+    for category, title in (('phase', 'Phases'), ('wait', 'Waits'), ('dns', 'DNS'), ('sleep', 'Idle sleeps')):
+        groups = defaultdict(list)
+        for s in by_category[category]:
+            groups[s['name']].append(s)
+        table(title, groups)
+
+
+def export_chrome(filename: str):
+    with _lock:
+        spans = list(_spans)
+    if not spans:
+        return
+
+    origin = min(s['start'] for s in spans)
+    threads = {name: number for number, name in enumerate(dict.fromkeys(s['thread'] for s in spans), start=1)}
+    events = [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': name}}
+              for name, tid in threads.items()]
+    for s in spans:
+        events.append({
+            'name': s['name'],
+            'cat': s['cat'],
+            'ph': 'X',
+            'pid': 1,
+            'tid': threads[s['thread']],
+            'ts': int((s['start'] - origin) * 1e6),
+            'dur': int(s['duration'] * 1e6),
+            'args': {k: v for k, v in s.items() if k not in ('name', 'cat', 'start', 'duration', 'thread')}
+        })
+
+    with open(filename, 'w') as file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file, default=str)
@@ -0,0 +1,184 @@
+import threading
+import traceback
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import linode_api4
+from linode_api4 import LinodeClient
+
+import hashtopolis_agents as hta
+import images
+import inventory
+import ipam
+import network
+import readiness
+import reconcile
+import state
+import teardown
+
+_refill = None
+
+
+def stats_name(config: dict):
+    return f'pool-{config["settings"]["cluster_prefix"]}.json'
+
+
+def record(config: dict, hits: int, misses: int):
+    stats = state.load(stats_name(config), {'hits': 0, 'misses': 0})
+    stats['hits'] += hits
+    stats['misses'] += misses
+    state.save(stats_name(config), stats)
+
+
+def age_hours(instance: dict):
+    created = datetime.fromisoformat(instance['created']).replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - created).total_seconds() / 3600
+
+
+def pool_type(config: dict, inv: dict):
+    if config['settings'].get('warm_pool_type'):
+        return config['settings']['warm_pool_type']
+
+    agents = inventory.agents(config, inv)
+    if agents:
+        return Counter(a['type'] for a in agents.values()).most_common(1)[0][0]
+
+    return None
+
+
+def fill(config: dict, client: LinodeClient, size: int = None, type_id: str = None):
+    size = int(config['settings'].get('warm_pool_size', 0)) if size is None else size
+    max_age = float(config['settings'].get('warm_pool_max_age', 24))
+    inv = inventory.get(config, client, refresh=True)
+    type_id = type_id or pool_type(config, inv)
+    members = inventory.pool(config, inv)
+
+    # without a type there is nothing to compare with, members are only recycled by age
+    stale = {i: m['label'] for i, m in members.items()
+             if age_hours(m) > max_age or (type_id and m['type'] != type_id)}
+    if stale:
+        print(f'# Recycling {len(stale)} stale pool members')
+        teardown.run(config, client, stale)
+        hta.open_server_firewall(config, client)
+        members = {i: m for i, m in members.items() if i not in stale}
+
+    amount = size - len(members)
+    if amount <= 0 or not type_id:
+        print(f'# Warm pool: {len(members)}/{size}')
+        return
+
+    vpc = network.get_vpc_info(config, client)
+    if not vpc:
+        print('# No running cluster found, deploy the server first')
+        return
+
+    vpc_info = inv['vpcs']['by_id'][vpc['vpc']['id']]
+    vpc_subnet = vpc_info['subnets'][0]['ipv4']
+    labels = reconcile.next_agent_labels(config, [m['label'] for m in members.values()], amount, 'pool')
+    vpc_addresses = [ipam.server_address(vpc_subnet)] + ipam.allocate(config, client, vpc['vpc']['id'], vpc_subnet,
+                                                                      labels)
+    firewall_id = network.get_firewall(client, config['settings']['cluster_prefix'] + 'agent_firewall')
+    parallelism = int(config['settings'].get('parallelism', 8))
+    vouchers = hta.get_x_vouchers(amount, config['settings']['domain'], config['keys']['hashtopolis'], parallelism)
+    image_id = images.find_agent_image(config, client) if str(config['settings'].get('golden_image', 0)) == '1' else None
+
+    print(f'# Adding {amount} {type_id} instances to the warm pool')
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        futures = [
+            executor.submit(provision_member, config, client, vpc_info['region'], firewall_id, type_id, label,
+                            voucher, vpc, vpc_addresses[0], vpc_ip, image_id)
+            for label, voucher, vpc_ip in zip(labels, vouchers, vpc_addresses[1:])
+        ]
+        created = 0
+        for label, future in zip(labels, futures):
+            if future.exception():
+                print(f' ! {label}: {future.exception()}')
+            else:
+                created += 1
+
+    inventory.invalidate(config)
+    print(f'# Warm pool: {len(members) + created}/{size}')
+
+
+def provision_member(config: dict, client: LinodeClient, region: str, firewall_id: str, type_id: str, label: str,
+                     voucher: str, vpc: dict, server_vpc_ip: str, vpc_ip: str, image_id: str = None):
+    """Install and register an agent, then park it deactivated and powered off."""
+    deadline = readiness.Deadline(int(config['settings'].get('warm_pool_provision_timeout', 1800)))
+    agent = hta.provision_agent(config, client, region, firewall_id, type_id, label, voucher, vpc, server_vpc_ip,
+                                vpc_ip, image_id)
+    matched = hta.wait_until_registered(config, agent, vpc_ip, deadline)
+
+    hta.set_agent_active(config['settings']['domain'], config['keys']['hashtopolis'], matched[agent.id]['agentId'],
+                         False)
+    agent.shutdown()
+    print(f' - {label} parked')
+
+
+def take(config: dict, client: LinodeClient, amount: int, type_id: str, agent_labels: list):
+    """Boot up to amount pool members as agents; returns the labels they were given."""
+    inv = inventory.get(config, client, refresh=True)
+    members = [m for m in inventory.pool(config, inv).values() if m['type'] == type_id and m['status'] == 'offline']
+    members = sorted(members, key=lambda m: m['created'], reverse=True)[:amount]
+
+    taken = []
+    matched = {}
+    if members:
+        vpc = network.get_vpc_info(config, client)
+        vpc_addresses = network.get_vpc_address_map(client, vpc['vpc']['id'])
+        matched = hta.match_agents(config['settings']['domain'], config['keys']['hashtopolis'],
+                                   hta.instance_ips({m['id']: m for m in members}, vpc_addresses))
+
+    for member, label in zip(members, agent_labels):
+        instance = linode_api4.Instance(client, member['id'])
+        instance.label = label
+        instance.save()
+        ipam.relabel(member['label'], label)
+        instance.boot()
+        if member['id'] in matched:
+            hta.set_agent_active(config['settings']['domain'], config['keys']['hashtopolis'],
+                                 matched[member['id']]['agentId'], True)
+        print(f'# {member["label"]} booted as {label}')
+        taken.append(label)
+
+    record(config, len(taken), amount - len(taken))
+    inventory.invalidate(config)
+
+    return taken
+
+
+def refill(config: dict, client: LinodeClient):
+    try:
+        fill(config, client)
+    except Exception as e:
+        print(f' ! warm pool refill failed: {e}')
+        traceback.print_exc()
+
+
+def refill_in_background(config: dict, client: LinodeClient):
+    """Fill the pool on a daemon thread, one at a time, for long running commands such as autoscale."""
+    global _refill
+    if not int(config['settings'].get('warm_pool_size', 0)):
+        return None
+    if _refill and _refill.is_alive():
+        return _refill
+
+    print('# Refilling the warm pool in the background')
+    _refill = threading.Thread(target=refill, args=(config, client), name='warm-pool-refill', daemon=True)
+    _refill.start()
+
+    return _refill
+
+
+def report(config: dict, client: LinodeClient):
+    inv = inventory.get(config, client)
+    members = inventory.pool(config, inv)
+    size = int(config['settings'].get('warm_pool_size', 0))
+    stats = state.load(stats_name(config), {'hits': 0, 'misses': 0})
+    requests = stats['hits'] + stats['misses']
+
+    print(f'# Warm pool: {len(members)}/{size}')
+    for m in sorted(members.values(), key=lambda m: m['label']):
+        print(f' - {m["label"]:<32} {m["type"]:<20} {m["status"]:<10} {age_hours(m):.1f} h old')
+    print(f'# Hits: {stats["hits"]}, misses: {stats["misses"]}'
+          + (f', hit rate {100 * stats["hits"] / requests:.0f}%' if requests else ''))